@@ -6,12 +6,34 @@ REDIS_URL = os.getenv("REDIS_URL")
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = os.getenv("REDIS_PORT")
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_POOL_TIMEOUT = int(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "purpleauth")
 OTP_LENGTH = int(os.getenv("OTP_LENGTH", "6"))
 OTP_LIFETIME = int(os.getenv("OTP_LIFETIME", "5"))
 MAGIC_LIFETIME = int(os.getenv("MAGIC_LIFETIME", "5"))
 HOST = os.getenv("FQDN_HOST")
 MAILGUN_KEY = os.getenv("MAILGUN_KEY")
 MAILGUN_ENDPOINT = os.getenv("MAILGUN_ENDPOINT")
+EMAIL_MAX_CONNECTIONS = int(os.getenv("EMAIL_MAX_CONNECTIONS", "20"))
+EMAIL_KEEPALIVE_TIMEOUT = float(os.getenv("EMAIL_KEEPALIVE_TIMEOUT", "60"))
+EMAIL_TIMEOUT = float(os.getenv("EMAIL_TIMEOUT", "10"))
+EMAIL_CONNECT_TIMEOUT = float(os.getenv("EMAIL_CONNECT_TIMEOUT", "3"))
+EMAIL_RETRIES = int(os.getenv("EMAIL_RETRIES", "3"))
+EMAIL_RETRY_BACKOFF = float(os.getenv("EMAIL_RETRY_BACKOFF", "0.5"))
+EMAIL_BATCH_WINDOW = float(os.getenv("EMAIL_BATCH_WINDOW", "0.25"))
+EMAIL_TRANSPORT = os.getenv("EMAIL_TRANSPORT", "mailgun")
+SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_TLS = os.getenv("SMTP_TLS", "starttls")
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "5"))
+EMAIL_PROVIDER_CONCURRENCY = int(os.getenv("EMAIL_PROVIDER_CONCURRENCY", "10"))
+EMAIL_QUEUE_BATCH_SIZE = int(os.getenv("EMAIL_QUEUE_BATCH_SIZE", "50"))
+EMAIL_QUEUE_MAX_ATTEMPTS = int(os.getenv("EMAIL_QUEUE_MAX_ATTEMPTS", "5"))
+EMAIL_QUEUE_RETRY_BACKOFF = float(os.getenv("EMAIL_QUEUE_RETRY_BACKOFF", "30"))
+EMAIL_QUEUE_CLAIM_IDLE = int(os.getenv("EMAIL_QUEUE_CLAIM_IDLE", "60"))
 FROM_ADDRESS = os.getenv("FROM_ADDRESS")
 VERSION = os.getenv("APP_VERSION")
 DB_URL = os.getenv("MONGO_URL")
@@ -25,7 +47,29 @@ ISSUER = os.getenv("FQDN_HOST", "http://localhost:8080")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
 FERNET_KEY = os.getenv("FERNET_KEY")
 FERNET = Fernet(FERNET_KEY)
+SECRET_PEPPER = os.getenv("SECRET_PEPPER")
 PORTAL_ENABLED = os.getenv("PORTAL_ENABLED", False)
 WEBMASTER_EMAIL = os.getenv("WEBMASTER_EMAIL")
 DEBUG = os.getenv("DEBUG", False)
 PORTAL_API_KEY = os.getenv("PORTAL_API_KEY", None)
+CLIENT_APP_CACHE_TTL = int(os.getenv("CLIENT_APP_CACHE_TTL", "300"))
+CLIENT_APP_CACHE_SIZE = int(os.getenv("CLIENT_APP_CACHE_SIZE", "1024"))
+KEY_CACHE_SIZE = int(os.getenv("KEY_CACHE_SIZE", "2048"))
+JWKS_MAX_AGE = int(os.getenv("JWKS_MAX_AGE", "3600"))
+VERIFY_BATCH_LIMIT = int(os.getenv("VERIFY_BATCH_LIMIT", "1000"))
+VERIFY_CACHE_SIZE = int(os.getenv("VERIFY_CACHE_SIZE", "4096"))
+PORTAL_USER_CACHE_TTL = int(os.getenv("PORTAL_USER_CACHE_TTL", "30"))
+PORTAL_USER_CACHE_SIZE = int(os.getenv("PORTAL_USER_CACHE_SIZE", "1024"))
+HASH_EXECUTOR = os.getenv("HASH_EXECUTOR", "thread")
+HASH_MAX_WORKERS = int(os.getenv("HASH_MAX_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_WAIT_WARNING = float(os.getenv("HASH_WAIT_WARNING", "0.5"))
+HASH_METRICS_SECONDS = float(os.getenv("HASH_METRICS_SECONDS", "300"))
+QUOTA_ENGINE = os.getenv("QUOTA_ENGINE", "mongo")
+QUOTA_FLUSH_SECONDS = int(os.getenv("QUOTA_FLUSH_SECONDS", "10"))
+QUOTA_REDIS_TTL = int(os.getenv("QUOTA_REDIS_TTL", "3600"))
+INDEX_PROGRESS_SECONDS = int(os.getenv("INDEX_PROGRESS_SECONDS", "10"))
+REFRESH_TOKEN_STORE = os.getenv("REFRESH_TOKEN_STORE", "mongo")
+# This skips a security check, so only an explicit yes turns it on.
+REFRESH_STATELESS = os.getenv("REFRESH_STATELESS", "").lower() in ("1", "true", "yes")
+REVOCATION_FILTER_CAPACITY = int(os.getenv("REVOCATION_FILTER_CAPACITY", "100000"))
+REVOCATION_REBUILD_SECONDS = int(os.getenv("REVOCATION_REBUILD_SECONDS", "300"))
@@ -1,6 +1,8 @@
+from typing import Type
 from urllib.parse import quote_plus
 
 import mongox
+from motor.motor_asyncio import AsyncIOMotorCollection
 
 from app import config
 from app.config import DB_URL
@@ -15,3 +17,11 @@ if not DB_URL:
 
 db_client = mongox.Client(DB_URL)
 db = db_client.get_database("purpleauth_db")
+
+
+def raw_collection(model: Type[mongox.Model]) -> AsyncIOMotorCollection:
+    """
+    Get the motor collection behind a model, for operations mongox doesn't expose,
+    like targeted updates.
+    """
+    return model.Meta.collection._collection
@@ -1,17 +1,16 @@
-import datetime
 from typing import Union
 
 import mongox
 from fastapi import HTTPException, Depends, Header
 
-from app import config
-from app.io import email as io_email
+from app.database import raw_collection
 from app.models.client_app_model import ClientApp
+from app.services import client_app_cache, notifications, quota
 
 
 async def check_client_app(app_id: str):
     try:
-        return await ClientApp.query(ClientApp.app_id == app_id).get()
+        return await client_app_cache.get_client_app(app_id)
     except (mongox.NoMatchFound, mongox.MultipleMatchesFound):
         raise HTTPException(status_code=404, detail="Could not find app.")
 
@@ -25,8 +24,14 @@ async def check_client_app_authorized(
     bearer, api_key = authorization.split()
     if bearer != "Bearer" or not api_key:
         raise HTTPException(status_code=401)
-    if not client_app.verify_api_key(api_key):
+    valid, new_hash = client_app.verify_and_update_api_key(api_key)
+    if not valid:
         raise HTTPException(status_code=401)
+    if new_hash:
+        await raw_collection(ClientApp).update_one(
+            {"app_id": client_app.app_id}, {"$set": {"hashed_api_key": new_hash}}
+        )
+        await client_app_cache.invalidate(client_app.app_id)
     return client_app
 
 
@@ -35,46 +40,22 @@ async def client_app_use_quota(
 ):
     if client_app.unlimited:
         return client_app
-    if client_app.quota < 1:
-        await io_email.send(
-            to=client_app.owner,
-            subject=f"{client_app.name} is out of Authentications",
-            text=f"{client_app.name} has reached its quota of authentications. No "
-            f"further authentications will be processed. Please reply to this "
-            f"email to purchase more.\nRick Henry\nRick Henry Development\n"
-            f"https://rickhenry.dev",
-            from_name="Purple Authentication",
-            reply_to=config.WEBMASTER_EMAIL,
-        )
+    remaining = await quota.use_quota(client_app.app_id)
+    if remaining is None:
+        notifications.notify_out_of_quota(client_app)
         raise HTTPException(
             status_code=503,
             detail="This app does not have any authentications remaining. "
             "Please contact your administrator",
         )
-    client_app.quota -= 1
-    if client_app.quota < client_app.low_quota_threshold:
-        time_since_last_notification = (
-            datetime.datetime.now() - client_app.low_quota_last_notified
-        )
-        if time_since_last_notification >= datetime.timedelta(days=1):
-            await io_email.send(
-                to=client_app.owner,
-                subject=f"{client_app.name} is almost out of Authentications",
-                text=f"{client_app.name} has almost reached its quota of "
-                f"authentications. It will process {client_app.quota} more "
-                f"authentications before it stops authenticating users. "
-                f"Please reply to this email to purchase more.\nRick Henry"
-                f"\nRick Henry Development\nhttps://rickhenry.dev",
-                from_name="Purple Authentication",
-                reply_to=config.WEBMASTER_EMAIL,
-            )
-
-    await client_app.save()
+    client_app.quota = remaining
+    if remaining < client_app.low_quota_threshold:
+        notifications.notify_low_quota(client_app, remaining)
     return client_app
 
 
 async def check_refresh_client_app(client_app: ClientApp = Depends(check_client_app)):
-    if not client_app.get_refresh_key():
+    if not client_app.refresh_enabled:
         raise HTTPException(
             status_code=403, detail="Refreshing isn't supported on this app"
         )
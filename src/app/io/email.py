@@ -1,27 +1,520 @@
-import aiohttp
+import abc
+import asyncio
+import contextlib
+import json
 import logging
+from email.message import EmailMessage
+from email.utils import formataddr
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+import aiohttp
+import aiosmtplib
 
 from app import config
 
+# The most recipients mailgun accepts in one batch message.
+MAILGUN_BATCH_LIMIT = 1000
+
+# Statuses worth trying again, anything else is our fault and won't get better.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 
 class EmailError(Exception):
     pass
 
 
-async def send(to: str, subject: str, text: str, from_name: str, reply_to: str = None):
-    send_data = {
-        "from": f"{from_name} <{config.FROM_ADDRESS}>",
-        "to": to,
-        "subject": subject,
-        "text": text,
-    }
-    if reply_to:
-        send_data["h:Reply-To"] = reply_to
-    async with aiohttp.ClientSession() as session:
-        res = await session.post(
-            config.MAILGUN_ENDPOINT,
-            auth=aiohttp.BasicAuth("api", config.MAILGUN_KEY),
-            data=send_data,
+class EmailRejected(EmailError):
+    """The provider refused the message, sending it again as it is won't help."""
+
+
+class Transport(abc.ABC):
+    """
+    A way of delivering email. Transports hold on to their connections between
+    messages, so they are made once per process by get_transport and must be
+    shut down when it finishes.
+    """
+
+    # The most recipients send_batch can send in one go, if limited. Transports
+    # that send a message for each recipient anyway leave it at 1, so the Batcher
+    # sends each on its own and one failure can't fail the others.
+    batch_limit: Optional[int] = 1
+
+    async def startup(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @abc.abstractmethod
+    async def send(
+        self, to: str, subject: str, text: str, from_name: str, reply_to: str = None
+    ):
+        """
+        :raises EmailRejected: if the provider refused the message
+        :raises EmailError: if the message couldn't be sent and might be later
+        """
+
+    async def send_batch(
+        self,
+        to: Dict[str, dict],
+        subject: str,
+        text: str,
+        from_name: str,
+        reply_to: str = None,
+    ):
+        """
+        Send one message to many recipients. Each recipient only sees their own
+        address, and %recipient.name% in the subject or text is replaced with
+        their value for name. Transports without batch sending render and send a
+        message for each recipient, trying all of them even if some fail.
+
+        :param to: the variables for each recipient, by address
+        :raises EmailError: if any of the messages couldn't be sent
+        """
+        results = await asyncio.gather(
+            *(
+                self.send(
+                    address,
+                    render(subject, variables),
+                    render(text, variables),
+                    from_name,
+                    reply_to,
+                )
+                for address, variables in to.items()
+            ),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+
+class MailgunTransport(Transport):
+    batch_limit = MAILGUN_BATCH_LIMIT
+
+    def __init__(self):
+        # One session for the life of the worker, so connections (and their TLS
+        # sessions) to mailgun are kept alive and reused instead of set up for
+        # every email.
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """
+        Get the shared session, creating it if startup hasn't yet. A session
+        belongs to the event loop it was made on, so scripts and tests running
+        several loops get a new one for each.
+        """
+        loop = asyncio.get_running_loop()
+        if (
+            self._session is None
+            or self._session.closed
+            or self._session_loop is not loop
+        ):
+            self._drop_session()
+            connector = aiohttp.TCPConnector(
+                limit=config.EMAIL_MAX_CONNECTIONS,
+                keepalive_timeout=config.EMAIL_KEEPALIVE_TIMEOUT,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=config.EMAIL_TIMEOUT, connect=config.EMAIL_CONNECT_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._session_loop = loop
+        return self._session
+
+    def _drop_session(self):
+        """
+        Let go of a session made on another event loop. Its connections can only
+        be closed on that loop, so it is closed there if the loop is still running.
+        Otherwise it is detached from its connector, which goes with the loop it
+        belonged to, instead of being left to warn that it was never closed.
+        """
+        session, loop = self._session, self._session_loop
+        self._session = None
+        if session is None or session.closed:
+            return
+        if loop.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+        else:
+            session.detach()
+
+    async def startup(self):
+        self.get_session()
+
+    async def shutdown(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def send(
+        self, to: str, subject: str, text: str, from_name: str, reply_to: str = None
+    ):
+        send_data = {
+            "from": f"{from_name} <{config.FROM_ADDRESS}>",
+            "to": to,
+            "subject": subject,
+            "text": text,
+        }
+        if reply_to:
+            send_data["h:Reply-To"] = reply_to
+        await self._post(send_data)
+
+    async def send_batch(
+        self,
+        to: Dict[str, dict],
+        subject: str,
+        text: str,
+        from_name: str,
+        reply_to: str = None,
+    ):
+        """
+        Send one message to many recipients in as few requests as mailgun allows,
+        leaving mailgun to fill in each recipient's variables. Mailgun rejects a
+        whole batch if any address in it is bad.
+
+        :param to: the variables for each recipient, by address
+        :raises EmailRejected: if mailgun refused one of the batches
+        """
+        recipients = list(to.items())
+        for start in range(0, len(recipients), MAILGUN_BATCH_LIMIT):
+            batch = dict(recipients[start : start + MAILGUN_BATCH_LIMIT])
+            send_data = [
+                ("from", f"{from_name} <{config.FROM_ADDRESS}>"),
+                ("subject", subject),
+                ("text", text),
+                ("recipient-variables", json.dumps(batch)),
+            ]
+            send_data.extend(("to", address) for address in batch)
+            if reply_to:
+                send_data.append(("h:Reply-To", reply_to))
+            await self._post(send_data)
+
+    async def _post(self, send_data: Union[dict, list]):
+        """
+        Post a message to mailgun, retrying with exponential backoff when it fails
+        in a way that might not happen again.
+
+        :param send_data: the form data of the message
+        :raises EmailRejected: if mailgun refused the message
+        :raises EmailError: if it still couldn't be sent after the configured retries
+        """
+        for attempt in range(config.EMAIL_RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(config.EMAIL_RETRY_BACKOFF * 2 ** (attempt - 1))
+            try:
+                async with self.get_session().post(
+                    config.MAILGUN_ENDPOINT,
+                    auth=aiohttp.BasicAuth("api", config.MAILGUN_KEY),
+                    data=send_data,
+                ) as res:
+                    if res.status == 200:
+                        return
+                    error = await res.text()
+                    if res.status not in RETRY_STATUSES:
+                        raise EmailRejected(f"Mailgun rejected the email: {error}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                error = str(err) or type(err).__name__
+            logging.warning(f"Email attempt {attempt + 1} failed: {error}")
+        raise EmailError(f"Something went wrong: {error}")
+
+
+class SMTPTransport(Transport):
+    """
+    Sends through an SMTP server, keeping a pool of connections that have already
+    said EHLO, started TLS and logged in, so each message only costs its own
+    MAIL, RCPT and DATA commands. aiosmtplib doesn't pipeline those, so each
+    connection sends one message at a time and the pool size is how many go out
+    at once.
+    """
+
+    def __init__(
+        self,
+        host: str = None,
+        port: int = None,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        tls: str = None,
+        pool_size: int = None,
+    ):
+        """
+        Arguments left out are taken from the SMTP_ settings.
+
+        :param tls: "starttls" to upgrade after connecting, "tls" to connect over
+            TLS, or "none" for a plain connection
+        :param pool_size: the most connections to have open at once
+        """
+        self.host = host or config.SMTP_HOST
+        self.port = port or config.SMTP_PORT
+        self.username = username if username is not None else config.SMTP_USERNAME
+        self.password = password if password is not None else config.SMTP_PASSWORD
+        self.tls = (tls or config.SMTP_TLS).lower()
+        self.pool_size = pool_size or config.SMTP_POOL_SIZE
+        self._idle: List[aiosmtplib.SMTP] = []
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        # Like mailgun's session, connections belong to the loop they were made on.
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._loop is not loop:
+            self._idle = []
+            self._slots = asyncio.Semaphore(self.pool_size)
+            self._loop = loop
+        return self._slots
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        connection = aiosmtplib.SMTP(
+            hostname=self.host,
+            port=self.port,
+            username=self.username,
+            password=self.password,
+            use_tls=self.tls == "tls",
+            start_tls=self.tls == "starttls",
+            timeout=config.EMAIL_TIMEOUT,
         )
-        if res.status != 200:
-            logging.getLogger().error(f"Could not send email: {await res.text()}")
+        try:
+            await connection.connect()
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        """
+        Borrow a connection from the pool, opening one if none are idle. It goes
+        back to the pool afterwards unless sending through it failed.
+        """
+        async with self._get_slots():
+            connection = None
+            while self._idle and connection is None:
+                connection = self._idle.pop()
+                if not connection.is_connected:
+                    connection = None
+            if connection is None:
+                connection = await self._connect()
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            self._idle.append(connection)
+
+    async def startup(self):
+        self._get_slots()
+
+    async def shutdown(self):
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            with contextlib.suppress(aiosmtplib.SMTPException, OSError):
+                await connection.quit()
+
+    async def send(
+        self, to: str, subject: str, text: str, from_name: str, reply_to: str = None
+    ):
+        message = EmailMessage()
+        message["From"] = formataddr((from_name, config.FROM_ADDRESS))
+        message["To"] = to
+        message["Subject"] = subject
+        if reply_to:
+            message["Reply-To"] = reply_to
+        message.set_content(text)
+        # An idle connection may have been closed by the server since it was last
+        # used, which only shows when sending through it, so try once more on a
+        # fresh one before giving up.
+        for attempt in range(2):
+            try:
+                async with self.connection() as connection:
+                    await connection.send_message(message)
+                return
+            except aiosmtplib.SMTPAuthenticationError as err:
+                raise EmailError(f"Could not log in to SMTP server: {err}") from err
+            except aiosmtplib.SMTPRecipientsRefused as err:
+                raise EmailRejected(f"SMTP server refused the email: {err}") from err
+            except aiosmtplib.SMTPResponseException as err:
+                if err.code >= 500:
+                    raise EmailRejected(
+                        f"SMTP server rejected the email: {err}"
+                    ) from err
+                error = str(err)
+            except (aiosmtplib.SMTPException, OSError) as err:
+                error = str(err) or type(err).__name__
+            logging.warning(f"Email attempt {attempt + 1} failed: {error}")
+        raise EmailError(f"Something went wrong: {error}")
+
+
+TRANSPORTS = {"mailgun": MailgunTransport, "smtp": SMTPTransport}
+
+# The transports in use by this process, by name.
+_transports: Dict[str, Transport] = {}
+
+
+def get_transport(name: Optional[str] = None) -> Transport:
+    """
+    Get the shared transport with the given name, EMAIL_TRANSPORT if not given.
+
+    :raises EmailError: if there is no such transport
+    """
+    name = name or config.EMAIL_TRANSPORT
+    if name not in _transports:
+        if name not in TRANSPORTS:
+            raise EmailError(f"Unknown email transport: {name}")
+        _transports[name] = TRANSPORTS[name]()
+    return _transports[name]
+
+
+async def startup():
+    await get_transport().startup()
+
+
+async def shutdown():
+    transports = list(_transports.values())
+    _transports.clear()
+    for transport in transports:
+        await transport.shutdown()
+
+
+async def send(to: str, subject: str, text: str, from_name: str, reply_to: str = None):
+    await get_transport().send(to, subject, text, from_name, reply_to)
+
+
+def render(template: str, variables: Optional[dict]) -> str:
+    """Fill in %recipient.name% placeholders the way mailgun would."""
+    for name, value in (variables or {}).items():
+        template = template.replace(f"%recipient.{name}%", str(value))
+    return template
+
+
+async def send_batch(
+    to: Dict[str, dict], subject: str, text: str, from_name: str, reply_to: str = None
+):
+    """
+    Send one message to many recipients through the configured transport. See
+    Transport.send_batch.
+
+    :param to: the variables for each recipient, by address
+    """
+    await get_transport().send_batch(to, subject, text, from_name, reply_to)
+
+
+class Batcher:
+    """
+    Collects messages that share a template for a short window and sends each
+    group as one batch, so a burst of similar emails becomes a few requests.
+    """
+
+    def __init__(
+        self,
+        window: float = config.EMAIL_BATCH_WINDOW,
+        concurrency: Optional[int] = None,
+        transport: Optional[Transport] = None,
+    ):
+        """
+        :param window: seconds to wait for similar messages, 0 sends immediately
+        :param concurrency: how many requests to have in flight at once, if limited
+        :param transport: what to send with, the configured transport if not given
+        """
+        self.window = window
+        self.transport = transport
+        self._limit = asyncio.Semaphore(concurrency) if concurrency else None
+        self._groups: Dict[tuple, List[Tuple[str, dict, asyncio.Future]]] = {}
+        self._flushes: Set[asyncio.Task] = set()
+
+    async def send(
+        self,
+        to: str,
+        subject: str,
+        text: str,
+        from_name: str,
+        reply_to: str = None,
+        variables: Optional[dict] = None,
+    ):
+        """
+        Send a message once its group goes out. Takes the same arguments as send,
+        plus the variables for this recipient.
+
+        :raises EmailError: if the group couldn't be sent
+        """
+        if self.window <= 0:
+            async with self._limited():
+                return await self._transport().send(
+                    to,
+                    render(subject, variables),
+                    render(text, variables),
+                    from_name,
+                    reply_to,
+                )
+        key = (subject, text, from_name, reply_to)
+        future = asyncio.get_running_loop().create_future()
+        if key not in self._groups:
+            self._groups[key] = []
+            flush = asyncio.create_task(self._flush_later(key))
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+        self._groups[key].append((to, variables or {}, future))
+        return await future
+
+    def _limited(self):
+        return self._limit or contextlib.nullcontext()
+
+    def _transport(self) -> Transport:
+        return self.transport or get_transport()
+
+    async def _flush_later(self, key: tuple):
+        await asyncio.sleep(self.window)
+        group = self._groups.pop(key)
+        # The same address can only appear once in a batch, and each batch is sent
+        # in one go so a rejection can be pinned on its recipients.
+        limit = self._transport().batch_limit
+        batches: List[Dict[str, Tuple[dict, asyncio.Future]]] = [{}]
+        for to, variables, future in group:
+            if to in batches[-1] or len(batches[-1]) == limit:
+                batches.append({})
+            batches[-1][to] = (variables, future)
+        await asyncio.gather(*(self._send_group(key, batch) for batch in batches))
+
+    async def _send_group(
+        self, key: tuple, batch: Dict[str, Tuple[dict, asyncio.Future]]
+    ):
+        subject, text, from_name, reply_to = key
+        try:
+            async with self._limited():
+                if len(batch) == 1:
+                    ((to, (variables, _future)),) = batch.items()
+                    await self._transport().send(
+                        to,
+                        render(subject, variables),
+                        render(text, variables),
+                        from_name,
+                        reply_to,
+                    )
+                else:
+                    await self._transport().send_batch(
+                        {to: variables for to, (variables, _future) in batch.items()},
+                        subject,
+                        text,
+                        from_name,
+                        reply_to,
+                    )
+        except EmailRejected as err:
+            if len(batch) == 1:
+                self._fail(batch, err)
+                return
+            # One bad address gets the whole batch rejected, so send each message
+            # on its own and only fail the ones that are rejected again.
+            await asyncio.gather(
+                *(self._send_group(key, {to: entry}) for to, entry in batch.items())
+            )
+        except Exception as err:
+            self._fail(batch, err)
+        else:
+            for _variables, future in batch.values():
+                if not future.done():
+                    future.set_result(None)
+
+    @staticmethod
+    def _fail(batch: Dict[str, Tuple[dict, asyncio.Future]], err: Exception):
+        for _variables, future in batch.values():
+            if not future.done():
+                future.set_exception(err)
@@ -0,0 +1,38 @@
+import asyncio
+import random
+import uuid
+
+from aiohttp import web
+
+# A local stand-in for mailgun's messages endpoint, for tests and benchmarks. It
+# accepts any POST, can add latency and failures, and remembers what it was sent.
+# Point MAILGUN_ENDPOINT at it, e.g. http://localhost:8025/v3/mg.example.com/messages
+
+
+def create_app(latency: float = 0, failure_rate: float = 0) -> web.Application:
+    """
+    :param latency: seconds to wait before answering each request
+    :param failure_rate: fraction of requests to answer with a 503
+    :return: the stand-in application, its messages are in app["messages"]
+    """
+    app = web.Application()
+    app["messages"] = []
+    app["connections"] = set()
+
+    async def messages(request: web.Request) -> web.Response:
+        app["connections"].add(request.transport.get_extra_info("peername"))
+        if latency:
+            await asyncio.sleep(latency)
+        if random.random() < failure_rate:
+            return web.Response(status=503, text="Service Unavailable")
+        app["messages"].append(dict(await request.post()))
+        return web.json_response(
+            {"id": f"<{uuid.uuid4()}@standin>", "message": "Queued. Thank you."}
+        )
+
+    app.router.add_post("/{path:.*}", messages)
+    return app
+
+
+def run(host: str, port: int, latency: float = 0, failure_rate: float = 0):
+    web.run_app(create_app(latency, failure_rate), host=host, port=port)
@@ -1,19 +1,80 @@
-from redis import Redis
+from datetime import timedelta
+from typing import Optional, Union
+
+from redis import asyncio as aioredis
+
 from app import config
 
+# Every store shares one pool. The blocking pool makes callers wait for a free
+# connection instead of failing once REDIS_MAX_CONNECTIONS are in use.
 if config.REDIS_URL:
-    OTP_STORE = Redis.from_url(f"{config.REDIS_URL}/0")
-    MAGIC_STORE = Redis.from_url(f"{config.REDIS_URL}/1")
-else:
-    OTP_STORE = Redis(
-        host=config.REDIS_HOST,
-        port=config.REDIS_PORT,
-        db=0,
-        password=config.REDIS_PASSWORD,
+    POOL = aioredis.BlockingConnectionPool.from_url(
+        config.REDIS_URL,
+        max_connections=config.REDIS_MAX_CONNECTIONS,
+        timeout=config.REDIS_POOL_TIMEOUT,
     )
-    MAGIC_STORE = Redis(
+else:
+    POOL = aioredis.BlockingConnectionPool(
         host=config.REDIS_HOST,
         port=config.REDIS_PORT,
-        db=1,
         password=config.REDIS_PASSWORD,
+        max_connections=config.REDIS_MAX_CONNECTIONS,
+        timeout=config.REDIS_POOL_TIMEOUT,
     )
+
+REDIS = aioredis.Redis(connection_pool=POOL)
+
+# Deletes a key only if it still holds the expected value, so only one of several
+# concurrent callers can consume it.
+_DELETE_IF_EQUAL = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+_delete_if_equal = REDIS.register_script(_DELETE_IF_EQUAL)
+
+
+class Namespace:
+    """
+    A view of the shared redis client that prefixes every key, so separate stores
+    can share one database without their keys colliding.
+    """
+
+    def __init__(self, name: str):
+        self.prefix = f"{config.REDIS_KEY_PREFIX}:{name}:"
+
+    def key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await REDIS.get(self.key(key))
+
+    async def set(self, key: str, value: Union[str, bytes], **kwargs) -> bool:
+        return await REDIS.set(self.key(key), value, **kwargs)
+
+    async def expire(self, key: str, time: Union[int, timedelta]) -> bool:
+        return await REDIS.expire(self.key(key), time)
+
+    async def delete(self, *keys: str) -> int:
+        return await REDIS.delete(*(self.key(key) for key in keys))
+
+    async def delete_if_equal(self, key: str, value: Union[str, bytes]) -> bool:
+        """
+        Atomically delete a key if it holds the given value.
+
+        :param key: the key to consume
+        :param value: the value it must still hold
+        :return: True if this call deleted it, False if it was missing, held
+        something else or was consumed first by someone else
+        """
+        return bool(await _delete_if_equal(keys=[self.key(key)], args=[value]))
+
+
+OTP_STORE = Namespace("otp")
+MAGIC_STORE = Namespace("magic")
+
+
+async def close():
+    await REDIS.close()
+    await POOL.disconnect()
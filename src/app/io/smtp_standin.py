@@ -0,0 +1,138 @@
+import asyncio
+import base64
+from typing import Iterable, List, Optional, Set, Tuple
+
+# A local stand-in for an SMTP server, for tests and benchmarks, like
+# mailgun_standin is for mailgun. It speaks just enough ESMTP for aiosmtplib
+# (EHLO, AUTH PLAIN, MAIL, RCPT, DATA, RSET, NOOP and QUIT), never offers TLS and
+# remembers what it was sent. Run it with EMAIL_TRANSPORT=smtp, SMTP_TLS=none and
+# SMTP_HOST/SMTP_PORT pointing at it.
+
+
+class SMTPStandin:
+    def __init__(
+        self,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        latency: float = 0,
+        refused: Iterable[str] = (),
+    ):
+        """
+        :param username: the login to require, anyone can send if not given
+        :param latency: seconds to wait before accepting each message
+        :param refused: addresses to refuse as unknown
+        """
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.refused = set(refused)
+        # (sender, recipients, data) for each message accepted.
+        self.messages: List[Tuple[str, List[str], bytes]] = []
+        self.connections: Set[Tuple[str, int]] = set()
+        self.logins = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> asyncio.Server:
+        """
+        :param port: where to listen, 0 picks a free port
+        :return: the running server, its port is in server.sockets[0]
+        """
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections.add(writer.get_extra_info("peername"))
+        authenticated = self.username is None
+        sender, recipients = None, []
+
+        async def reply(line: str):
+            writer.write(f"{line}\r\n".encode("utf-8"))
+            await writer.drain()
+
+        await reply("220 standin ESMTP")
+        try:
+            while line := await reader.readline():
+                command, _, argument = line.decode("utf-8").strip().partition(" ")
+                command = command.upper()
+                if command in ("EHLO", "HELO"):
+                    await reply("250-standin\r\n250 AUTH PLAIN")
+                elif command == "AUTH":
+                    authenticated = self._login(argument)
+                    if authenticated:
+                        self.logins += 1
+                        await reply("235 2.7.0 Authentication successful")
+                    else:
+                        await reply("535 5.7.8 Authentication credentials invalid")
+                elif command == "NOOP":
+                    await reply("250 OK")
+                elif command == "RSET":
+                    sender, recipients = None, []
+                    await reply("250 OK")
+                elif command == "QUIT":
+                    await reply("221 Bye")
+                    break
+                elif not authenticated:
+                    await reply("530 5.7.0 Authentication required")
+                elif command == "MAIL":
+                    sender, recipients = _address(argument), []
+                    await reply("250 OK")
+                elif command == "RCPT":
+                    recipient = _address(argument)
+                    if recipient in self.refused:
+                        await reply("550 5.1.1 No such user")
+                    else:
+                        recipients.append(recipient)
+                        await reply("250 OK")
+                elif command == "DATA":
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    data = await self._read_data(reader)
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    self.messages.append((sender, recipients, data))
+                    sender, recipients = None, []
+                    await reply("250 OK: queued")
+                else:
+                    await reply("502 Command not implemented")
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _login(self, argument: str) -> bool:
+        mechanism, _, credentials = argument.partition(" ")
+        if mechanism.upper() != "PLAIN":
+            return False
+        try:
+            _identity, username, password = (
+                base64.b64decode(credentials).decode("utf-8").split("\0")
+            )
+        except ValueError:
+            return False
+        return username == self.username and password == self.password
+
+    @staticmethod
+    async def _read_data(reader: asyncio.StreamReader) -> bytes:
+        lines = []
+        while (line := await reader.readline()) not in (b".\r\n", b""):
+            # Lines starting with a dot have another one added by the client.
+            lines.append(line[1:] if line.startswith(b"..") else line)
+        return b"".join(lines)
+
+
+def _address(argument: str) -> str:
+    """Get the address out of e.g. FROM:<me@example.com> SIZE=100"""
+    _, _, rest = argument.partition(":")
+    return rest.strip().split(" ")[0].strip("<>")
+
+
+def run(
+    host: str,
+    port: int,
+    username: Optional[str] = None,
+    password: Optional[str] = None,
+    latency: float = 0,
+):
+    async def serve():
+        server = await SMTPStandin(username, password, latency).start(host, port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
@@ -12,12 +12,21 @@ from app.models.token_models import RefreshToken
 from app.portal.routes.api import portal_api_router
 from app.portal.routes.auth import portal_auth_router
 from app.portal.routes.views import portal_router
+from app.io import email as io_email, redis_interface
 from app.routes.client_app import client_app_router
 from app.routes.magic import magic_router
 from app.routes.otp import otp_router
 from app.routes.token import token_router
 from app.portal.crud import user_crud
 from app.portal.services.ensure_portal_app import ensure_portal_app
+from app.security import hashing
+from app.services import (
+    client_app_cache,
+    indexes,
+    notifications,
+    redis_quota,
+    revocation,
+)
 
 app = FastAPI(title="Purple Auth Service", version=config.VERSION)
 
@@ -34,7 +43,79 @@ logging.basicConfig(
 @app.on_event("startup")
 async def prepare_db():
     await ClientApp.create_indexes()
-    await RefreshToken.create_indexes()
+    # Refresh token indexes can take a while to build on a big collection. They
+    # aren't used when refresh tokens are kept somewhere else.
+    if config.REFRESH_TOKEN_STORE == "mongo":
+        indexes.start_builder(RefreshToken)
+
+
+@app.on_event("shutdown")
+async def stop_index_builder():
+    await indexes.stop_builder()
+
+
+@app.on_event("startup")
+async def start_cache_listeners():
+    client_app_cache.start_listener()
+
+
+@app.on_event("shutdown")
+async def stop_cache_listeners():
+    await client_app_cache.stop_listener()
+
+
+@app.on_event("startup")
+async def start_revocation_listener():
+    if config.REFRESH_STATELESS:
+        revocation.start_listener()
+
+
+@app.on_event("shutdown")
+async def stop_revocation_listener():
+    await revocation.stop_listener()
+
+
+@app.on_event("startup")
+async def open_email_session():
+    await io_email.startup()
+
+
+@app.on_event("startup")
+async def start_quota_flusher():
+    if config.QUOTA_ENGINE == "redis":
+        await redis_quota.start_flusher()
+
+
+@app.on_event("shutdown")
+async def stop_quota_flusher():
+    await redis_quota.stop_flusher()
+
+
+@app.on_event("shutdown")
+async def finish_notifications():
+    await notifications.drain()
+
+
+@app.on_event("shutdown")
+async def close_email_session():
+    await io_email.shutdown()
+
+
+@app.on_event("startup")
+async def start_hashing_reporter():
+    if config.HASH_METRICS_SECONDS > 0:
+        hashing.start_reporter()
+
+
+@app.on_event("shutdown")
+async def stop_hashing_pool():
+    await hashing.stop_reporter()
+    hashing.shutdown()
+
+
+@app.on_event("shutdown")
+async def close_redis():
+    await redis_interface.close()
 
 
 if PORTAL_ENABLED:
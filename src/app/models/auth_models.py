@@ -1,4 +1,6 @@
-from pydantic import BaseModel, EmailStr, Field as PyField
+from pydantic import BaseModel, EmailStr, Field as PyField, conlist
+
+from app import config
 
 
 class AuthRequest(BaseModel):
@@ -14,5 +16,11 @@ class VerifyToken(BaseModel):
     idToken: str = PyField(..., title="ID Token")
 
 
+class VerifyTokens(BaseModel):
+    idTokens: conlist(str, min_items=1, max_items=config.VERIFY_BATCH_LIMIT) = PyField(
+        ..., title="ID Tokens"
+    )
+
+
 class RequestRefresh(BaseModel):
     refreshToken: str = PyField(..., title="Refresh Token")
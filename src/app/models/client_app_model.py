@@ -1,14 +1,93 @@
 import datetime
-from typing import Optional
+import hashlib
+from typing import List, Optional, Tuple
 
 import mongox
 from jwcrypto import jwk
 from pydantic import BaseModel, EmailStr
 
 # noinspection PyAbstractClass
+from app import config
 from app.config import FERNET
-from app.database import db
-from app.security.context import PWD_CONTEXT
+from app.database import db, raw_collection
+from app.security.context import SECRET_CONTEXT
+from app.services.cache import TTLCache
+
+# Parsed keys, keyed by app id and a digest of the encrypted key. Changing a key
+# changes the digest, so stale entries are never hit and just age out.
+_KEY_CACHE = TTLCache(maxsize=config.KEY_CACHE_SIZE)
+
+
+def _load_key(app_id: str, enc_key: bytes) -> jwk.JWK:
+    cache_key = (app_id, hashlib.sha256(enc_key).digest())
+    key = _KEY_CACHE.get(cache_key)
+    if key is None:
+        key = jwk.JWK.from_pem(FERNET.decrypt(enc_key))
+        # The RFC 7638 thumbprint names the key in token headers and the jwks.
+        key["kid"] = key.thumbprint()
+        _KEY_CACHE.set(cache_key, key)
+    return key
+
+
+# Signing algorithms apps can choose from, and the keys that sign with each.
+ALGORITHMS = {
+    "ES256": {"kty": "EC", "crv": "P-256"},
+    "EdDSA": {"kty": "OKP", "crv": "Ed25519"},
+}
+
+
+def generate_key(algorithm: str = "ES256") -> jwk.JWK:
+    """
+    :param algorithm: one of ALGORITHMS
+    :raises ValueError: if the algorithm isn't supported
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Unsupported algorithm: {algorithm}")
+    return jwk.JWK.generate(**ALGORITHMS[algorithm])
+
+
+def key_algorithm(key: jwk.JWK) -> str:
+    """
+    The algorithm a key signs with. This goes by the key rather than the app's
+    setting, so keys made before the setting changed still verify.
+    """
+    for algorithm, params in ALGORITHMS.items():
+        if key.key_type == params["kty"]:
+            return algorithm
+    raise ValueError(f"Unsupported key type: {key.key_type}")
+
+
+class RetiredKey(BaseModel):
+    """A key that no longer signs tokens but still verifies them until it retires."""
+
+    enc_key: bytes
+    retires: datetime.datetime
+
+
+def _live_keys(retired_keys: List[RetiredKey]) -> List[RetiredKey]:
+    now = datetime.datetime.now()
+    return [retired for retired in retired_keys if retired.retires > now]
+
+
+def _find_key(
+    app_id: str,
+    enc_key: bytes,
+    retired_keys: List[RetiredKey],
+    kid: Optional[str],
+) -> Optional[jwk.JWK]:
+    key = _load_key(app_id, enc_key)
+    if kid is None or key.key_id == kid:
+        return key
+    for retired in _live_keys(retired_keys):
+        key = _load_key(app_id, retired.enc_key)
+        if key.key_id == kid:
+            return key
+    return None
+
+
+# Fields only ever changed in place by atomic updates as authentications are taken
+# and owners notified, never by saving a whole app.
+QUOTA_FIELDS = {"quota", "low_quota_last_notified"}
 
 
 # Consider moving quota information into a sub-document
@@ -61,34 +140,114 @@ class ClientApp(mongox.Model):
     hashed_api_key: str = mongox.Field(
         None, title="Hashed API Key to authorize using the app. Keep this secret."
     )
+    algorithm: str = mongox.Field(
+        "ES256",
+        title="Signing algorithm",
+        description="ES256 or EdDSA, used when new keys are generated for the app.",
+    )
+    rotate_refresh_tokens: bool = mongox.Field(
+        False,
+        title="Rotate refresh tokens",
+        description="If enabled, every refresh returns a new refresh token and the "
+        "old one stops working. Reusing an old one logs that session out.",
+    )
+    previous_keys: List[RetiredKey] = mongox.Field(
+        [],
+        title="Previous signing keys",
+        description="Keys replaced by rotation, kept to verify the tokens they signed "
+        "until those have expired.",
+    )
+    previous_refresh_keys: List[RetiredKey] = mongox.Field(
+        [],
+        title="Previous refresh keys",
+        description="Refresh keys replaced by rotation, kept until the refresh tokens "
+        "they signed have expired.",
+    )
 
     class Meta:
         collection = db.get_collection("client_apps")
         indexes = [mongox.Index("app_id", unique=True), mongox.Index("owner")]
 
-    def get_key(self) -> jwk.JWK:
-        pem = FERNET.decrypt(self.enc_key)
-        return jwk.JWK.from_pem(pem)
+    async def save_settings(self) -> "ClientApp":
+        """
+        Save the app without its QUOTA_FIELDS. save() writes back every field as it
+        was read, which would undo any authentications taken in the meantime.
+        """
+        await raw_collection(ClientApp).update_one(
+            {"app_id": self.app_id},
+            {"$set": self.dict(exclude={"id", "_id"} | QUOTA_FIELDS)},
+        )
+        return self
+
+    def get_key(self, kid: Optional[str] = None) -> Optional[jwk.JWK]:
+        """
+        :param kid: the id of the key to get, the current signing key if not given
+        :return: the key, or None if it isn't current or a previous key that hasn't
+        retired yet
+        """
+        return _find_key(self.app_id, self.enc_key, self.previous_keys, kid)
+
+    def get_verification_keys(self) -> List[jwk.JWK]:
+        """The current signing key followed by any previous keys not yet retired."""
+        return [
+            _load_key(self.app_id, enc_key)
+            for enc_key in [self.enc_key]
+            + [retired.enc_key for retired in _live_keys(self.previous_keys)]
+        ]
 
     def set_key(self, key: jwk.JWK):
         pem = key.export_to_pem(private_key=True, password=None)
         self.enc_key = FERNET.encrypt(pem)
 
-    def get_refresh_key(self):
+    def rotate_key(self, key: jwk.JWK, retires: datetime.datetime):
+        """
+        Sign with a new key, keeping the current one to verify tokens until retires.
+        """
+        if self.enc_key:
+            self.previous_keys = _live_keys(self.previous_keys) + [
+                RetiredKey(enc_key=self.enc_key, retires=retires)
+            ]
+        self.set_key(key)
+
+    def get_refresh_key(self, kid: Optional[str] = None) -> Optional[jwk.JWK]:
         if not self.enc_refresh_key:
             return None
-        pem = FERNET.decrypt(self.enc_refresh_key)
-        return jwk.JWK.from_pem(pem)
+        return _find_key(
+            self.app_id, self.enc_refresh_key, self.previous_refresh_keys, kid
+        )
 
     def set_refresh_key(self, key: jwk.JWK):
         pem = key.export_to_pem(private_key=True, password=None)
         self.enc_refresh_key = FERNET.encrypt(pem)
 
+    def rotate_refresh_key(self, key: jwk.JWK, retires: datetime.datetime):
+        if self.enc_refresh_key:
+            self.previous_refresh_keys = _live_keys(self.previous_refresh_keys) + [
+                RetiredKey(enc_key=self.enc_refresh_key, retires=retires)
+            ]
+        self.set_refresh_key(key)
+
     def set_api_key(self, api_key: str):
-        self.hashed_api_key = PWD_CONTEXT.hash(api_key)
+        self.hashed_api_key = SECRET_CONTEXT.hash(api_key)
 
     def verify_api_key(self, api_key: str) -> bool:
-        return PWD_CONTEXT.verify(api_key, self.hashed_api_key)
+        valid, _ = self.verify_and_update_api_key(api_key)
+        return valid
+
+    def verify_and_update_api_key(self, api_key: str) -> Tuple[bool, Optional[str]]:
+        """
+        Verify an api key, upgrading a legacy argon2 hash on this object if it
+        matches. The caller is responsible for saving the returned hash.
+
+        :param api_key: the api key to check
+        :return: whether it matched, and the new hash if the old one was upgraded
+        """
+        valid, new_hash = SECRET_CONTEXT.verify_and_update(
+            api_key, self.hashed_api_key
+        )
+        if new_hash:
+            self.hashed_api_key = new_hash
+        return valid, new_hash
 
     @property
     def refresh_enabled(self) -> bool:
@@ -100,9 +259,10 @@ class ClientApp(mongox.Model):
         if self.refresh_enabled == enabled:
             return
         if enabled:
-            self.set_refresh_key(jwk.JWK.generate(kty="EC", size=4096))
+            self.set_refresh_key(generate_key(self.algorithm))
         elif not enabled:
             self.enc_refresh_key = None
+            self.previous_refresh_keys = []
 
 
 class ClientAppPublic(BaseModel):
@@ -1,5 +1,5 @@
 import datetime
-from typing import Optional
+from typing import List, Optional
 
 import mongox
 from pydantic import EmailStr, BaseModel, Field as PyField
@@ -24,13 +24,31 @@ class RefreshToken(mongox.Model):
     hash: str
     expires: datetime.datetime
     uid: str
+    # With rotation, one record is a whole token family (all the tokens issued in
+    # turn for one login) and only the token of the current generation is valid.
+    generation: int = 0
 
     class Meta:
         collection = db.get_collection("refresh_tokens")
+        # Every lookup is by app plus uid (one token) or app plus email (logout
+        # everywhere), and app_id alone is covered by the prefix of either.
         indexes = [
-            mongox.Index("app_id"),
-            mongox.Index("email"),
-            mongox.Index("expires", expireAfterSeconds=0),
+            mongox.Index(
+                keys=[
+                    ("app_id", mongox.Order.ASCENDING),
+                    ("uid", mongox.Order.ASCENDING),
+                ],
+                unique=True,
+                background=True,
+            ),
+            mongox.Index(
+                keys=[
+                    ("app_id", mongox.Order.ASCENDING),
+                    ("email", mongox.Order.ASCENDING),
+                ],
+                background=True,
+            ),
+            mongox.Index("expires", expireAfterSeconds=0, background=True),
         ]
 
 
@@ -39,6 +57,17 @@ class VerifiedTokenResponse(BaseModel):
     claims: dict
 
 
+class VerifiedTokenResult(BaseModel):
+    valid: bool
+    headers: Optional[dict] = None
+    claims: Optional[dict] = None
+    error: Optional[str] = None
+
+
+class VerifiedTokensResponse(BaseModel):
+    results: List[VerifiedTokenResult]
+
+
 class IssueToken(BaseModel):
     idToken: str = PyField(..., title="ID Token")
     refreshToken: Optional[str] = PyField(
@@ -1,15 +1,17 @@
+import datetime
 import uuid
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
-import jwcrypto.jwk as jwk
 import mongox
 from fastapi import HTTPException
 from mongox import Q
 
-from app.models.client_app_model import ClientApp
-from app.models.token_models import RefreshToken
+from app import config
+from app.database import raw_collection
+from app.models.client_app_model import ClientApp, generate_key
 from app.portal.models.user_model import User
 from app.portal.services import deletion_protection
+from app.services import client_app_cache, quota, refresh_store, revocation
 
 
 async def create_client_app(
@@ -22,8 +24,10 @@ async def create_client_app(
     app_id: Optional[str] = None,
     refresh_token_expire_hours: int = 24,
     low_quota_threshold: int = 10,
+    algorithm: str = "ES256",
+    rotate_refresh_tokens: bool = False,
 ) -> ClientApp:
-    key = jwk.JWK.generate(kty="EC", size=2048)
+    key = generate_key(algorithm)
     app_id = app_id or str(uuid.uuid4())
     app = ClientApp(
         name=app_name,
@@ -35,14 +39,18 @@ async def create_client_app(
         redirect_url=redirect_url,
         low_quota_threshold=low_quota_threshold,
         failure_redirect_url=failure_redirect_url,
+        algorithm=algorithm,
+        rotate_refresh_tokens=rotate_refresh_tokens,
     )
     if refresh:
-        app.set_refresh_key(jwk.JWK.generate(kty="EC", size=4096))
+        app.set_refresh_key(generate_key(algorithm))
         app.refresh_token_expire_hours = refresh_token_expire_hours
 
     app.set_key(key)
     app.set_api_key(api_key)
     await app.insert()
+    # An app id can be reused, the portal app's always is.
+    await quota.forget_counter(app_id)
 
     return app
 
@@ -77,27 +85,67 @@ async def update_client_app(
     refresh_token_expire_hours,
     failure_redirect_url,
     low_quota_threshold,
+    rotate_refresh_tokens=False,
 ) -> ClientApp:
     app = await get_client_app(app_id, user)
+    if app.rotate_refresh_tokens and not rotate_refresh_tokens:
+        # Tokens superseded by rotation are only caught by checking the store, which
+        # stateless verification skips for apps that don't rotate.
+        await revocation.revoke(
+            revocation.app_entry(app.app_id),
+            until=_refresh_tokens_expire(app.refresh_token_expire_hours),
+        )
 
     app.name = app_name
     app.redirect_url = redirect_url
     app.failure_redirect_url = failure_redirect_url
     app.change_refresh(refresh_enabled)
     app.refresh_token_expire_hours = refresh_token_expire_hours
+    app.rotate_refresh_tokens = rotate_refresh_tokens
     app.low_quota_threshold = low_quota_threshold
 
-    await app.save()
+    await app.save_settings()
+    await client_app_cache.invalidate(app.app_id)
 
     return app
 
 
-async def delete_user_apps(user: User) -> None:
-    """Delete all of a user's apps and all refresh tokens from those apps."""
-    user_apps = await ClientApp.query(ClientApp.owner == user.email).all()
-    for app in user_apps:
-        await RefreshToken.query(RefreshToken.app_id == app.app_id).delete()
-        await app.delete()
+def _refresh_tokens_expire(
+    refresh_token_expire_hours: Optional[int],
+) -> datetime.datetime:
+    """
+    When every refresh token the app issues with this lifetime will have expired.
+    Tokens issued before the lifetime was lowered outlive this, but are always
+    checked against the store, see security.token.verify_refresh_token.
+    """
+    return datetime.datetime.now() + datetime.timedelta(
+        hours=refresh_token_expire_hours or 0
+    )
+
+
+async def delete_user_apps(user: User) -> Tuple[int, int]:
+    """
+    Delete all of a user's apps and all refresh tokens from those apps, with one
+    delete for the tokens and one for the apps, however many apps there are.
+
+    :return: how many apps and how many refresh tokens were deleted
+    """
+    apps = await raw_collection(ClientApp).find(
+        {"owner": user.email},
+        projection={"_id": False, "app_id": True, "refresh_token_expire_hours": True},
+    ).to_list(None)
+    if not apps:
+        return 0, 0
+    app_ids = [app["app_id"] for app in apps]
+    longest = max(app.get("refresh_token_expire_hours") or 0 for app in apps)
+    await revocation.revoke(
+        *(revocation.app_entry(app_id) for app_id in app_ids),
+        until=_refresh_tokens_expire(longest),
+    )
+    tokens_deleted = await refresh_store.get_store().delete_apps(*app_ids)
+    apps_deleted = await ClientApp.query(Q.in_(ClientApp.app_id, app_ids)).delete()
+    await client_app_cache.invalidate(*app_ids)
+    return apps_deleted, tokens_deleted
 
 
 async def delete_app(app_id: str, user: User) -> str:
@@ -108,27 +156,57 @@ async def delete_app(app_id: str, user: User) -> str:
             detail="You need to turn off deletion protection to delete this app.",
         )
     name = app.name[:]
-    await RefreshToken.query(RefreshToken.app_id == app.app_id).delete()
+    await revocation.revoke(
+        revocation.app_entry(app.app_id),
+        until=_refresh_tokens_expire(app.refresh_token_expire_hours),
+    )
+    await refresh_store.get_store().delete_apps(app.app_id)
     await app.delete()
+    await client_app_cache.invalidate(app.app_id)
     return name
 
 
-async def rotate_app_keys(app_id: str, user: User) -> ClientApp:
+async def rotate_app_keys(app_id: str, user: User, revoke: bool = False) -> ClientApp:
     """
-    Replace an app's keys with newly generated ones. This will invalidate all current
-    id tokens and refresh tokens. It will also delete all the (now-invalid) refresh
-    tokens from the database.
+    Replace an app's keys with newly generated ones. The old keys keep verifying the
+    tokens they signed until those would have expired, so users stay logged in and
+    verifiers can pick up the new key when they first see its kid. Revoking drops the
+    old keys at once instead, invalidating all current id tokens and refresh tokens,
+    and deletes the (now-invalid) refresh tokens from the database.
 
     :param app_id:  The app's id
     :param user: The owner of the app. Other users cannot change an active app's keys.
+    :param revoke: Whether tokens signed with the old keys should stop working now.
     :return: updated app
     """
     app = await get_client_app(app_id, user)
-    app.set_key(jwk.JWK.generate(kty="EC", size=2048))
+    now = datetime.datetime.now()
+    if revoke:
+        app.previous_keys = []
+        app.previous_refresh_keys = []
+        app.set_key(generate_key(app.algorithm))
+    else:
+        app.rotate_key(
+            generate_key(app.algorithm),
+            now + datetime.timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES),
+        )
     if app.enc_refresh_key:
-        app.set_refresh_key(jwk.JWK.generate(kty="EC", size=4096))
-    await app.save()
-    await RefreshToken.query(RefreshToken.app_id == app.app_id).delete()
+        refresh_key = generate_key(app.algorithm)
+        if revoke:
+            app.set_refresh_key(refresh_key)
+        else:
+            app.rotate_refresh_key(
+                refresh_key,
+                now + datetime.timedelta(hours=app.refresh_token_expire_hours or 0),
+            )
+    await app.save_settings()
+    await client_app_cache.invalidate(app.app_id)
+    if revoke:
+        await revocation.revoke(
+            revocation.app_entry(app.app_id),
+            until=_refresh_tokens_expire(app.refresh_token_expire_hours),
+        )
+        await refresh_store.get_store().delete_apps(app.app_id)
 
     return app
 
@@ -145,10 +223,11 @@ async def disable_deletion_protection(
     :return: the updated app
     """
     app = await get_client_app(app_id, user)
-    if not deletion_protection.verify_dp_code(user, app.app_id, dp_code):
+    if not await deletion_protection.verify_dp_code(user, app.app_id, dp_code):
         raise HTTPException(400, detail="Invalid deletion protection code.")
     app.deletion_protection = False
-    await app.save()
+    await app.save_settings()
+    await client_app_cache.invalidate(app.app_id)
     return app
 
 
@@ -162,7 +241,8 @@ async def enable_deletion_protection(app_id: str, user: User) -> ClientApp:
     """
     app = await get_client_app(app_id, user)
     app.deletion_protection = True
-    await app.save()
+    await app.save_settings()
+    await client_app_cache.invalidate(app.app_id)
     return app
 
 
@@ -175,5 +255,6 @@ async def update_api_key(app: ClientApp, new_api_key) -> ClientApp:
     :return: the updated app
     """
     app.set_api_key(new_api_key)
-    await app.save()
+    await app.save_settings()
+    await client_app_cache.invalidate(app.app_id)
     return app
@@ -5,7 +5,7 @@ from fastapi import HTTPException
 
 from app.portal.crud import clientapp_crud
 from app.portal.models.user_model import User
-from app.portal.services import deletion_protection
+from app.portal.services import deletion_protection, user_cache
 
 
 async def get_user_by_email(email: str) -> Optional[User]:
@@ -38,11 +38,13 @@ async def delete_user(user: User) -> None:
         )
     await clientapp_crud.delete_user_apps(user)
     await user.delete()
+    user_cache.invalidate(user.email)
 
 
 async def update_user(user: User, name: str) -> User:
     user.name = name
     await user.save()
+    user_cache.invalidate(user.email)
     return user
 
 
@@ -54,8 +56,9 @@ async def disable_deletion_protection(user: User, dp_code: str) -> User:
     :param code:  the one time use code emailed to the user
     :return:      the user object
     """
-    if not deletion_protection.verify_dp_code(user, "account", dp_code):
+    if not await deletion_protection.verify_dp_code(user, "account", dp_code):
         raise HTTPException(status_code=400, detail="Invalid deletion protection code.")
     user.deletion_protection = False
     await user.save()
+    user_cache.invalidate(user.email)
     return user
@@ -5,6 +5,7 @@ from fastapi import APIRouter, Form, Depends, Response, Header, HTTPException
 from starlette.requests import Request
 
 from app import config
+from app.models.client_app_model import ALGORITHMS
 from app.portal.crud import clientapp_crud
 from app.portal.models.user_model import User
 from app.portal.services import htmx, deletion_protection
@@ -39,6 +40,8 @@ async def create_app(
     failure_redirect_url: str = Form(...),
     refresh: bool = Form(False),
     refresh_token_expire_hours: int = Form(24),
+    rotate_refresh_tokens: bool = Form(False),
+    algorithm: str = Form("ES256"),
     user: User = Depends(get_current_active_user),
 ):
     """
@@ -52,9 +55,13 @@ async def create_app(
     authentication attempt.
     :param refresh: Whether to enable refresh on the app
     :param refresh_token_expire_hours: How long refresh tokens are valid for.
+    :param rotate_refresh_tokens: Whether each refresh replaces the refresh token.
+    :param algorithm: The algorithm to sign tokens with, ES256 or EdDSA.
     :param user: The user creating the app. This route requires authentication.
     :return: HTML for the app in the list and events to display the full app.
     """
+    if algorithm not in ALGORITHMS:
+        raise HTTPException(status_code=400, detail="Invalid signing algorithm")
     api_key = secrets.token_urlsafe()
     new_app = await clientapp_crud.create_client_app(
         app_name=app_name,
@@ -64,6 +71,8 @@ async def create_app(
         refresh_token_expire_hours=refresh_token_expire_hours,
         failure_redirect_url=failure_redirect_url,
         api_key=api_key,
+        algorithm=algorithm,
+        rotate_refresh_tokens=rotate_refresh_tokens,
     )
     vm = SingleAppVM(request, new_app)
     res = templates.TemplateResponse(
@@ -126,6 +135,7 @@ async def update_app(
     failure_redirect_url: str = Form(...),
     refresh_enabled: bool = Form(...),
     refresh_token_expire_hours: int = Form(24),
+    rotate_refresh_tokens: bool = Form(False),
     low_quota_threshold: int = Form(10),
     user: User = Depends(get_current_active_user),
 ):
@@ -139,6 +149,7 @@ async def update_app(
     :param failure_redirect_url:  updated failure redirect url (see create_app)
     :param refresh_enabled: whether to enable refresh on the app
     :param refresh_token_expire_hours: how long refresh tokens are valid for.
+    :param rotate_refresh_tokens: whether each refresh replaces the refresh token.
     :param low_quota_threshold: how many authentications should be left before the
     app owner is notified that they are running out
     :param user: the owner of the app. This route requires authentication.
@@ -153,6 +164,7 @@ async def update_app(
         refresh_token_expire_hours,
         failure_redirect_url,
         low_quota_threshold,
+        rotate_refresh_tokens,
     )
     vm = SingleAppVM(request, updated_app)
     res = templates.TemplateResponse(
@@ -194,23 +206,38 @@ async def rotate_app_keys_form(
 
 
 @portal_api_router.post("/apps/{app_id}/rotate-keys")
-async def rotate_app_keys(app_id: str, user: User = Depends(get_current_active_user)):
+async def rotate_app_keys(
+    app_id: str,
+    user: User = Depends(get_current_active_user),
+    revoke: bool = Form(False),
+):
     """
     Rotate app encryption keys.
     :param app_id: the app to rotate keys for
     :param user: the owner of the app. This route requires authentication.
+    :param revoke: whether tokens signed with the old keys should stop working now
     :return: empty response with headers to close the modal and show a notification
     """
-    await clientapp_crud.rotate_app_keys(app_id, user)
+    await clientapp_crud.rotate_app_keys(app_id, user, revoke)
     res = Response(
         content="", status_code=200, headers={"HX-Trigger": '{"closeModal": "{}"}'}
     )
+    if revoke:
+        message = (
+            "Your app encryption keys have been changed. All users will need to "
+            "re-authenticate and you will need to download new public keys anywhere "
+            "they may have been cached"
+        )
+    else:
+        message = (
+            "Your app encryption keys have been changed. New tokens are signed with "
+            "the new keys, and tokens signed with the old ones keep working until "
+            "they expire."
+        )
     res.headers["HX-Trigger"] = htmx.make_show_notification_header(
         res.headers,
         "App Keys Changed",
-        "Your app encryption keys have been changed. All users will need to "
-        "re-authenticate and you will need to download new public keys anywhere they "
-        "may have been cached",
+        message,
         "success",
     )
     return res
@@ -343,7 +370,7 @@ async def get_disable_deletion_protection_code(
     """
     vm = SingleAppVM(request)
     await vm.get_app(app_id)
-    code = deletion_protection.generate_dp_code(user, vm.app.app_id)
+    code = await deletion_protection.generate_dp_code(user, vm.app.app_id)
     try:
         await io_email.send(
             to=user.email,
@@ -222,7 +222,7 @@ async def get_disable_deletion_protection_code(
     """
     vm = VMBase(request)
     await vm.check_for_user()
-    code = deletion_protection.generate_dp_code(user, "account")
+    code = await deletion_protection.generate_dp_code(user, "account")
     try:
         await io_email.send(
             to=user.email,
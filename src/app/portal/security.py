@@ -8,14 +8,17 @@ from fastapi.openapi.models import OAuthFlows
 from fastapi.security import OAuth2
 from starlette.requests import Request
 
-from app.config import HOST, PORTAL_API_KEY
 from app.portal.crud import user_crud
 from app.portal.models.user_model import User
+from app.portal.services import user_cache
+from app.portal.services.local_auth import LocalAuthClient
 
 # USE_WHITELIST = bool(os.getenv("USE_WHITELIST"))
 # WHITELIST_DOMAINS = os.getenv("WHITELIST_DOMAINS", "").lower().split(",")
 # WHITELIST = os.getenv("WHITELIST", "").lower().split(",")
-auth_client = pac.AuthClient(HOST, "0", PORTAL_API_KEY)
+# The portal is an app on this same server, so it verifies its users' tokens in
+# process instead of over HTTP.
+auth_client = LocalAuthClient("0")
 
 
 class ServiceAuthentication(OAuth2):
@@ -78,20 +81,31 @@ async def try_refresh(request: Request) -> Optional[str]:
     return None
 
 
-async def get_current_user(token: str = Security(oauth2_scheme)) -> User:
-    credential_exception = HTTPException(status_code=401, detail="Invalid Token")
-    try:
-        token_result = await auth_client.verify(token)
-    except pac.AuthenticationFailure as e:
-        if str(e) == "expired":
-            raise HTTPException(status_code=401, detail="Expired Token")
-        raise credential_exception
-    email = token_result["claims"].get("sub")
-    if not email:
-        raise credential_exception
-    user = await user_crud.get_user_by_email(email)
-    if not user:
-        user = await user_crud.create_user_from_email(email)
+async def get_current_user(
+    request: Request, token: str = Security(oauth2_scheme)
+) -> User:
+    """
+    Resolve the user an id token belongs to. The user is kept on the request, so
+    dependencies and view models asking again in the same request get it for free,
+    and briefly cached by token, so requests made together share the work.
+    """
+    if user := getattr(request.state, "user", None):
+        return user
+    user = user_cache.get_user(token)
+    if user is None:
+        credential_exception = HTTPException(status_code=401, detail="Invalid Token")
+        try:
+            token_result = await auth_client.verify(token)
+        except pac.AuthenticationFailure as e:
+            if str(e) == "expired":
+                raise HTTPException(status_code=401, detail="Expired Token")
+            raise credential_exception
+        email = token_result["claims"].get("sub")
+        if not email:
+            raise credential_exception
+        user = await user_crud.check_or_create_user_from_email(email)
+        user_cache.set_user(token, user, token_result["claims"].get("exp"))
+    request.state.user = user
     return user
 
 
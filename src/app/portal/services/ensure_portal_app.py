@@ -6,6 +6,7 @@ import mongox
 from app import config
 from app.models.client_app_model import ClientApp
 from app.portal.crud import clientapp_crud
+from app.services import client_app_cache
 
 
 async def ensure_portal_app():
@@ -28,6 +29,9 @@ async def ensure_portal_app():
         )
         logging.info(f"Portal App API Key: {api_key}")
     portal_app.unlimited = True
-    await portal_app.save()
+    # The portal keeps its refresh token in a cookie it never replaces.
+    portal_app.rotate_refresh_tokens = False
+    await portal_app.save_settings()
+    await client_app_cache.invalidate(portal_app.app_id)
 
     return portal_app
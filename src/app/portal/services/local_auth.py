@@ -0,0 +1,144 @@
+from typing import Dict, Optional
+
+import mongox
+import pydantic
+import purple_auth_client as pac
+from fastapi import HTTPException
+
+from app.models.auth_models import AuthRequest, ConfirmCode
+from app.models.client_app_model import ClientApp
+from app.routes import magic, otp
+from app.security import token as security_token
+from app.services import client_app_cache
+
+
+def _raise_for_status(status_code: int):
+    """Raise what purple_auth_client would have for an HTTP error response."""
+    if status_code == 404:
+        raise pac.AppNotFound
+    if status_code == 422:
+        raise pac.ValidationError
+    if status_code in (401, 403):
+        raise pac.AuthenticationFailure
+    raise pac.ServerError
+
+
+class LocalAuthClient:
+    """
+    Does what purple_auth_client.AuthClient does for the portal's own app, but in
+    this process, instead of making HTTP requests back to this same server. It has
+    the same interface and raises the same errors, so it can stand in for one.
+    """
+
+    def __init__(self, app_id: str):
+        self.app_id = app_id
+
+    async def _get_client_app(self) -> ClientApp:
+        try:
+            return await client_app_cache.get_client_app(self.app_id)
+        except (mongox.NoMatchFound, mongox.MultipleMatchesFound):
+            raise pac.AppNotFound
+
+    async def authenticate(self, email: str, flow: str = "otp") -> str:
+        """
+        Start the otp or magic link flow for an email address.
+
+        :raises InvalidAuthFlow: if flow isn't otp or magic.
+        :raises ValidationError: if the email address isn't valid.
+        """
+        if flow not in pac.ALLOWED_FLOWS:
+            raise pac.InvalidAuthFlow
+        try:
+            auth_request = AuthRequest(email=email)
+        except pydantic.ValidationError:
+            raise pac.ValidationError
+        # The portal app is unlimited, so there's no quota to take.
+        client_app = await self._get_client_app()
+        try:
+            if flow == "magic":
+                return await magic.request_magic(auth_request, client_app)
+            return await otp.request_otp(auth_request, client_app)
+        except HTTPException as err:
+            _raise_for_status(err.status_code)
+
+    async def submit_code(self, email: str, code: str) -> Dict[str, Optional[str]]:
+        """
+        :returns: the id_token and refresh_token, which is None if refresh is not
+        enabled
+        :raises AuthenticationFailure: if the email code combination doesn't
+        authenticate.
+        """
+        try:
+            confirm_code = ConfirmCode(email=email, code=code)
+        except pydantic.ValidationError:
+            raise pac.ValidationError
+        client_app = await self._get_client_app()
+        try:
+            tokens = await otp.confirm_otp(confirm_code, client_app)
+        except HTTPException as err:
+            _raise_for_status(err.status_code)
+        return {"id_token": tokens.idToken, "refresh_token": tokens.refreshToken}
+
+    async def verify(self, id_token: str) -> Dict[str, dict]:
+        """
+        :returns: Dict of headers and claims from the verified JWT
+        :raises AuthenticationFailure: If the token could not be verified, with
+        "expired" as its message if that's why.
+        """
+        if not id_token:
+            raise ValueError("ID Token is required")
+        client_app = await self._get_client_app()
+        try:
+            headers, claims = security_token.verify(id_token, client_app)
+        except security_token.TokenVerificationError as err:
+            raise pac.AuthenticationFailure(*err.args)
+        return {"headers": headers, "claims": claims}
+
+    async def refresh(self, refresh_token: str) -> str:
+        """
+        :returns: New ID Token
+        :raises AuthenticationFailure: If the token could not be verified
+        """
+        if not refresh_token:
+            raise ValueError("Refresh Token is Required")
+        client_app = await self._get_client_app()
+        if not client_app.refresh_enabled:
+            raise pac.AuthenticationFailure
+        try:
+            # The portal app doesn't rotate refresh tokens, so the same one is reused.
+            id_token, _ = await security_token.verify_refresh_token(
+                refresh_token, client_app
+            )
+        except security_token.TokenVerificationError as err:
+            raise pac.AuthenticationFailure(*err.args)
+        return id_token
+
+    async def delete_refresh_token(self, id_token: str, refresh_token: str):
+        """
+        Delete a refresh token (logout)
+
+        :raises AuthenticationFailure: If either token could not be verified
+        """
+        client_app = await self._get_client_app()
+        if not client_app.refresh_enabled:
+            raise pac.AuthenticationFailure
+        try:
+            security_token.verify(id_token, client_app)
+            await security_token.delete_refresh_token(refresh_token, client_app)
+        except security_token.TokenVerificationError as err:
+            raise pac.AuthenticationFailure(*err.args)
+
+    async def delete_all_refresh_tokens(self, id_token: str):
+        """
+        Delete all a user's refresh tokens (logout everywhere)
+
+        :raises AuthenticationFailure: If the token could not be verified
+        """
+        client_app = await self._get_client_app()
+        if not client_app.refresh_enabled:
+            raise pac.AuthenticationFailure
+        try:
+            _, claims = security_token.verify(id_token, client_app)
+        except security_token.TokenVerificationError as err:
+            raise pac.AuthenticationFailure(*err.args)
+        await security_token.delete_all_refresh_tokens(claims["sub"], client_app)
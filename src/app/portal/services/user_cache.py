@@ -0,0 +1,56 @@
+import hashlib
+import time
+from typing import Optional
+
+from app import config
+from app.portal.models.user_model import User
+from app.services.cache import TTLCache
+
+# Portal users by the digest of the id token they were resolved from, so pages and
+# htmx fragments loaded together don't each verify the token and query the user.
+# It isn't shared between workers, so a change made through another worker shows
+# up once the (short) time to live has passed.
+USER_CACHE = TTLCache(
+    maxsize=config.PORTAL_USER_CACHE_SIZE if config.PORTAL_USER_CACHE_TTL > 0 else 0,
+    ttl=config.PORTAL_USER_CACHE_TTL,
+)
+
+
+def _token_key(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+def get_user(token: str) -> Optional[User]:
+    """
+    :param token: the user's id token
+    :return: a copy of the user the token was resolved to, if cached
+    """
+    user = USER_CACHE.get(_token_key(token))
+    return user.copy() if user is not None else None
+
+
+def set_user(token: str, user: User, expires: Optional[float] = None) -> None:
+    """
+    :param token: the id token the user was resolved from
+    :param user: the user
+    :param expires: the token's exp claim, the user is never cached past it
+    """
+    ttl = config.PORTAL_USER_CACHE_TTL
+    if expires is not None:
+        ttl = min(ttl, expires - time.time())
+        if ttl <= 0:
+            return
+    USER_CACHE.set(_token_key(token), user.copy(), ttl)
+
+
+def invalidate(email: str) -> None:
+    """
+    Drop every cached token for a user. Call this after anything that changes a
+    user in the database.
+
+    :param email: the changed user's email
+    """
+    for key in USER_CACHE:
+        user = USER_CACHE.get(key)
+        if user is not None and user.email == email:
+            USER_CACHE.pop(key)
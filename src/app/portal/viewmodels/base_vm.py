@@ -39,7 +39,7 @@ class VMBase:
             self.user = None
             return False
         try:
-            self.user = await get_current_user(token)
+            self.user = await get_current_user(self.request, token)
             return True
         except (HTTPException, ValueError):
             self.user = None
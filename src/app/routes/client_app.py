@@ -1,5 +1,9 @@
-from fastapi import APIRouter, Depends
+from typing import Union
 
+from fastapi import APIRouter, Depends, Header
+from starlette.responses import Response
+
+from app import config
 from app.dependencies import check_client_app, check_client_app_authorized
 from app.models.client_app_model import ClientApp, ClientAppPublic
 from app.security import client_app as security_client_app
@@ -14,6 +18,31 @@ def get_public_key(client_app: ClientApp = Depends(check_client_app_authorized))
     return security_client_app.export_public_key(client_app)
 
 
+def _etag_matches(etag: str, if_none_match: str) -> bool:
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or any(
+        candidate.removeprefix("W/") == etag for candidate in candidates
+    )
+
+
+@client_app_router.get("/{app_id}/.well-known/jwks.json")
+async def get_jwks(
+    client_app: ClientApp = Depends(check_client_app),
+    if_none_match: Union[str, None] = Header(default=None),
+):
+    """Get the app's public keys as a JSON Web Key Set. Tokens name the key that
+    signed them in their kid header, so the keys can be cached until a token comes
+    along with a kid that isn't in the cached set."""
+    body, etag = security_client_app.export_jwks(client_app)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={config.JWKS_MAX_AGE}",
+    }
+    if if_none_match and _etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
 @client_app_router.get("/{app_id}", response_model=ClientAppPublic)
 async def get_app_info(client_app: ClientApp = Depends(check_client_app_authorized)):
     """Get more information about a client app"""
@@ -1,14 +1,15 @@
+import datetime
 from urllib.parse import quote_plus
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query
 from starlette.responses import RedirectResponse
 
 from app import config
 from app.dependencies import check_client_app, client_app_use_quota
 from app.models.client_app_model import ClientApp
 from app.models.auth_models import AuthRequest
-from app.io import email as io_email
 from app.security import magic as security_magic, token as security_token
+from app.services import email_queue
 
 magic_router = APIRouter()
 
@@ -16,21 +17,21 @@ magic_router = APIRouter()
 @magic_router.post("/request/{app_id}")
 async def request_magic(
     auth_request: AuthRequest,
-    background_tasks: BackgroundTasks,
     client_app: ClientApp = Depends(client_app_use_quota),
 ):
     """Request a magic authentication link"""
-    magic_link = security_magic.generate(auth_request.email, client_app.app_id)
-    background_tasks.add_task(
-        io_email.send,
+    magic_link = await security_magic.generate(auth_request.email, client_app.app_id)
+    await email_queue.enqueue(
         to=auth_request.email,
         subject="Your Magic Sign In Link",
         text=(
             "Click or copy this link to sign in:\n"
-            f"{magic_link}\n"
+            "%recipient.link%\n"
             f"It will expire in {config.MAGIC_LIFETIME} minutes.\n"
         ),
         from_name=client_app.name,
+        variables={"link": magic_link},
+        lifetime=datetime.timedelta(minutes=config.MAGIC_LIFETIME),
     )
     return "Check your email for a login link."
 
@@ -42,10 +43,10 @@ async def confirm_magic(
     client_app: ClientApp = Depends(check_client_app),
 ):
     """This endpoint confirms magic links. Do not use directly."""
-    if email := security_magic.verify(id_, secret, client_app.app_id):
+    if email := await security_magic.verify(id_, secret, client_app.app_id):
         id_token = security_token.generate(email, client_app)
         redirect_url = f"{client_app.redirect_url}?idToken={quote_plus(id_token)}"
-        if client_app.get_refresh_key():
+        if client_app.refresh_enabled:
             refresh_token = await security_token.generate_refresh_token(
                 email, client_app
             )
@@ -1,12 +1,13 @@
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends
+import datetime
+from fastapi import APIRouter, HTTPException, Depends
 
 from app import config
 from app.dependencies import check_client_app, client_app_use_quota
-from app.io import email as io_email
 from app.models.client_app_model import ClientApp
 from app.models.auth_models import AuthRequest, ConfirmCode
 from app.models.token_models import IssueToken
 from app.security import otp as security_otp, token as security_token
+from app.services import email_queue
 
 otp_router = APIRouter()
 
@@ -14,20 +15,20 @@ otp_router = APIRouter()
 @otp_router.post("/request/{app_id}")
 async def request_otp(
     auth_request: AuthRequest,
-    background_tasks: BackgroundTasks,
     client_app: ClientApp = Depends(client_app_use_quota),
 ):
     """Request an authentication code for an email"""
-    user_code = security_otp.generate(auth_request.email, client_app.app_id)
-    background_tasks.add_task(
-        io_email.send,
+    user_code = await security_otp.generate(auth_request.email, client_app.app_id)
+    await email_queue.enqueue(
         to=auth_request.email,
         subject="Your One Time Login Code",
         text=(
-            f"Your code is {user_code}\n"
+            "Your code is %recipient.code%\n"
             f"It will expire in {config.OTP_LIFETIME} minutes.\n"
         ),
         from_name=client_app.name,
+        variables={"code": user_code},
+        lifetime=datetime.timedelta(minutes=config.OTP_LIFETIME),
     )
     return "Check your email for a login code"
 
@@ -38,13 +39,13 @@ async def confirm_otp(
     client_app: ClientApp = Depends(check_client_app),
 ):
     """Confirm authentication by one time code"""
-    if not security_otp.verify(
+    if not await security_otp.verify(
         confirm_code.email, confirm_code.code, client_app.app_id
     ):
         raise HTTPException(status_code=401, detail="Invalid Code.")
     id_token = security_token.generate(confirm_code.email, client_app)
     refresh_token = None
-    if client_app.get_refresh_key():
+    if client_app.refresh_enabled:
         refresh_token = await security_token.generate_refresh_token(
             confirm_code.email, client_app
         )
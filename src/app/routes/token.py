@@ -1,3 +1,5 @@
+import asyncio
+
 from fastapi import APIRouter, Depends, HTTPException
 
 from app.dependencies import (
@@ -7,12 +9,19 @@ from app.dependencies import (
 from app.models.client_app_model import (
     ClientApp,
 )
-from app.models.auth_models import VerifyToken, RequestRefresh
-from app.models.token_models import VerifiedTokenResponse, IssueToken
+from app.models.auth_models import VerifyToken, VerifyTokens, RequestRefresh
+from app.models.token_models import (
+    IssueToken,
+    VerifiedTokenResponse,
+    VerifiedTokenResult,
+    VerifiedTokensResponse,
+)
 from app.security import token as security_token
 
 token_router = APIRouter()
 
+VERIFY_YIELD_EVERY = 50
+
 
 @token_router.post("/verify/{app_id}", response_model=VerifiedTokenResponse)
 async def verify_token(
@@ -27,19 +36,43 @@ async def verify_token(
     return VerifiedTokenResponse(headers=headers, claims=claims)
 
 
+@token_router.post("/verify/{app_id}/batch", response_model=VerifiedTokensResponse)
+async def verify_tokens(
+    vt: VerifyTokens,
+    client_app: ClientApp = Depends(check_client_app),
+):
+    """Verify many tokens for one app at once. Results are in the same order as the
+    tokens, and a token that doesn't verify only fails its own result."""
+    results = []
+    for i, id_token in enumerate(vt.idTokens):
+        if i and not i % VERIFY_YIELD_EVERY:
+            # Let other requests in between chunks of a large batch.
+            await asyncio.sleep(0)
+        try:
+            headers, claims = security_token.verify(id_token, client_app)
+        except security_token.TokenVerificationError as err:
+            results.append(
+                VerifiedTokenResult(valid=False, error=str(err) or "Invalid Token")
+            )
+            continue
+        results.append(VerifiedTokenResult(valid=True, headers=headers, claims=claims))
+    return VerifiedTokensResponse(results=results)
+
+
 @token_router.post("/refresh/{app_id}", response_model=IssueToken)
 async def refresh(
     req_res: RequestRefresh,
     client_app: ClientApp = Depends(check_refresh_client_app),
 ):
-    """Request a new idToken using a refresh token issued by this server."""
+    """Request a new idToken using a refresh token issued by this server. If the app
+    rotates refresh tokens, the returned refreshToken replaces the one sent."""
     try:
-        id_token = await security_token.verify_refresh_token(
+        id_token, refresh_token = await security_token.verify_refresh_token(
             req_res.refreshToken, client_app
         )
     except security_token.TokenVerificationError:
         raise HTTPException(status_code=401, detail="Could not verify refresh token")
-    return IssueToken(idToken=id_token, refreshToken=req_res.refreshToken)
+    return IssueToken(idToken=id_token, refreshToken=refresh_token)
 
 
 @token_router.delete("/refresh/{app_id}", status_code=204)
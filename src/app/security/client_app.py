@@ -1,5 +1,38 @@
-from app.models.client_app_model import ClientApp
+import hashlib
+import json
+from typing import Tuple
+
+from app import config
+from app.models.client_app_model import ClientApp, key_algorithm
+from app.services.cache import TTLCache
+
+# Serialized jwks bodies and their etags, keyed by app id and the ids of the keys
+# in them, so a rotated or retired key is never served from here.
+_JWKS_CACHE = TTLCache(maxsize=config.KEY_CACHE_SIZE)
 
 
 def export_public_key(client_app: ClientApp) -> dict:
     return client_app.get_key().export_public(as_dict=True)
+
+
+def export_jwks(client_app: ClientApp) -> Tuple[bytes, str]:
+    """
+    Get the app's public signing keys as a JSON Web Key Set, including previous keys
+    that still verify tokens they signed.
+
+    :return: the serialized key set and a strong etag for it
+    """
+    keys = client_app.get_verification_keys()
+    cache_key = (client_app.app_id, tuple(key.key_id for key in keys))
+    cached = _JWKS_CACHE.get(cache_key)
+    if cached is None:
+        public_keys = [
+            dict(key.export_public(as_dict=True), alg=key_algorithm(key), use="sig")
+            for key in keys
+        ]
+        body = json.dumps(
+            {"keys": public_keys}, sort_keys=True, separators=(",", ":")
+        ).encode("utf-8")
+        cached = (body, f'"{hashlib.sha256(body).hexdigest()}"')
+        _JWKS_CACHE.set(cache_key, cached)
+    return cached
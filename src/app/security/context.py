@@ -1,3 +1,81 @@
+import hashlib
+import hmac
+from typing import Optional, Tuple, Union
+
 from passlib.context import CryptContext
 
+from app import config
+
 PWD_CONTEXT = CryptContext(schemes=["argon2"], deprecated="auto", argon2__rounds=16)
+
+
+class SecretContext:
+    """
+    Hashing for secrets that are already random and high entropy, like api keys,
+    magic link secrets and refresh tokens. Slow password hashing adds nothing for
+    these, so they are hashed with HMAC-SHA256 keyed with a server side pepper.
+
+    It has the same verify/verify_and_update interface as passlib's CryptContext.
+    Hashes made by the legacy context still verify, and verify_and_update returns a
+    replacement hash for them so they can be upgraded as they are used.
+    """
+
+    prefix = "$hmac-sha256$"
+
+    def __init__(self, pepper: bytes, legacy: CryptContext):
+        self._pepper = pepper
+        self.legacy = legacy
+
+    def hash(self, secret: str) -> str:
+        digest = hmac.new(self._pepper, secret.encode("utf-8"), hashlib.sha256)
+        return f"{self.prefix}{digest.hexdigest()}"
+
+    def identify(self, hash_: Union[str, bytes, None]) -> bool:
+        return _as_str(hash_).startswith(self.prefix)
+
+    def needs_update(self, hash_: Union[str, bytes, None]) -> bool:
+        return not self.identify(hash_)
+
+    def verify(self, secret: str, hash_: Union[str, bytes, None]) -> bool:
+        valid, _ = self.verify_and_update(secret, hash_)
+        return valid
+
+    def verify_and_update(
+        self, secret: str, hash_: Union[str, bytes, None]
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        Verify a secret against a hash.
+
+        :param secret: the secret to check
+        :param hash_: the stored hash, from this context or the legacy one
+        :return: whether the secret matched, and a new hash to store in place of a
+        legacy one (None if the secret didn't match or the hash is already current)
+        """
+        if not hash_:
+            return False, None
+        if self.identify(hash_):
+            return hmac.compare_digest(self.hash(secret), _as_str(hash_)), None
+        if self.legacy.verify(secret, hash_):
+            return True, self.hash(secret)
+        return False, None
+
+
+def _as_str(hash_: Union[str, bytes, None]) -> str:
+    if hash_ is None:
+        return ""
+    if isinstance(hash_, bytes):
+        return hash_.decode("utf-8")
+    return hash_
+
+
+def _pepper() -> bytes:
+    if config.SECRET_PEPPER:
+        return config.SECRET_PEPPER.encode("utf-8")
+    # Deployments without a dedicated pepper derive one from the fernet key, which
+    # is already a required secret.
+    return hmac.new(
+        config.FERNET_KEY.encode("utf-8"), b"purpleauth-secret-pepper", hashlib.sha256
+    ).digest()
+
+
+SECRET_CONTEXT = SecretContext(_pepper(), legacy=PWD_CONTEXT)
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional, Tuple, TypeVar, Union
+
+from app import config
+from app.security.context import PWD_CONTEXT
+from app.services.background import BackgroundTask
+
+T = TypeVar("T")
+
+# OTP and deletion protection codes are short, so they still need a slow hash, but
+# argon2 would stall the event loop if it ran inline. The pool size doubles as the
+# concurrency cap: argon2 is memory hard, so letting every pending request hash at
+# once would blow up memory.
+
+_executor: Optional[Executor] = None
+_reporter = BackgroundTask()
+
+
+class HashingMetrics:
+    """Running counters for work handed to the hashing pool."""
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.in_flight = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        """Jobs submitted but still waiting for a free worker."""
+        return max(0, self.in_flight - self.max_workers)
+
+    @property
+    def mean_wait(self) -> float:
+        return self.total_wait / self.completed if self.completed else 0.0
+
+    def record(self, wait: float):
+        self.completed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def summary(self) -> str:
+        return (
+            f"{self.in_flight} in flight, queue depth {self.queue_depth}, "
+            f"{self.completed} done, mean wait {self.mean_wait:.3f}s, "
+            f"max wait {self.max_wait:.3f}s"
+        )
+
+    def as_dict(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "completed": self.completed,
+            "mean_wait": self.mean_wait,
+            "max_wait": self.max_wait,
+        }
+
+
+METRICS = HashingMetrics(config.HASH_MAX_WORKERS)
+
+
+def get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if config.HASH_EXECUTOR == "process":
+            _executor = ProcessPoolExecutor(max_workers=config.HASH_MAX_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(
+                max_workers=config.HASH_MAX_WORKERS, thread_name_prefix="argon2"
+            )
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+# These run in the pool, so they need to be importable module level functions for
+# the process pool to pickle them.
+def _timed(fn: Callable[..., T], *args) -> Tuple[float, T]:
+    return time.monotonic(), fn(*args)
+
+
+def _hash(secret: str) -> str:
+    return PWD_CONTEXT.hash(secret)
+
+
+def _verify(secret: str, hash_: Union[str, bytes, None]) -> bool:
+    return PWD_CONTEXT.verify(secret, hash_)
+
+
+async def _run(fn: Callable[..., T], *args) -> T:
+    loop = asyncio.get_running_loop()
+    submitted = time.monotonic()
+    METRICS.in_flight += 1
+    try:
+        started, result = await loop.run_in_executor(get_executor(), _timed, fn, *args)
+    finally:
+        METRICS.in_flight -= 1
+    wait = started - submitted
+    METRICS.record(wait)
+    if wait > config.HASH_WAIT_WARNING:
+        logging.warning(
+            f"Hashing waited {wait:.3f}s for a worker "
+            f"(queue depth {METRICS.queue_depth})"
+        )
+    return result
+
+
+async def report_periodically() -> None:
+    """Log the pool's metrics every HASH_METRICS_SECONDS while it is being used."""
+    reported = None
+    while True:
+        await asyncio.sleep(config.HASH_METRICS_SECONDS)
+        if METRICS.completed != reported or METRICS.in_flight:
+            logging.info(f"Hashing pool: {METRICS.summary()}")
+            reported = METRICS.completed
+
+
+def start_reporter() -> None:
+    _reporter.start(report_periodically)
+
+
+async def stop_reporter() -> None:
+    await _reporter.stop()
+
+
+async def hash_secret(secret: str) -> str:
+    """Hash a low entropy secret (like a one time code) with argon2."""
+    return await _run(_hash, secret)
+
+
+async def verify_secret(secret: str, hash_: Union[str, bytes, None]) -> bool:
+    """Verify a low entropy secret against an argon2 hash."""
+    if not hash_:
+        return False
+    return await _run(_verify, secret, hash_)
@@ -5,15 +5,16 @@ from urllib.parse import quote_plus, unquote
 
 from app import config
 from app.io.redis_interface import MAGIC_STORE
-from app.security.context import PWD_CONTEXT
+from app.security.context import SECRET_CONTEXT
 
 
-def generate(email: str, app_id: str) -> str:
+async def generate(email: str, app_id: str) -> str:
     url_secret = secrets.token_urlsafe()
-    secret_hash = PWD_CONTEXT.hash(url_secret)
-    MAGIC_STORE.set(f"{app_id}:magic:{email}", secret_hash)
-    MAGIC_STORE.expire(
-        f"{app_id}:magic:{email}", datetime.timedelta(minutes=config.MAGIC_LIFETIME)
+    secret_hash = SECRET_CONTEXT.hash(url_secret)
+    await MAGIC_STORE.set(
+        f"{app_id}:{email}",
+        secret_hash,
+        ex=datetime.timedelta(minutes=config.MAGIC_LIFETIME),
     )
     enc_email = config.FERNET.encrypt(email.encode("utf-8"))
     return (
@@ -22,10 +23,12 @@ def generate(email: str, app_id: str) -> str:
     )
 
 
-def verify(enc_email: str, secret: str, app_id: str) -> Optional[str]:
+async def verify(enc_email: str, secret: str, app_id: str) -> Optional[str]:
     email = config.FERNET.decrypt(unquote(enc_email).encode("utf-8")).decode("utf-8")
-    secret_hash = MAGIC_STORE.get(f"{app_id}:magic:{email}")
-    if PWD_CONTEXT.verify(secret, secret_hash):
-        MAGIC_STORE.expire(f"{app_id}:magic:{email}", datetime.timedelta(seconds=1))
+    # The secret hash is deterministic, so checking and consuming the link is a
+    # single atomic round trip.
+    if await MAGIC_STORE.delete_if_equal(
+        f"{app_id}:{email}", SECRET_CONTEXT.hash(secret)
+    ):
         return email
     return None
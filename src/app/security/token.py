@@ -1,16 +1,24 @@
 import datetime
+import hashlib
+import time
 import uuid
+from typing import Callable, Optional, Tuple
 
-import mongox
 import python_jwt as jwt
 from fastapi import Header, Depends, HTTPException
+from jwcrypto import jwk
 from jwcrypto.jws import InvalidJWSObject, InvalidJWSSignature
 
 from app import config
 from app.dependencies import check_client_app
-from app.models.client_app_model import ClientApp
+from app.models.client_app_model import ClientApp, key_algorithm
 from app.models.token_models import RefreshToken
-from app.security.context import PWD_CONTEXT
+from app.security.context import SECRET_CONTEXT
+from app.services import refresh_store, revocation
+from app.services.cache import TTLCache
+
+# Verified id token headers and claims, by app, key set and token digest.
+_VERIFY_CACHE = TTLCache(maxsize=config.VERIFY_CACHE_SIZE)
 
 
 class TokenVerificationError(BaseException):
@@ -21,11 +29,27 @@ class TokenCreationError(BaseException):
     pass
 
 
-def _check_token(token, key, app_id) -> (dict, dict):
+def _check_token(
+    token, find_key: Callable[[Optional[str]], Optional[jwk.JWK]], app_id
+) -> (dict, dict):
+    """
+    :param find_key: gets the app's key with the kid in the token's header, tokens
+    without one are checked against the current key
+    """
     try:
-        headers, claims = jwt.verify_jwt(token, key, allowed_algs=["ES256"])
+        unverified_headers, _ = jwt.process_jwt(token)
+        if not isinstance(unverified_headers, dict):
+            raise TokenVerificationError
+        key = find_key(unverified_headers.get("kid"))
+        if key is None:
+            raise TokenVerificationError("Unknown key")
+        headers, claims = jwt.verify_jwt(
+            token, key, allowed_algs=[key_algorithm(key)]
+        )
+    except jwt._JWTError as err:
+        # Keep python_jwt's message, so callers can tell e.g. "expired" tokens.
+        raise TokenVerificationError(str(err))
     except (
-        jwt._JWTError,
         UnicodeDecodeError,
         InvalidJWSObject,
         InvalidJWSSignature,
@@ -39,87 +63,183 @@ def _check_token(token, key, app_id) -> (dict, dict):
 
 def generate(email: str, client_app: ClientApp) -> str:
     payload = {"iss": f"{config.ISSUER}/app/{client_app.app_id}", "sub": email}
+    key = client_app.get_key()
     return jwt.generate_jwt(
         payload,
-        client_app.get_key(),
-        "ES256",
+        key,
+        key_algorithm(key),
         datetime.timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES),
+        other_headers={"kid": key.key_id},
     )
 
 
 def verify(token: str, client_app: ClientApp) -> (dict, dict):
-    return _check_token(token, client_app.get_key(), client_app.app_id)
+    """
+    Verify an id token, remembering the result until the token expires so the same
+    token can be checked again without verifying its signature.
+    """
+    # The ids of the app's keys are part of the cache key, so rotating or revoking
+    # keys leaves the app's earlier results behind to age out.
+    cache_key = (
+        client_app.app_id,
+        tuple(key.key_id for key in client_app.get_verification_keys()),
+        hashlib.sha256(token.encode("utf-8")).digest(),
+    )
+    cached = _VERIFY_CACHE.get(cache_key)
+    if cached is not None:
+        headers, claims = cached
+        return dict(headers), dict(claims)
+    headers, claims = _check_token(token, client_app.get_key, client_app.app_id)
+    if "exp" in claims:
+        ttl = claims["exp"] - time.time()
+        if ttl > 0:
+            _VERIFY_CACHE.set(cache_key, (dict(headers), dict(claims)), ttl)
+    return headers, claims
 
 
-async def generate_refresh_token(email: str, client_app: ClientApp) -> str:
-    if not client_app.get_refresh_key() or not client_app.refresh_token_expire_hours:
-        raise TokenCreationError("Refresh is not enabled")
-    uid = str(uuid.uuid4())
+def _sign_refresh_token(
+    record: RefreshToken,
+    generation: int,
+    client_app: ClientApp,
+    lifetime: datetime.timedelta,
+) -> str:
     payload = {
         "iss": f"{config.ISSUER}/app/{client_app.app_id}",
-        "sub": email,
-        "uid": uid,
+        "sub": record.email,
+        "uid": record.uid,
+        "gen": generation,
     }
-    token = jwt.generate_jwt(
+    refresh_key = client_app.get_refresh_key()
+    return jwt.generate_jwt(
         payload,
-        client_app.get_refresh_key(),
-        "ES256",
-        datetime.timedelta(hours=client_app.refresh_token_expire_hours),
-    )
-    token_hash = PWD_CONTEXT.hash(token)
-    expires = datetime.datetime.now() + datetime.timedelta(
-        hours=client_app.refresh_token_expire_hours
+        refresh_key,
+        key_algorithm(refresh_key),
+        lifetime,
+        other_headers={"kid": refresh_key.key_id},
     )
-    await RefreshToken(
+
+
+async def generate_refresh_token(email: str, client_app: ClientApp) -> str:
+    if not client_app.refresh_enabled or not client_app.refresh_token_expire_hours:
+        raise TokenCreationError("Refresh is not enabled")
+    lifetime = datetime.timedelta(hours=client_app.refresh_token_expire_hours)
+    record = RefreshToken(
         app_id=client_app.app_id,
         email=email,
-        hash=token_hash,
-        expires=expires,
-        uid=uid,
-    ).insert()
+        hash="",
+        expires=datetime.datetime.now() + lifetime,
+        uid=str(uuid.uuid4()),
+    )
+    token = _sign_refresh_token(record, record.generation, client_app, lifetime)
+    record.hash = SECRET_CONTEXT.hash(token)
+    await refresh_store.get_store().save(record)
     return token
 
 
-async def _find_refresh_token(claims: dict, client_app: ClientApp):
-    try:
-        return (
-            await RefreshToken.query(RefreshToken.email == claims["sub"])
-            .query(RefreshToken.app_id == client_app.app_id)
-            .query(RefreshToken.uid == claims["uid"])
-            .get()
-        )
-    except mongox.NoMatchFound:
+async def _find_refresh_token(claims: dict, client_app: ClientApp) -> RefreshToken:
+    found_rt = await refresh_store.get_store().find(client_app.app_id, claims["uid"])
+    if found_rt is None or found_rt.email != claims["sub"]:
         raise TokenVerificationError("Could not find matching token.")
-    except mongox.MultipleMatchesFound:
-        raise TokenVerificationError("Something has gone wrong")
+    return found_rt
 
 
-async def verify_refresh_token(token: str, client_app: ClientApp) -> str:
-    _, claims = _check_token(token, client_app.get_refresh_key(), client_app.app_id)
+async def _revoke_family(found_rt: RefreshToken):
+    # An old token from a rotating family has been used again, so it may have been
+    # stolen. Nobody can tell which user is the real one, so the session ends.
+    await revocation.revoke(
+        revocation.token_entry(found_rt.app_id, found_rt.uid), until=found_rt.expires
+    )
+    await refresh_store.get_store().delete(found_rt)
+    raise TokenVerificationError("Refresh token reused. Please log in again.")
+
+
+def _within_lifetime(claims: dict, client_app: ClientApp) -> bool:
+    """
+    Whether a refresh token lasts no longer than the app's refresh tokens do now.
+    Revocations only last that long, so a token issued before the lifetime was
+    lowered could outlive its revocation.
+    """
+    lifetime = datetime.timedelta(hours=client_app.refresh_token_expire_hours or 0)
+    return claims["exp"] - claims["iat"] <= lifetime.total_seconds()
+
+
+async def verify_refresh_token(token: str, client_app: ClientApp) -> Tuple[str, str]:
+    """
+    Check a refresh token and issue a new id token with it.
+
+    If the app rotates refresh tokens, the token is exchanged for the next one in
+    its family, and using any earlier token of the family again revokes it all.
+
+    :return: the new id token, and the refresh token the client should use next
+    (the same one when the app doesn't rotate them)
+    :raises TokenVerificationError: if the refresh token can't be used
+    """
+    _, claims = _check_token(token, client_app.get_refresh_key, client_app.app_id)
+    if (
+        config.REFRESH_STATELESS
+        and not client_app.rotate_refresh_tokens
+        and _within_lifetime(claims, client_app)
+        and not revocation.might_be_revoked(
+            client_app.app_id, claims["sub"], claims["uid"]
+        )
+    ):
+        # The signature already proves the token was issued here and hasn't
+        # expired, so unless it might have been revoked there's nothing to look up.
+        return generate(claims["sub"], client_app), token
     found_rt = await _find_refresh_token(claims, client_app)
+    store = refresh_store.get_store()
     if found_rt.expires <= datetime.datetime.now():
-        await found_rt.delete()
+        await store.delete(found_rt)
         raise TokenVerificationError("Expired Token. Please log in again.")
-    if PWD_CONTEXT.verify(token, found_rt.hash):
-        return generate(claims["sub"], client_app)
-    raise TokenVerificationError("Could not find matching refresh token")
+    if claims.get("gen", 0) != found_rt.generation:
+        if client_app.rotate_refresh_tokens:
+            await _revoke_family(found_rt)
+        raise TokenVerificationError("Could not find matching refresh token")
+    valid, new_hash = SECRET_CONTEXT.verify_and_update(token, found_rt.hash)
+    if not valid:
+        raise TokenVerificationError("Could not find matching refresh token")
+    id_token = generate(claims["sub"], client_app)
+    if not client_app.rotate_refresh_tokens:
+        if new_hash:
+            await store.update_hash(found_rt, new_hash)
+        return id_token, token
+    # The family keeps the expiry of its first token, so rotating never extends it.
+    next_token = _sign_refresh_token(
+        found_rt,
+        found_rt.generation + 1,
+        client_app,
+        found_rt.expires - datetime.datetime.now(),
+    )
+    if not await store.rotate(found_rt, SECRET_CONTEXT.hash(next_token)):
+        # The same token was used concurrently and the other use rotated first.
+        await _revoke_family(found_rt)
+    return id_token, next_token
 
 
 async def delete_refresh_token(refresh_token: str, client_app: ClientApp):
     _, claims = _check_token(
-        refresh_token, client_app.get_refresh_key(), client_app.app_id
+        refresh_token, client_app.get_refresh_key, client_app.app_id
     )
     found_rt = await _find_refresh_token(claims, client_app)
-    await found_rt.delete()
+    await revocation.revoke(
+        revocation.token_entry(client_app.app_id, found_rt.uid),
+        until=datetime.datetime.fromtimestamp(claims["exp"]),
+    )
+    await refresh_store.get_store().delete(found_rt)
 
 
-async def delete_all_refresh_tokens(email: str, client_app: ClientApp):
-    for rt in (
-        await RefreshToken.query(RefreshToken.email == email)
-        .query(RefreshToken.app_id == client_app.app_id)
-        .all()
-    ):
-        await rt.delete()
+async def delete_all_refresh_tokens(email: str, client_app: ClientApp) -> int:
+    """
+    Delete all of a user's refresh tokens for an app (log out everywhere).
+
+    :return: how many tokens were deleted
+    """
+    await revocation.revoke(
+        revocation.user_entry(client_app.app_id, email),
+        until=datetime.datetime.now()
+        + datetime.timedelta(hours=client_app.refresh_token_expire_hours or 0),
+    )
+    return await refresh_store.get_store().delete_all(client_app.app_id, email)
 
 
 async def authorization_header(
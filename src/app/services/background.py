@@ -0,0 +1,32 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Optional
+
+
+class BackgroundTask:
+    """
+    A long running task a module starts once per process, e.g. on startup, and
+    cancels on shutdown.
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, function: Callable[..., Awaitable[Any]], *args) -> None:
+        """Run function(*args) in the background, unless it is already running."""
+        if not self.running:
+            self._task = asyncio.create_task(function(*args))
+
+    async def stop(self) -> None:
+        """Cancel the task, if started, and wait for it to finish."""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
@@ -0,0 +1,123 @@
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, Iterator, Optional, Tuple
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    A small in-process cache that evicts the least recently used entry once it is
+    full and drops entries once they are older than their time to live.
+
+    This is not shared between workers, so anything cached here must either be
+    safe to be slightly stale or be invalidated explicitly.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: Optional[float] = None,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param maxsize: maximum number of entries to keep. A cache with a maxsize of
+        0 stores nothing.
+        :param ttl: default number of seconds an entry lives. None means entries only
+        leave the cache by eviction or invalidation.
+        :param timer: clock used for expiry, replaceable for testing.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._data: "OrderedDict[Hashable, Tuple[Optional[float], Any]]" = (
+            OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(list(self._data.keys()))
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            return default
+        if expires is not None and expires <= self._timer():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Store a value, evicting the least recently used entry if the cache is full.
+
+        :param key: cache key
+        :param value: value to store
+        :param ttl: seconds this entry should live, overriding the cache default
+        """
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires = self._timer() + ttl if ttl is not None else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        _, value = self._data.pop(key, (None, default))
+        return value
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class BloomFilter:
+    """
+    A set of strings that can answer "definitely not in the set" without storing
+    them. Membership tests can give false positives, at about the error rate while
+    it holds no more than capacity items, but never false negatives. Items can't be
+    removed, so a filter is rebuilt to drop them.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        """
+        :param capacity: how many items the filter is sized for. More can be added,
+        at the cost of more false positives.
+        :param error_rate: the false positive rate at capacity
+        """
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str) -> Iterator[int]:
+        # Two halves of one digest, combined to make as many hashes as are needed.
+        digest = hashlib.sha256(item.encode("utf-8")).digest()
+        first = int.from_bytes(digest[:8], "big")
+        second = int.from_bytes(digest[8:16], "big") | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def update(self, items: Iterable[str]) -> None:
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+
+from redis.exceptions import RedisError
+
+from app import config
+from app.io.redis_interface import REDIS
+from app.models.client_app_model import ClientApp
+from app.services.background import BackgroundTask
+from app.services.cache import TTLCache
+
+INVALIDATION_CHANNEL = "purpleauth:client_app:invalidate"
+
+CLIENT_APP_CACHE = TTLCache(
+    maxsize=config.CLIENT_APP_CACHE_SIZE if config.CLIENT_APP_CACHE_TTL > 0 else 0,
+    ttl=config.CLIENT_APP_CACHE_TTL,
+)
+
+_listener = BackgroundTask()
+
+
+async def load_client_app(app_id: str) -> ClientApp:
+    """
+    Load a client app straight from the database, bypassing the cache.
+
+    :param app_id: the app's id
+    :return: the app
+    :raises mongox.NoMatchFound: if there is no app with that id
+    """
+    return await ClientApp.query(ClientApp.app_id == app_id).get()
+
+
+async def get_client_app(app_id: str) -> ClientApp:
+    """
+    Get a client app from the cache, loading it from the database on a miss.
+
+    A copy is returned so callers can't change the cached document by accident.
+
+    :param app_id: the app's id
+    :return: the app
+    :raises mongox.NoMatchFound: if there is no app with that id
+    """
+    client_app = CLIENT_APP_CACHE.get(app_id)
+    if client_app is None:
+        client_app = await load_client_app(app_id)
+        CLIENT_APP_CACHE.set(app_id, client_app)
+    return client_app.copy()
+
+
+async def invalidate(*app_ids: str) -> None:
+    """
+    Drop apps from this worker's cache and tell every other worker to do the same.
+    Call this after anything that changes an app in the database.
+
+    :param app_ids: ids of the changed apps
+    """
+    for app_id in app_ids:
+        CLIENT_APP_CACHE.pop(app_id)
+    try:
+        for app_id in app_ids:
+            await REDIS.publish(INVALIDATION_CHANNEL, app_id)
+    except RedisError as err:
+        # Other workers will pick up the change when their entry expires.
+        logging.warning(f"Could not publish client app invalidation: {err}")
+
+
+async def listen_for_invalidations() -> None:
+    """Evict apps from the cache as invalidations are published by any worker."""
+    while True:
+        pubsub = REDIS.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Invalidations sent while we weren't subscribed have been missed.
+            CLIENT_APP_CACHE.clear()
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    CLIENT_APP_CACHE.pop(message["data"].decode("utf-8"))
+        except RedisError as err:
+            logging.warning(f"Lost client app invalidation subscription: {err}")
+            CLIENT_APP_CACHE.clear()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.reset()
+
+
+def start_listener() -> None:
+    _listener.start(listen_for_invalidations)
+
+
+async def stop_listener() -> None:
+    await _listener.stop()
@@ -0,0 +1,250 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import signal
+import socket
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from redis.exceptions import RedisError, ResponseError
+
+from app import config
+from app.io import email as io_email, redis_interface
+from app.io.redis_interface import REDIS, Namespace
+
+# Outgoing email goes through a redis stream so web workers only have to enqueue it
+# and nothing is lost on restart. Email workers (manage.py email-worker) read it in
+# batches through a consumer group. Failed sends wait in a sorted set scored by
+# when to try again, and once they have failed EMAIL_QUEUE_MAX_ATTEMPTS times they
+# are moved to a dead letter stream for someone to look at, without their text or
+# variables, which can hold login codes and links.
+EMAIL_STORE = Namespace("email")
+QUEUE = EMAIL_STORE.key("queue")
+RETRY = EMAIL_STORE.key("retry")
+DEAD = EMAIL_STORE.key("dead")
+GROUP = "senders"
+DEAD_LETTER_MAXLEN = 10000
+
+Entry = Tuple[bytes, Dict[bytes, bytes]]
+
+# Moves retries that are due back onto the queue.
+_PROMOTE = """
+local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+for _, message in ipairs(due) do
+    redis.call("XADD", KEYS[2], "*", "message", message)
+    redis.call("ZREM", KEYS[1], message)
+end
+return #due
+"""
+_promote = REDIS.register_script(_PROMOTE)
+
+
+async def enqueue(
+    to: str,
+    subject: str,
+    text: str,
+    from_name: str,
+    reply_to: str = None,
+    variables: Optional[dict] = None,
+    lifetime: Optional[datetime.timedelta] = None,
+) -> bytes:
+    """
+    Queue an email to be sent by an email worker. Takes the same arguments as
+    io_email.send. Emails with the same subject, text and sender that are sent
+    close together go out as one batch, so put anything specific to the recipient
+    in variables and refer to it as %recipient.name%.
+
+    :param variables: values for this recipient's placeholders
+    :param lifetime: how long the email is any use for, e.g. the lifetime of the
+        login code in it. It is dropped rather than sent or retried after that.
+    :return: the id of the queued message
+    """
+    message = {
+        "id": uuid.uuid4().hex,
+        "provider": config.EMAIL_TRANSPORT,
+        "attempts": 0,
+        "expires": time.time() + lifetime.total_seconds() if lifetime else None,
+        "email": {
+            "to": to,
+            "subject": subject,
+            "text": text,
+            "from_name": from_name,
+            "reply_to": reply_to,
+            "variables": variables,
+        },
+    }
+    return await REDIS.xadd(QUEUE, {"message": json.dumps(message)})
+
+
+def _expired(message: dict, at: float) -> bool:
+    return message.get("expires") is not None and message["expires"] <= at
+
+
+def _redacted(message: dict) -> dict:
+    """A message without the parts that can hold secrets, for the dead letters."""
+    email = {
+        name: value
+        for name, value in message["email"].items()
+        if name not in ("text", "variables")
+    }
+    return {**message, "email": email}
+
+
+class EmailWorker:
+    def __init__(
+        self,
+        consumer: Optional[str] = None,
+        batch_size: int = config.EMAIL_QUEUE_BATCH_SIZE,
+        concurrency: int = config.EMAIL_PROVIDER_CONCURRENCY,
+    ):
+        """
+        :param consumer: name of this worker in the consumer group, must be unique
+        :param batch_size: how many messages to read from the queue at once
+        :param concurrency: how many sends to have in flight to each provider
+        """
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._batchers: Dict[str, io_email.Batcher] = {}
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    async def ensure_group(self):
+        try:
+            await REDIS.xgroup_create(QUEUE, GROUP, id="0", mkstream=True)
+        except ResponseError as err:
+            if "BUSYGROUP" not in str(err):
+                raise
+
+    async def run(self):
+        await self.ensure_group()
+        logging.info(f"Email worker {self.consumer} started")
+        while not self._stopping.is_set():
+            try:
+                await self.run_once(block=1000)
+            except RedisError as err:
+                logging.warning(f"Email worker lost redis: {err}")
+                await asyncio.sleep(1)
+        logging.info(f"Email worker {self.consumer} stopped")
+
+    async def run_once(self, block: Optional[int] = None) -> int:
+        """
+        Send one batch of queued emails.
+
+        :param block: milliseconds to wait for new messages if there are none
+        :return: how many messages were handled
+        """
+        await self.promote_retries()
+        entries = await self.claim_stale()
+        if not entries:
+            response = await REDIS.xreadgroup(
+                GROUP, self.consumer, {QUEUE: ">"}, count=self.batch_size, block=block
+            )
+            entries = response[0][1] if response else []
+        await asyncio.gather(*(self.process(*entry) for entry in entries))
+        return len(entries)
+
+    async def promote_retries(self) -> int:
+        return await _promote(keys=[RETRY, QUEUE], args=[time.time(), self.batch_size])
+
+    async def claim_stale(self) -> List[Entry]:
+        """Take over messages a worker read but never finished, e.g. if it crashed."""
+        idle = config.EMAIL_QUEUE_CLAIM_IDLE * 1000
+        pending = await REDIS.xpending_range(
+            QUEUE, GROUP, min="-", max="+", count=self.batch_size
+        )
+        stale = [
+            entry["message_id"]
+            for entry in pending
+            if entry["time_since_delivered"] >= idle
+        ]
+        if not stale:
+            return []
+        claimed = await REDIS.xclaim(
+            QUEUE, GROUP, self.consumer, min_idle_time=idle, message_ids=stale
+        )
+        return [(entry_id, fields) for entry_id, fields in claimed if fields]
+
+    def _batcher(self, provider: str) -> io_email.Batcher:
+        """
+        Messages go out through the transport that was configured when they were
+        queued, so changing EMAIL_TRANSPORT doesn't strand the ones already queued.
+        """
+        if provider not in self._batchers:
+            self._batchers[provider] = io_email.Batcher(
+                concurrency=self.concurrency,
+                transport=io_email.get_transport(provider),
+            )
+        return self._batchers[provider]
+
+    async def process(self, entry_id: bytes, fields: Dict[bytes, bytes]):
+        message = json.loads(fields[b"message"])
+        if _expired(message, time.time()):
+            logging.info(f"Dropping email {message['id']}, it has expired")
+            await self.finish(entry_id)
+            return
+        try:
+            await self._batcher(message["provider"]).send(**message["email"])
+        except Exception as err:
+            await self.retry_later(entry_id, message, err)
+            return
+        await self.finish(entry_id)
+
+    async def finish(self, entry_id: bytes):
+        async with REDIS.pipeline(transaction=True) as pipe:
+            pipe.xack(QUEUE, GROUP, entry_id)
+            pipe.xdel(QUEUE, entry_id)
+            await pipe.execute()
+
+    async def retry_later(self, entry_id: bytes, message: dict, err: Exception):
+        """Schedule a failed message to be tried again, or dead letter it."""
+        message["attempts"] += 1
+        message["error"] = str(err) or type(err).__name__
+        backoff = config.EMAIL_QUEUE_RETRY_BACKOFF * 2 ** (message["attempts"] - 1)
+        retry_at = time.time() + backoff
+        async with REDIS.pipeline(transaction=True) as pipe:
+            if _expired(message, retry_at):
+                logging.warning(
+                    f"Dropping email {message['id']} to {message['email']['to']}, "
+                    f"it will have expired before it can be retried: "
+                    f"{message['error']}"
+                )
+            elif message["attempts"] >= config.EMAIL_QUEUE_MAX_ATTEMPTS:
+                logging.error(
+                    f"Giving up on email {message['id']} to "
+                    f"{message['email']['to']}: {message['error']}"
+                )
+                pipe.xadd(
+                    DEAD,
+                    {"message": json.dumps(_redacted(message))},
+                    maxlen=DEAD_LETTER_MAXLEN,
+                    approximate=True,
+                )
+            else:
+                pipe.zadd(RETRY, {json.dumps(message): retry_at})
+            pipe.xack(QUEUE, GROUP, entry_id)
+            pipe.xdel(QUEUE, entry_id)
+            await pipe.execute()
+
+
+async def work(
+    consumer: Optional[str] = None,
+    batch_size: int = config.EMAIL_QUEUE_BATCH_SIZE,
+    concurrency: int = config.EMAIL_PROVIDER_CONCURRENCY,
+):
+    """Run an email worker until it is interrupted or terminated."""
+    worker = EmailWorker(consumer, batch_size, concurrency)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    await io_email.startup()
+    try:
+        await worker.run()
+    finally:
+        await io_email.shutdown()
+        await redis_interface.close()
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from typing import List, Type
+
+import mongox
+from pymongo.errors import PyMongoError
+
+from app import config
+from app.database import raw_collection
+from app.models.token_models import RefreshToken
+from app.services.background import BackgroundTask
+
+# Indexes that a model's declared indexes have replaced, dropped once their
+# replacements exist. Any other index on the collection is left alone, so
+# indexes an operator added by hand survive.
+REPLACED_INDEXES = {RefreshToken: ["app_id", "email"]}
+
+_builder = BackgroundTask()
+
+
+async def _report_progress(collection, name: str) -> None:
+    """Log how far along the server is with building an index, if it will say."""
+    try:
+        async for operation in collection.database.client.admin.aggregate(
+            [
+                {"$currentOp": {"allUsers": True}},
+                {"$match": {"command.createIndexes": collection.name}},
+            ]
+        ):
+            progress = operation.get("progress")
+            if progress and progress.get("total"):
+                logging.info(
+                    f"Index {name} on {collection.name}: "
+                    f"{progress['done']}/{progress['total']} "
+                    f"({progress['done'] / progress['total']:.0%})"
+                )
+                return
+    except PyMongoError as err:
+        # Seeing other operations needs extra privileges, the build goes on anyway.
+        logging.debug(f"Could not read index build progress: {err}")
+    logging.info(f"Index {name} on {collection.name}: still building")
+
+
+async def ensure_indexes(model: Type[mongox.Model]) -> List[str]:
+    """
+    Build any of a model's Meta.indexes its collection is missing.
+
+    Missing indexes are built one at a time, logging progress while they build.
+    The indexes they replace (REPLACED_INDEXES) are only dropped after that, so
+    queries always have an index to use.
+
+    :param model: the model whose collection to index
+    :return: the names of the indexes that were created
+    """
+    collection = raw_collection(model)
+    wanted = {index.name: index for index in model.Meta.indexes}
+    existing = await collection.index_information()
+    missing = [index for name, index in wanted.items() if name not in existing]
+    created = []
+    for number, index in enumerate(missing, start=1):
+        logging.info(
+            f"Building index {index.name} on {collection.name} "
+            f"({number}/{len(missing)})"
+        )
+        build = asyncio.ensure_future(collection.create_indexes([index]))
+        while True:
+            done, _ = await asyncio.wait({build}, timeout=config.INDEX_PROGRESS_SECONDS)
+            if done:
+                break
+            await _report_progress(collection, index.name)
+        await build
+        created.append(index.name)
+        logging.info(f"Built index {index.name} on {collection.name}")
+    for name in REPLACED_INDEXES.get(model, []):
+        if name in existing and name not in wanted:
+            logging.info(f"Dropping index {name} on {collection.name}")
+            await collection.drop_index(name)
+    return created
+
+
+async def _ensure_all(models: List[Type[mongox.Model]]) -> None:
+    for model in models:
+        try:
+            await ensure_indexes(model)
+        except PyMongoError as err:
+            logging.error(f"Could not build indexes for {model.__name__}: {err}")
+
+
+def start_builder(*models: Type[mongox.Model]) -> None:
+    """Build models' indexes in the background, so startup doesn't wait on them."""
+    _builder.start(_ensure_all, list(models))
+
+
+async def stop_builder() -> None:
+    await _builder.stop()
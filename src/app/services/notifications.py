@@ -0,0 +1,100 @@
+import asyncio
+import datetime
+import logging
+from typing import Coroutine, Set
+
+from app import config
+from app.io.redis_interface import Namespace
+from app.models.client_app_model import ClientApp
+from app.services import email_queue, quota
+
+NOTIFICATION_STORE = Namespace("notifications")
+
+# Strong references to the running sends, asyncio only keeps weak ones.
+_pending: Set[asyncio.Task] = set()
+
+
+async def _send_once_a_day(kind: str, app_id: str, **email) -> bool:
+    """
+    Send an email about an app at most once a day, across all workers.
+
+    :param kind: which notification this is
+    :param app_id: the app it is about
+    :param email: arguments for email_queue.enqueue
+    :return: True if this call sent it
+    """
+    key = f"{kind}:{app_id}:{datetime.date.today().isoformat()}"
+    if not await NOTIFICATION_STORE.set(
+        key, "1", nx=True, ex=datetime.timedelta(days=1)
+    ):
+        return False
+    try:
+        await email_queue.enqueue(**email)
+    except Exception:
+        # Let the next request try again.
+        await NOTIFICATION_STORE.delete(key)
+        raise
+    return True
+
+
+async def send_out_of_quota(client_app: ClientApp) -> None:
+    await _send_once_a_day(
+        "out_of_quota",
+        client_app.app_id,
+        to=client_app.owner,
+        subject="%recipient.app_name% is out of Authentications",
+        text="%recipient.app_name% has reached its quota of authentications. No "
+        "further authentications will be processed. Please reply to this "
+        "email to purchase more.\nRick Henry\nRick Henry Development\n"
+        "https://rickhenry.dev",
+        from_name="Purple Authentication",
+        reply_to=config.WEBMASTER_EMAIL,
+        variables={"app_name": client_app.name},
+    )
+
+
+async def send_low_quota(client_app: ClientApp, remaining: int) -> None:
+    sent = await _send_once_a_day(
+        "low_quota",
+        client_app.app_id,
+        to=client_app.owner,
+        subject="%recipient.app_name% is almost out of Authentications",
+        text="%recipient.app_name% has almost reached its quota of "
+        "authentications. It will process %recipient.remaining% more "
+        "authentications before it stops authenticating users. "
+        "Please reply to this email to purchase more.\nRick Henry"
+        "\nRick Henry Development\nhttps://rickhenry.dev",
+        from_name="Purple Authentication",
+        reply_to=config.WEBMASTER_EMAIL,
+        variables={"app_name": client_app.name, "remaining": remaining},
+    )
+    if sent:
+        await quota.mark_low_quota_notified(client_app.app_id)
+
+
+def _log_failure(task: asyncio.Task) -> None:
+    _pending.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.warning(f"Could not send quota notification: {task.exception()}")
+
+
+def _in_background(coroutine: Coroutine) -> None:
+    task = asyncio.create_task(coroutine)
+    _pending.add(task)
+    task.add_done_callback(_log_failure)
+
+
+def notify_out_of_quota(client_app: ClientApp) -> None:
+    """Tell the owner their app is out of quota, without waiting for the email."""
+    _in_background(send_out_of_quota(client_app))
+
+
+def notify_low_quota(client_app: ClientApp, remaining: int) -> None:
+    """Tell the owner their app is running low, without waiting for the email."""
+    _in_background(send_low_quota(client_app, remaining))
+
+
+async def drain() -> None:
+    """Wait for notifications that are still being sent, for shutdown."""
+    if _pending:
+        await asyncio.gather(*_pending, return_exceptions=True)
@@ -0,0 +1,94 @@
+import datetime
+import logging
+from typing import Optional
+
+from pymongo import ReturnDocument
+from redis.exceptions import RedisError
+
+from app import config
+from app.database import raw_collection
+from app.models.client_app_model import ClientApp
+from app.services import redis_quota
+
+
+async def use_quota(app_id: str) -> Optional[int]:
+    """
+    Take one authentication from an app's quota, using the configured engine.
+
+    :param app_id: the app to charge
+    :return: the remaining quota after this authentication, or None if there was
+    none left
+    """
+    if config.QUOTA_ENGINE == "redis":
+        try:
+            return await redis_quota.use_quota(app_id)
+        except (redis_quota.CounterUnavailable, RedisError) as err:
+            logging.warning(
+                f"Quota counter for {app_id} unavailable, using mongo: {err!r}"
+            )
+    return await _use_mongo_quota(app_id)
+
+
+async def _use_mongo_quota(app_id: str) -> Optional[int]:
+    """
+    Take one authentication from an app's quota in mongo.
+
+    The decrement is a single conditional update, so concurrent requests can't
+    lose each other's writes or take the quota below zero, and nothing but the
+    counter is written.
+
+    :param app_id: the app to charge
+    :return: the remaining quota after this authentication, or None if there was
+    none left
+    """
+    updated = await raw_collection(ClientApp).find_one_and_update(
+        {"app_id": app_id, "quota": {"$gte": 1}},
+        {"$inc": {"quota": -1}},
+        projection={"_id": False, "quota": True},
+        return_document=ReturnDocument.AFTER,
+    )
+    if updated is None:
+        return None
+    return updated["quota"]
+
+
+async def mark_low_quota_notified(app_id: str) -> None:
+    """
+    Record when the owner was last told their app is running low.
+
+    :param app_id: the app that was notified about
+    """
+    await raw_collection(ClientApp).update_one(
+        {"app_id": app_id},
+        {"$set": {"low_quota_last_notified": datetime.datetime.now()}},
+    )
+
+
+async def forget_counter(app_id: str) -> None:
+    """
+    Make the quota engine pick up a quota just written to mongo. Without this the
+    redis engine keeps counting down from the old quota until its counter expires.
+
+    :param app_id: the app whose quota was written
+    """
+    if config.QUOTA_ENGINE != "redis":
+        return
+    try:
+        await redis_quota.forget(app_id)
+    except RedisError as err:
+        logging.warning(f"Could not reset quota counter for {app_id}: {err}")
+
+
+async def set_quota(app_id: str, remaining: int) -> bool:
+    """
+    Set how many authentications an app has left.
+
+    :param app_id: the app to change
+    :param remaining: its new quota
+    :return: False if there is no such app
+    """
+    result = await raw_collection(ClientApp).update_one(
+        {"app_id": app_id}, {"$set": {"quota": remaining}}
+    )
+    await forget_counter(app_id)
+    return result.matched_count == 1
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import uuid
+from typing import Optional
+
+from pymongo import UpdateOne
+from redis.exceptions import RedisError
+
+from app import config
+from app.database import raw_collection
+from app.io.redis_interface import REDIS, Namespace
+from app.models.client_app_model import ClientApp
+from app.services.background import BackgroundTask
+
+# Remaining quota lives in redis as one counter per app. Every authentication also
+# adds to a "pending" hash of app_id -> authentications not yet written to mongo.
+# A flush renames pending to "flushing", tagged with a fresh flush id, applies it
+# to mongo with one bulk write and then drops it. Each app document records the
+# last flush id applied to it (quota_flush_id, deliberately not a model field so
+# ClientApp.save() leaves it alone), which makes replaying a half finished flush
+# after a crash harmless.
+QUOTA_STORE = Namespace("quota")
+PENDING = QUOTA_STORE.key("pending")
+FLUSHING = QUOTA_STORE.key("flushing")
+FLUSHING_ID = QUOTA_STORE.key("flushing_id")
+GENERATION = QUOTA_STORE.key("generation")
+
+SEED_ATTEMPTS = 3
+
+_NEEDS_SEED = -2
+_OUT_OF_QUOTA = -1
+
+_flusher = BackgroundTask()
+
+
+class CounterUnavailable(Exception):
+    """The app's counter couldn't be seeded, quota has to be taken from mongo."""
+
+
+# Returns the new remaining count, -1 when there is none left or -2 when the
+# counter has to be seeded from mongo first.
+_TAKE = """
+local remaining = redis.call("GET", KEYS[1])
+if not remaining then
+    return -2
+end
+if tonumber(remaining) < 1 then
+    return -1
+end
+redis.call("HINCRBY", KEYS[2], ARGV[1], 1)
+return redis.call("DECR", KEYS[1])
+"""
+
+# Seeds the counter from the quota read from mongo, less whatever hasn't been
+# written back yet. Gives up if a flush finished since the caller started reading,
+# since the quota it read may not include that flush.
+_SEED = """
+if (redis.call("GET", KEYS[5]) or "0") ~= ARGV[4] then
+    return 0
+end
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    local used = tonumber(redis.call("HGET", KEYS[2], ARGV[1]) or 0)
+    if redis.call("GET", KEYS[4]) ~= ARGV[3] then
+        used = used + tonumber(redis.call("HGET", KEYS[3], ARGV[1]) or 0)
+    end
+    redis.call("SET", KEYS[1], tonumber(ARGV[2]) - used, "EX", ARGV[5])
+end
+return 1
+"""
+
+# Returns the id of the flush to apply: an unfinished one if there is one,
+# otherwise a new one made from the pending counts. Nil if there is nothing to do.
+_START_FLUSH = """
+local current = redis.call("GET", KEYS[3])
+if current and redis.call("EXISTS", KEYS[2]) == 1 then
+    return current
+end
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return false
+end
+redis.call("RENAME", KEYS[1], KEYS[2])
+redis.call("SET", KEYS[3], ARGV[1])
+return ARGV[1]
+"""
+
+_FINISH_FLUSH = """
+if redis.call("GET", KEYS[2]) == ARGV[1] then
+    redis.call("DEL", KEYS[1], KEYS[2])
+    redis.call("INCR", KEYS[3])
+end
+return 0
+"""
+
+_take = REDIS.register_script(_TAKE)
+_seed_counter = REDIS.register_script(_SEED)
+_start_flush = REDIS.register_script(_START_FLUSH)
+_finish_flush = REDIS.register_script(_FINISH_FLUSH)
+
+
+def remaining_key(app_id: str) -> str:
+    return QUOTA_STORE.key(f"remaining:{app_id}")
+
+
+async def _seed(app_id: str) -> None:
+    generation = await REDIS.get(GENERATION) or b"0"
+    document = await raw_collection(ClientApp).find_one(
+        {"app_id": app_id},
+        projection={"_id": False, "quota": True, "quota_flush_id": True},
+    )
+    if document is None:
+        return
+    await _seed_counter(
+        keys=[remaining_key(app_id), PENDING, FLUSHING, FLUSHING_ID, GENERATION],
+        args=[
+            app_id,
+            document["quota"],
+            document.get("quota_flush_id", ""),
+            generation,
+            config.QUOTA_REDIS_TTL,
+        ],
+    )
+
+
+async def use_quota(app_id: str) -> Optional[int]:
+    """
+    Take one authentication from the app's counter in redis.
+
+    :param app_id: the app to charge
+    :return: the remaining quota after this authentication, or None if there was
+    none left
+    :raises CounterUnavailable: if the counter couldn't be seeded
+    """
+    remaining = await _take(keys=[remaining_key(app_id), PENDING], args=[app_id])
+    attempts = 0
+    while remaining == _NEEDS_SEED:
+        if attempts == SEED_ATTEMPTS:
+            raise CounterUnavailable(app_id)
+        attempts += 1
+        await _seed(app_id)
+        remaining = await _take(keys=[remaining_key(app_id), PENDING], args=[app_id])
+    if remaining == _OUT_OF_QUOTA:
+        return None
+    return remaining
+
+
+async def forget(app_id: str) -> None:
+    """
+    Drop the app's counter, so the next authentication seeds it from the quota in
+    mongo. Call this whenever the quota is written there.
+    """
+    await REDIS.delete(remaining_key(app_id))
+
+
+async def flush() -> int:
+    """
+    Write the authentications counted in redis back to mongo.
+
+    Also finishes a flush interrupted by a crash, so it is run on startup.
+
+    :return: how many apps were updated
+    """
+    flush_id = await _start_flush(
+        keys=[PENDING, FLUSHING, FLUSHING_ID], args=[uuid.uuid4().hex]
+    )
+    if flush_id is None:
+        return 0
+    flush_id = flush_id.decode("utf-8") if isinstance(flush_id, bytes) else flush_id
+    used = await REDIS.hgetall(FLUSHING)
+    operations = [
+        UpdateOne(
+            {"app_id": app_id.decode("utf-8"), "quota_flush_id": {"$ne": flush_id}},
+            {"$inc": {"quota": -int(count)}, "$set": {"quota_flush_id": flush_id}},
+        )
+        for app_id, count in used.items()
+    ]
+    if operations:
+        await raw_collection(ClientApp).bulk_write(operations, ordered=False)
+    await _finish_flush(keys=[FLUSHING, FLUSHING_ID, GENERATION], args=[flush_id])
+    return len(operations)
+
+
+async def flush_periodically() -> None:
+    while True:
+        await asyncio.sleep(config.QUOTA_FLUSH_SECONDS)
+        try:
+            await flush()
+        except Exception as err:
+            # Nothing is lost, the counts stay in redis until the next flush.
+            logging.warning(f"Could not flush quota to the database: {err}")
+
+
+async def start_flusher() -> None:
+    try:
+        await flush()
+    except RedisError as err:
+        logging.warning(f"Could not reconcile quota on startup: {err}")
+    _flusher.start(flush_periodically)
+
+
+async def stop_flusher() -> None:
+    await _flusher.stop()
+    try:
+        await flush()
+    except RedisError as err:
+        logging.warning(f"Could not flush quota on shutdown: {err}")
@@ -0,0 +1,397 @@
+import abc
+import datetime
+import math
+from typing import AsyncIterator, Dict, Iterable, Optional
+
+from mongox import Q
+from pymongo import ReplaceOne
+
+from app import config
+from app.database import raw_collection
+from app.io.redis_interface import REDIS, Namespace
+from app.models.token_models import RefreshToken
+
+
+class RefreshTokenStore(abc.ABC):
+    """
+    Where the stored part of refresh tokens lives. Records are found by app and
+    uid, which every refresh token carries in its claims.
+    """
+
+    @abc.abstractmethod
+    async def save(self, record: RefreshToken) -> None:
+        pass
+
+    async def save_many(self, records: Iterable[RefreshToken]) -> int:
+        """
+        Save several records, replacing any already stored with the same app and
+        uid, so copying the same records twice is harmless.
+
+        :return: how many were saved
+        """
+        saved = 0
+        for record in records:
+            await self.save(record)
+            saved += 1
+        return saved
+
+    @abc.abstractmethod
+    async def find(self, app_id: str, uid: str) -> Optional[RefreshToken]:
+        pass
+
+    @abc.abstractmethod
+    async def update_hash(self, record: RefreshToken, new_hash: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def rotate(self, record: RefreshToken, new_hash: str) -> bool:
+        """
+        Move a record on to its next generation with a new hash, if it is still at
+        the record's generation.
+
+        :return: False if another rotation got there first, or the record is gone
+        """
+
+    @abc.abstractmethod
+    async def delete(self, record: RefreshToken) -> int:
+        pass
+
+    @abc.abstractmethod
+    async def delete_all(self, app_id: str, email: str) -> int:
+        """Delete all of a user's records for an app, returning how many."""
+
+    @abc.abstractmethod
+    async def delete_apps(self, *app_ids: str) -> int:
+        """Delete every record for the apps, returning how many."""
+
+    @abc.abstractmethod
+    def scan(self) -> AsyncIterator[RefreshToken]:
+        """Iterate over every unexpired record."""
+
+
+class MongoRefreshStore(RefreshTokenStore):
+    """
+    Records in the refresh_tokens collection, found through the unique (app_id,
+    uid) index. Mongo deletes them once they expire.
+    """
+
+    async def save(self, record: RefreshToken) -> None:
+        await record.insert()
+
+    async def save_many(self, records: Iterable[RefreshToken]) -> int:
+        operations = [
+            ReplaceOne(
+                {"app_id": record.app_id, "uid": record.uid},
+                record.dict(exclude={"id"}),
+                upsert=True,
+            )
+            for record in records
+        ]
+        if not operations:
+            return 0
+        await raw_collection(RefreshToken).bulk_write(operations, ordered=False)
+        return len(operations)
+
+    async def find(self, app_id: str, uid: str) -> Optional[RefreshToken]:
+        document = await raw_collection(RefreshToken).find_one(
+            {"app_id": app_id, "uid": uid}
+        )
+        if document is None:
+            return None
+        return RefreshToken(**document)
+
+    async def update_hash(self, record: RefreshToken, new_hash: str) -> None:
+        await raw_collection(RefreshToken).update_one(
+            {"app_id": record.app_id, "uid": record.uid}, {"$set": {"hash": new_hash}}
+        )
+
+    async def rotate(self, record: RefreshToken, new_hash: str) -> bool:
+        # Records saved before rotation existed have no generation, which means 0.
+        generation = record.generation or {"$in": [0, None]}
+        result = await raw_collection(RefreshToken).update_one(
+            {"app_id": record.app_id, "uid": record.uid, "generation": generation},
+            {"$set": {"hash": new_hash}, "$inc": {"generation": 1}},
+        )
+        return result.modified_count == 1
+
+    async def delete(self, record: RefreshToken) -> int:
+        result = await raw_collection(RefreshToken).delete_one(
+            {"app_id": record.app_id, "uid": record.uid}
+        )
+        return result.deleted_count
+
+    async def delete_all(self, app_id: str, email: str) -> int:
+        result = await raw_collection(RefreshToken).delete_many(
+            {"app_id": app_id, "email": email}
+        )
+        return result.deleted_count
+
+    async def delete_apps(self, *app_ids: str) -> int:
+        if not app_ids:
+            return 0
+        return await RefreshToken.query(
+            Q.in_(RefreshToken.app_id, list(app_ids))
+        ).delete()
+
+    async def scan(self) -> AsyncIterator[RefreshToken]:
+        async for document in raw_collection(RefreshToken).find(
+            {"expires": {"$gt": datetime.datetime.now()}}
+        ):
+            yield RefreshToken(**document)
+
+
+# Each record is a hash of email, hash, expires and generation at "{<app_id>}:<uid>"
+# in TOKENS, which redis deletes when the token expires. A sorted set of uids at
+# "{<app_id>}:<email>" in USERS is what logout everywhere deletes by, and a sorted
+# set of the keys of every record and user set at "{<app_id>}" in APPS is what
+# deleting an app deletes by. Both are scored by when their entries expire, drop
+# expired entries whenever a token is saved and live as long as their newest one.
+# The braces make redis cluster keep all of an app's keys in one slot, so scripts
+# can be given any of them.
+TOKENS = Namespace("refresh_token")
+USERS = Namespace("refresh_user")
+APPS = Namespace("refresh_app")
+BATCH_SIZE = 500
+
+_SAVE = """
+redis.call(
+    "HSET", KEYS[1],
+    "email", ARGV[1], "hash", ARGV[2], "expires", ARGV[3], "generation", ARGV[7]
+)
+redis.call("EXPIRE", KEYS[1], ARGV[4])
+redis.call("ZADD", KEYS[2], ARGV[3], ARGV[5])
+redis.call("ZREMRANGEBYSCORE", KEYS[2], "-inf", ARGV[6])
+redis.call("ZADD", KEYS[3], ARGV[3], KEYS[1])
+if tonumber(redis.call("ZSCORE", KEYS[3], KEYS[2]) or 0) < tonumber(ARGV[3]) then
+    redis.call("ZADD", KEYS[3], ARGV[3], KEYS[2])
+end
+redis.call("ZREMRANGEBYSCORE", KEYS[3], "-inf", ARGV[6])
+for i = 2, 3 do
+    if redis.call("TTL", KEYS[i]) < tonumber(ARGV[4]) then
+        redis.call("EXPIRE", KEYS[i], ARGV[4])
+    end
+end
+return 1
+"""
+
+# Only sets the hash of a record that still exists, an HSET on its own would bring
+# back an expired record with no expiry at all.
+_UPDATE_HASH = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return redis.call("HSET", KEYS[1], "hash", ARGV[1])
+end
+return 0
+"""
+
+# Records saved before rotation existed have no generation, which means 0 here too.
+_ROTATE = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+if (redis.call("HGET", KEYS[1], "generation") or "0") ~= ARGV[1] then
+    return 0
+end
+redis.call("HSET", KEYS[1], "hash", ARGV[2], "generation", tonumber(ARGV[1]) + 1)
+return 1
+"""
+
+_DELETE = """
+local deleted = redis.call("DEL", KEYS[1])
+redis.call("ZREM", KEYS[2], ARGV[1])
+redis.call("ZREM", KEYS[3], KEYS[1])
+return deleted
+"""
+
+# Deletes a user's records, given the keys of the records (from KEYS[3]) and their
+# uids. Returns -1 without deleting anything if the user's tokens have changed
+# since the uids were read, so they can be read again.
+_DELETE_ALL = """
+local uids = redis.call("ZRANGE", KEYS[1], 0, -1)
+if #uids ~= #ARGV then
+    return -1
+end
+local expected = {}
+for _, uid in ipairs(ARGV) do
+    expected[uid] = true
+end
+for _, uid in ipairs(uids) do
+    if not expected[uid] then
+        return -1
+    end
+end
+local deleted = 0
+for i = 3, #KEYS do
+    deleted = deleted + redis.call("DEL", KEYS[i])
+    redis.call("ZREM", KEYS[2], KEYS[i])
+end
+redis.call("DEL", KEYS[1])
+redis.call("ZREM", KEYS[2], KEYS[1])
+return deleted
+"""
+
+_save_record = REDIS.register_script(_SAVE)
+_set_hash = REDIS.register_script(_UPDATE_HASH)
+_rotate_record = REDIS.register_script(_ROTATE)
+_delete_record = REDIS.register_script(_DELETE)
+_delete_user = REDIS.register_script(_DELETE_ALL)
+
+
+def _glob_escape(value: str) -> str:
+    for special in "\\*?[]":
+        value = value.replace(special, f"\\{special}")
+    return value
+
+
+def _token_key(app_id: str, uid: str) -> str:
+    return TOKENS.key(f"{{{app_id}}}:{uid}")
+
+
+def _user_key(app_id: str, email: str) -> str:
+    return USERS.key(f"{{{app_id}}}:{email}")
+
+
+def _app_key(app_id: str) -> str:
+    return APPS.key(f"{{{app_id}}}")
+
+
+def _seconds_left(expires: datetime.datetime) -> int:
+    return math.ceil((expires - datetime.datetime.now()).total_seconds())
+
+
+def _record(app_id: str, uid: str, fields: Dict[bytes, bytes]) -> RefreshToken:
+    return RefreshToken(
+        app_id=app_id,
+        uid=uid,
+        email=fields[b"email"].decode("utf-8"),
+        hash=fields[b"hash"].decode("utf-8"),
+        expires=datetime.datetime.fromtimestamp(float(fields[b"expires"])),
+        generation=int(fields.get(b"generation", 0)),
+    )
+
+
+class RedisRefreshStore(RefreshTokenStore):
+    """Records in redis, which expires them itself."""
+
+    async def _save(self, record: RefreshToken, client=None) -> bool:
+        seconds_left = _seconds_left(record.expires)
+        if seconds_left <= 0:
+            return False
+        await _save_record(
+            keys=[
+                _token_key(record.app_id, record.uid),
+                _user_key(record.app_id, record.email),
+                _app_key(record.app_id),
+            ],
+            args=[
+                record.email,
+                record.hash,
+                record.expires.timestamp(),
+                seconds_left,
+                record.uid,
+                datetime.datetime.now().timestamp(),
+                record.generation,
+            ],
+            client=client,
+        )
+        return True
+
+    async def save(self, record: RefreshToken) -> None:
+        await self._save(record)
+
+    async def save_many(self, records: Iterable[RefreshToken]) -> int:
+        saved = 0
+        async with REDIS.pipeline(transaction=False) as pipe:
+            for record in records:
+                saved += await self._save(record, client=pipe)
+            await pipe.execute()
+        return saved
+
+    async def find(self, app_id: str, uid: str) -> Optional[RefreshToken]:
+        fields = await REDIS.hgetall(_token_key(app_id, uid))
+        if not fields:
+            return None
+        return _record(app_id, uid, fields)
+
+    async def update_hash(self, record: RefreshToken, new_hash: str) -> None:
+        await _set_hash(keys=[_token_key(record.app_id, record.uid)], args=[new_hash])
+
+    async def rotate(self, record: RefreshToken, new_hash: str) -> bool:
+        rotated = await _rotate_record(
+            keys=[_token_key(record.app_id, record.uid)],
+            args=[record.generation, new_hash],
+        )
+        return bool(rotated)
+
+    async def delete(self, record: RefreshToken) -> int:
+        return await _delete_record(
+            keys=[
+                _token_key(record.app_id, record.uid),
+                _user_key(record.app_id, record.email),
+                _app_key(record.app_id),
+            ],
+            args=[record.uid],
+        )
+
+    async def delete_all(self, app_id: str, email: str) -> int:
+        user_key = _user_key(app_id, email)
+        while True:
+            uids = [uid.decode("utf-8") for uid in await REDIS.zrange(user_key, 0, -1)]
+            deleted = await _delete_user(
+                keys=[
+                    user_key,
+                    _app_key(app_id),
+                    *(_token_key(app_id, uid) for uid in uids),
+                ],
+                args=uids,
+            )
+            if deleted >= 0:
+                return deleted
+
+    async def delete_apps(self, *app_ids: str) -> int:
+        deleted = 0
+        for app_id in app_ids:
+            app_key = _app_key(app_id)
+            token_prefix = _token_key(app_id, "").encode("utf-8")
+            while keys := await REDIS.zrange(app_key, 0, BATCH_SIZE - 1):
+                async with REDIS.pipeline(transaction=True) as pipe:
+                    for key in keys:
+                        pipe.unlink(key)
+                    pipe.zrem(app_key, *keys)
+                    unlinked = await pipe.execute()
+                deleted += sum(
+                    count
+                    for key, count in zip(keys, unlinked)
+                    if key.startswith(token_prefix)
+                )
+        return deleted
+
+    async def scan(self) -> AsyncIterator[RefreshToken]:
+        async for key in REDIS.scan_iter(
+            match=_glob_escape(TOKENS.prefix) + "*", count=BATCH_SIZE
+        ):
+            fields = await REDIS.hgetall(key)
+            if not fields:
+                continue
+            tag, uid = key.decode("utf-8")[len(TOKENS.prefix) :].rsplit(":", 1)
+            yield _record(tag[1:-1], uid, fields)
+
+
+STORES = {"mongo": MongoRefreshStore, "redis": RedisRefreshStore}
+
+# The stores in use by this process, by name.
+_stores: Dict[str, RefreshTokenStore] = {}
+
+
+def get_store(name: Optional[str] = None) -> RefreshTokenStore:
+    """
+    Get the shared refresh token store with the given name, REFRESH_TOKEN_STORE if
+    not given.
+
+    :raises ValueError: if there is no such store
+    """
+    name = name or config.REFRESH_TOKEN_STORE
+    if name not in _stores:
+        if name not in STORES:
+            raise ValueError(f"Unknown refresh token store: {name}")
+        _stores[name] = STORES[name]()
+    return _stores[name]
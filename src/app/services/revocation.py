@@ -0,0 +1,128 @@
+import asyncio
+import datetime
+import logging
+import time
+
+from redis.exceptions import RedisError
+
+from app import config
+from app.io.redis_interface import REDIS, Namespace
+from app.services.background import BackgroundTask
+from app.services.cache import BloomFilter
+
+# Refresh tokens that may no longer be used, for verifying them without reading
+# the refresh token store. An entry names one token, every token of one user of an
+# app, or every token of an app. Entries are kept in a sorted set scored by when
+# they stop mattering (when the tokens they revoke would have expired anyway), and
+# each worker mirrors the set into a bloom filter. A token that might be in the
+# filter gets the full check against the store, which is always correct, so false
+# positives only cost a read. Revocations are recorded even when stateless refresh
+# is off, so turning it on can't bring back tokens that were already revoked.
+REVOCATIONS = Namespace("revocation")
+REVOKED = REVOCATIONS.key("revoked")
+REVOCATION_CHANNEL = "purpleauth:refresh:revoked"
+
+_filter = BloomFilter(config.REVOCATION_FILTER_CAPACITY)
+# Until the filter has been loaded, and whenever revocations might have been
+# missed, every token is treated as possibly revoked.
+_ready = False
+_listener = BackgroundTask()
+
+
+def token_entry(app_id: str, uid: str) -> str:
+    return f"token:{app_id}:{uid}"
+
+
+def user_entry(app_id: str, email: str) -> str:
+    return f"user:{app_id}:{email}"
+
+
+def app_entry(app_id: str) -> str:
+    return f"app:{app_id}"
+
+
+async def revoke(*entries: str, until: datetime.datetime) -> None:
+    """
+    Record revocations and tell every worker about them. Call this before deleting
+    the tokens from the store, so a failure leaves them usable rather than
+    deleted but still accepted by stateless verification.
+
+    :param entries: what to revoke, from token_entry, user_entry or app_entry
+    :param until: when the revoked tokens expire, after which the entries can go
+    :raises RedisError: if the revocation couldn't be recorded
+    """
+    _filter.update(entries)
+    await REDIS.zadd(REVOKED, {entry: until.timestamp() for entry in entries})
+    for entry in entries:
+        await REDIS.publish(REVOCATION_CHANNEL, entry)
+
+
+def might_be_revoked(app_id: str, email: str, uid: str) -> bool:
+    """
+    Check a refresh token against this worker's filter.
+
+    :return: False only if the token has definitely not been revoked
+    """
+    if not _ready:
+        return True
+    return (
+        token_entry(app_id, uid) in _filter
+        or user_entry(app_id, email) in _filter
+        or app_entry(app_id) in _filter
+    )
+
+
+async def rebuild_filter() -> int:
+    """
+    Replace this worker's filter with one built from the current revocations,
+    dropping any that no longer matter.
+
+    :return: how many revocations are in the new filter
+    """
+    global _filter
+    now = time.time()
+    await REDIS.zremrangebyscore(REVOKED, "-inf", now)
+    entries = await REDIS.zrangebyscore(REVOKED, now, "+inf")
+    new_filter = BloomFilter(max(config.REVOCATION_FILTER_CAPACITY, 2 * len(entries)))
+    new_filter.update(entry.decode("utf-8") for entry in entries)
+    _filter = new_filter
+    return len(entries)
+
+
+async def listen_for_revocations() -> None:
+    """Keep this worker's filter up to date with revocations made by any worker."""
+    global _ready
+    while True:
+        pubsub = REDIS.pubsub()
+        try:
+            await pubsub.subscribe(REVOCATION_CHANNEL)
+            # Revocations published from here on arrive as messages, and everything
+            # before is in the sorted set, so nothing falls between the two.
+            await rebuild_filter()
+            _ready = True
+            rebuild_at = time.monotonic() + config.REVOCATION_REBUILD_SECONDS
+            while True:
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0
+                )
+                if message is not None and message["type"] == "message":
+                    _filter.add(message["data"].decode("utf-8"))
+                if time.monotonic() >= rebuild_at:
+                    await rebuild_filter()
+                    rebuild_at = time.monotonic() + config.REVOCATION_REBUILD_SECONDS
+        except RedisError as err:
+            logging.warning(f"Lost refresh token revocation subscription: {err}")
+            _ready = False
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.reset()
+
+
+def start_listener() -> None:
+    _listener.start(listen_for_revocations)
+
+
+async def stop_listener() -> None:
+    global _ready
+    _ready = False
+    await _listener.stop()
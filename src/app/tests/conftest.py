@@ -1,5 +1,5 @@
-import datetime
 import uuid
+from unittest.mock import AsyncMock
 
 import jwcrypto.jwk as jwk
 import mongox
@@ -9,7 +9,9 @@ from fastapi.testclient import TestClient
 
 from app.models.client_app_model import ClientApp
 from app.main import app
-from app.security.context import PWD_CONTEXT
+from app.portal.services.user_cache import USER_CACHE
+from app.security.context import PWD_CONTEXT, SECRET_CONTEXT
+from app.services.client_app_cache import CLIENT_APP_CACHE
 
 
 @pytest.fixture(autouse=True)
@@ -18,13 +20,46 @@ def random_seed(faker):
     faker.random.seed()
 
 
+@pytest.fixture(autouse=True)
+def clear_client_app_cache(mocker):
+    """Keep cached apps from leaking between tests and never publish to redis."""
+    CLIENT_APP_CACHE.clear()
+    mocker.patch("app.services.client_app_cache.REDIS", new_callable=AsyncMock)
+    yield
+    CLIENT_APP_CACHE.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_user_cache():
+    """Keep users resolved from one test's token from leaking into the next."""
+    USER_CACHE.clear()
+    yield
+    USER_CACHE.clear()
+
+
 @pytest.fixture
 def test_client():
     return TestClient(app)
 
 
 @pytest.fixture
-def create_fake_client_app(faker, mocker):
+def fake_quota(mocker):
+    """Apply the atomic quota updates to the fake apps instead of the database."""
+    apps = {}
+
+    async def _use_quota(app_id):
+        _app = apps.get(app_id)
+        if _app is None or _app.quota < 1:
+            return None
+        _app.quota -= 1
+        return _app.quota
+
+    mocker.patch("app.services.quota.use_quota", side_effect=_use_quota)
+    return apps
+
+
+@pytest.fixture
+def create_fake_client_app(faker, mocker, fake_quota):
     def _create(
         app_id=None,
         refresh=False,
@@ -44,6 +79,7 @@ def create_fake_client_app(faker, mocker):
         key = jwk.JWK.generate(kty="EC", size=2048)
         mocker.patch("mongox.Model.delete")
         mocker.patch("mongox.Model.save")
+        mocker.patch("app.models.client_app_model.ClientApp.save_settings")
         _app = ClientApp(
             name=app_name,
             app_id=app_id,
@@ -64,6 +100,7 @@ def create_fake_client_app(faker, mocker):
         if refresh:
             _app.set_refresh_key(jwk.JWK.generate(kty="EC", size=4096))
             _app.refresh_token_expire_hours = refresh_expire or 24
+        fake_quota[app_id] = _app
         return _app
 
     return _create
@@ -170,37 +207,6 @@ def fake_client_app_low_quota(
     return _fake
 
 
-@pytest.fixture
-def fake_client_app_low_quota_notified_today(
-    create_fake_client_app, create_fake_queryset, monkeypatch
-):
-    _fake = create_fake_client_app(
-        quota=5, low_quota_last_notified=datetime.datetime.today()
-    )
-
-    def _fake_query(*_args):
-        return create_fake_queryset(get_return=_fake)
-
-    monkeypatch.setattr("app.dependencies.ClientApp.query", _fake_query)
-
-    return _fake
-
-
-@pytest.fixture
-def fake_client_app_low_quota_notified_yesterday(
-    create_fake_client_app, create_fake_queryset, monkeypatch
-):
-    yesterday = datetime.datetime.today() - datetime.timedelta(days=1, hours=1)
-    _fake = create_fake_client_app(quota=5, low_quota_last_notified=yesterday)
-
-    def _fake_query(*_args):
-        return create_fake_queryset(get_return=_fake)
-
-    monkeypatch.setattr("app.dependencies.ClientApp.query", _fake_query)
-
-    return _fake
-
-
 @pytest.fixture
 def fake_client_app_low_quota_custom_threshold(
     create_fake_client_app, create_fake_queryset, monkeypatch
@@ -260,3 +266,8 @@ def fake_app_id():
 @pytest.fixture
 def pwd_context():
     return PWD_CONTEXT
+
+
+@pytest.fixture
+def secret_context():
+    return SECRET_CONTEXT
@@ -1,8 +1,13 @@
+import asyncio
+import json
+import threading
+
 import pytest
+from aiohttp import web
 from aioresponses import aioresponses
 
 from app import config
-from app.io import email as io_email
+from app.io import email as io_email, mailgun_standin, smtp_standin
 
 
 @pytest.fixture
@@ -59,3 +64,411 @@ async def test_send_with_reply_to(mock_aioresponse):
 
     request = list(mock_aioresponse.requests.values())[0][0]
     assert request.kwargs["data"]["h:Reply-To"] == "reply@example.com"
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(config, "EMAIL_RETRY_BACKOFF", 0)
+
+
+@pytest.mark.asyncio
+async def test_send_retries_temporary_failures(mock_aioresponse, no_backoff):
+    mock_aioresponse.post(config.MAILGUN_ENDPOINT, status=503)
+    mock_aioresponse.post(config.MAILGUN_ENDPOINT, status=200)
+
+    await io_email.send(
+        to="test@example.com",
+        subject="Test Subject",
+        text="Test text",
+        from_name="Test Sender",
+    )
+
+    assert len(list(mock_aioresponse.requests.values())[0]) == 2
+
+
+@pytest.mark.asyncio
+async def test_send_gives_up_after_retries(mock_aioresponse, no_backoff):
+    for _ in range(config.EMAIL_RETRIES + 1):
+        mock_aioresponse.post(config.MAILGUN_ENDPOINT, status=503, body="Down")
+
+    with pytest.raises(io_email.EmailError) as error_info:
+        await io_email.send(
+            to="test@example.com",
+            subject="Test Subject",
+            text="Test text",
+            from_name="Test Sender",
+        )
+
+    assert str(error_info.value) == "Something went wrong: Down"
+
+
+@pytest.mark.asyncio
+async def test_send_doesnt_retry_rejected_message(mock_aioresponse, no_backoff):
+    mock_aioresponse.post(config.MAILGUN_ENDPOINT, status=400, body="Bad Request")
+
+    with pytest.raises(io_email.EmailRejected):
+        await io_email.send(
+            to="test@example.com",
+            subject="Test Subject",
+            text="Test text",
+            from_name="Test Sender",
+        )
+
+    assert len(list(mock_aioresponse.requests.values())[0]) == 1
+
+
+@pytest.fixture
+async def standin(monkeypatch):
+    app = mailgun_standin.create_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    monkeypatch.setattr(
+        config, "MAILGUN_ENDPOINT", f"http://127.0.0.1:{port}/v3/example/messages"
+    )
+    yield app
+    await io_email.shutdown()
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_send_reuses_connection(standin):
+    for i in range(3):
+        await io_email.send(
+            to=f"test{i}@example.com",
+            subject="Test Subject",
+            text="Test text",
+            from_name="Test Sender",
+        )
+
+    assert [message["to"] for message in standin["messages"]] == [
+        "test0@example.com",
+        "test1@example.com",
+        "test2@example.com",
+    ]
+    assert len(standin["connections"]) == 1
+
+
+async def _in_loop(function):
+    return function()
+
+
+def test_session_from_stopped_loop_is_let_go():
+    transport = io_email.MailgunTransport()
+
+    old = asyncio.run(_in_loop(transport.get_session))
+    new = asyncio.run(_in_loop(transport.get_session))
+
+    assert old.closed
+    assert new is not old
+    asyncio.run(transport.shutdown())
+
+
+@pytest.mark.asyncio
+async def test_session_from_running_loop_is_closed_there():
+    transport = io_email.MailgunTransport()
+    other_loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=other_loop.run_forever)
+    thread.start()
+    try:
+        old = asyncio.run_coroutine_threadsafe(
+            _in_loop(transport.get_session), other_loop
+        ).result()
+
+        transport.get_session()
+
+        # The close was handed to the other loop, give it a moment to run.
+        for _ in range(100):
+            if old.closed:
+                break
+            await asyncio.sleep(0.01)
+        assert old.closed
+    finally:
+        other_loop.call_soon_threadsafe(other_loop.stop)
+        thread.join()
+        other_loop.close()
+        await transport.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_send_batch(mock_aioresponse):
+    mock_aioresponse.post(config.MAILGUN_ENDPOINT, status=200)
+
+    await io_email.send_batch(
+        {"a@example.com": {"code": "1"}, "b@example.com": {"code": "2"}},
+        subject="Test Subject",
+        text="Your code is %recipient.code%",
+        from_name="Test Sender",
+    )
+
+    request = list(mock_aioresponse.requests.values())[0][0]
+    data = request.kwargs["data"]
+    assert ("to", "a@example.com") in data
+    assert ("to", "b@example.com") in data
+    assert ("text", "Your code is %recipient.code%") in data
+    assert json.loads(dict(data)["recipient-variables"]) == {
+        "a@example.com": {"code": "1"},
+        "b@example.com": {"code": "2"},
+    }
+
+
+@pytest.mark.asyncio
+async def test_batcher_groups_same_template(mocker):
+    mock_send = mocker.patch.object(io_email.MailgunTransport, "send")
+    mock_send_batch = mocker.patch.object(io_email.MailgunTransport, "send_batch")
+    batcher = io_email.Batcher(window=0.01)
+
+    await asyncio.gather(
+        batcher.send(
+            "a@example.com",
+            "Subject",
+            "Code %recipient.code%",
+            "App",
+            variables={"code": "1"},
+        ),
+        batcher.send(
+            "b@example.com",
+            "Subject",
+            "Code %recipient.code%",
+            "App",
+            variables={"code": "2"},
+        ),
+        batcher.send("c@example.com", "Other", "Hello", "App"),
+    )
+
+    mock_send_batch.assert_called_once_with(
+        {"a@example.com": {"code": "1"}, "b@example.com": {"code": "2"}},
+        "Subject",
+        "Code %recipient.code%",
+        "App",
+        None,
+    )
+    mock_send.assert_called_once_with("c@example.com", "Other", "Hello", "App", None)
+
+
+@pytest.mark.asyncio
+async def test_batcher_sends_rejected_batch_one_by_one(mocker):
+    mocker.patch.object(
+        io_email.MailgunTransport,
+        "send_batch",
+        side_effect=io_email.EmailRejected("bad address"),
+    )
+
+    async def _send(to, *_args):
+        if to == "bad@example.com":
+            raise io_email.EmailRejected("bad address")
+
+    mock_send = mocker.patch.object(
+        io_email.MailgunTransport, "send", side_effect=_send
+    )
+    batcher = io_email.Batcher(window=0.01)
+
+    results = await asyncio.gather(
+        batcher.send("a@example.com", "Subject", "Text", "App"),
+        batcher.send("bad@example.com", "Subject", "Text", "App"),
+        batcher.send("b@example.com", "Subject", "Text", "App"),
+        return_exceptions=True,
+    )
+
+    assert results[0] is None
+    assert isinstance(results[1], io_email.EmailRejected)
+    assert results[2] is None
+    assert mock_send.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_batcher_splits_at_batch_limit(mocker, monkeypatch):
+    monkeypatch.setattr(io_email.MailgunTransport, "batch_limit", 2)
+    mock_send_batch = mocker.patch.object(io_email.MailgunTransport, "send_batch")
+    mock_send = mocker.patch.object(io_email.MailgunTransport, "send")
+    batcher = io_email.Batcher(window=0.01)
+
+    await asyncio.gather(
+        *(
+            batcher.send(f"{i}@example.com", "Subject", "Text", "App")
+            for i in range(3)
+        )
+    )
+
+    assert mock_send_batch.call_count == 1
+    assert mock_send.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_batcher_renders_single_message(mocker):
+    mock_send = mocker.patch.object(io_email.MailgunTransport, "send")
+    batcher = io_email.Batcher(window=0)
+
+    await batcher.send(
+        "a@example.com",
+        "Code for %recipient.app%",
+        "Code %recipient.code%",
+        "App",
+        variables={"app": "Test", "code": "1"},
+    )
+
+    mock_send.assert_called_once_with(
+        "a@example.com", "Code for Test", "Code 1", "App", None
+    )
+
+
+@pytest.mark.asyncio
+async def test_batcher_failure_reaches_every_sender(mocker):
+    mocker.patch.object(
+        io_email.MailgunTransport, "send_batch", side_effect=io_email.EmailError("down")
+    )
+    batcher = io_email.Batcher(window=0.01)
+
+    results = await asyncio.gather(
+        batcher.send("a@example.com", "Subject", "Text", "App"),
+        batcher.send("b@example.com", "Subject", "Text", "App"),
+        return_exceptions=True,
+    )
+
+    assert all(isinstance(result, io_email.EmailError) for result in results)
+
+
+@pytest.fixture
+async def smtp_server():
+    server = smtp_standin.SMTPStandin(username="user", password="secret")
+    listener = await server.start()
+    server.port = listener.sockets[0].getsockname()[1]
+    yield server
+    listener.close()
+    await listener.wait_closed()
+
+
+@pytest.fixture
+async def smtp_transport(smtp_server):
+    transport = io_email.SMTPTransport(
+        host="127.0.0.1",
+        port=smtp_server.port,
+        username="user",
+        password="secret",
+        tls="none",
+        pool_size=2,
+    )
+    yield transport
+    await transport.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_smtp_send(smtp_server, smtp_transport):
+    await smtp_transport.send(
+        to="test@example.com",
+        subject="Test Subject",
+        text="Test text",
+        from_name="Test Sender",
+        reply_to="reply@example.com",
+    )
+
+    ((sender, recipients, data),) = smtp_server.messages
+    assert sender == config.FROM_ADDRESS
+    assert recipients == ["test@example.com"]
+    assert b"Subject: Test Subject" in data
+    assert b"Reply-To: reply@example.com" in data
+    assert b"Test text" in data
+
+
+@pytest.mark.asyncio
+async def test_smtp_reuses_connections(smtp_server, smtp_transport):
+    await asyncio.gather(
+        *(
+            smtp_transport.send(f"test{i}@example.com", "Subject", "Text", "App")
+            for i in range(10)
+        )
+    )
+
+    assert len(smtp_server.messages) == 10
+    assert len(smtp_server.connections) <= 2
+    assert smtp_server.logins == len(smtp_server.connections)
+
+
+@pytest.mark.asyncio
+async def test_smtp_reconnects_after_server_closes(smtp_server, smtp_transport):
+    await smtp_transport.send("a@example.com", "Subject", "Text", "App")
+    for connection in smtp_transport._idle:
+        connection.close()
+
+    await smtp_transport.send("b@example.com", "Subject", "Text", "App")
+
+    assert [recipients for _, recipients, _ in smtp_server.messages] == [
+        ["a@example.com"],
+        ["b@example.com"],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_smtp_send_batch_renders_each_message(smtp_server, smtp_transport):
+    await smtp_transport.send_batch(
+        {"a@example.com": {"code": "1"}, "b@example.com": {"code": "2"}},
+        subject="Test Subject",
+        text="Your code is %recipient.code%",
+        from_name="Test Sender",
+    )
+
+    bodies = {
+        recipients[0]: data for _, recipients, data in smtp_server.messages
+    }
+    assert b"Your code is 1" in bodies["a@example.com"]
+    assert b"Your code is 2" in bodies["b@example.com"]
+
+
+@pytest.mark.asyncio
+async def test_smtp_refused_recipient_is_rejected(smtp_server, smtp_transport):
+    smtp_server.refused.add("bad@example.com")
+
+    with pytest.raises(io_email.EmailRejected):
+        await smtp_transport.send("bad@example.com", "Subject", "Text", "App")
+    assert smtp_server.messages == []
+
+
+@pytest.mark.asyncio
+async def test_batcher_only_fails_refused_smtp_recipient(smtp_server, smtp_transport):
+    smtp_server.refused.add("bad@example.com")
+    batcher = io_email.Batcher(window=0.01, transport=smtp_transport)
+
+    results = await asyncio.gather(
+        batcher.send("a@example.com", "Subject", "Text", "App"),
+        batcher.send("bad@example.com", "Subject", "Text", "App"),
+        batcher.send("b@example.com", "Subject", "Text", "App"),
+        return_exceptions=True,
+    )
+
+    assert results[0] is None
+    assert isinstance(results[1], io_email.EmailRejected)
+    assert results[2] is None
+    assert sorted(recipients for _, recipients, _ in smtp_server.messages) == [
+        ["a@example.com"],
+        ["b@example.com"],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_smtp_bad_login(smtp_server):
+    transport = io_email.SMTPTransport(
+        host="127.0.0.1",
+        port=smtp_server.port,
+        username="user",
+        password="wrong",
+        tls="none",
+    )
+
+    with pytest.raises(io_email.EmailError):
+        await transport.send("a@example.com", "Subject", "Text", "App")
+    assert smtp_server.messages == []
+
+
+def test_transport_must_implement_send():
+    class Incomplete(io_email.Transport):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_get_transport_unknown():
+    with pytest.raises(io_email.EmailError):
+        io_email.get_transport("pigeon")
@@ -0,0 +1,60 @@
+import datetime
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app import config
+from app.io import redis_interface
+
+
+@pytest.fixture
+def mocked_redis(mocker):
+    return mocker.patch("app.io.redis_interface.REDIS", new_callable=AsyncMock)
+
+
+def test_namespace_prefixes_keys():
+    store = redis_interface.Namespace("things")
+
+    assert store.key("abc") == f"{config.REDIS_KEY_PREFIX}:things:abc"
+
+
+def test_stores_have_separate_namespaces():
+    assert redis_interface.OTP_STORE.key("a") != redis_interface.MAGIC_STORE.key("a")
+
+
+@pytest.mark.asyncio
+async def test_namespace_commands_use_prefixed_keys(mocked_redis):
+    store = redis_interface.Namespace("things")
+    lifetime = datetime.timedelta(minutes=5)
+
+    await store.set("abc", "value", ex=lifetime)
+    await store.get("abc")
+    await store.expire("abc", lifetime)
+    await store.delete("abc", "def")
+
+    mocked_redis.set.assert_awaited_once_with(store.key("abc"), "value", ex=lifetime)
+    mocked_redis.get.assert_awaited_once_with(store.key("abc"))
+    mocked_redis.expire.assert_awaited_once_with(store.key("abc"), lifetime)
+    mocked_redis.delete.assert_awaited_once_with(store.key("abc"), store.key("def"))
+
+
+@pytest.mark.asyncio
+async def test_delete_if_equal_runs_script_on_prefixed_key(mocker):
+    script = mocker.patch(
+        "app.io.redis_interface._delete_if_equal", new=AsyncMock(return_value=1)
+    )
+    store = redis_interface.Namespace("things")
+
+    assert await store.delete_if_equal("abc", "value") is True
+
+    script.assert_awaited_once_with(keys=[store.key("abc")], args=["value"])
+
+
+@pytest.mark.asyncio
+async def test_delete_if_equal_reports_miss(mocker):
+    mocker.patch(
+        "app.io.redis_interface._delete_if_equal", new=AsyncMock(return_value=0)
+    )
+    store = redis_interface.Namespace("things")
+
+    assert await store.delete_if_equal("abc", "value") is False
@@ -0,0 +1,81 @@
+import datetime
+
+from jwcrypto import jwk
+
+from app.models import client_app_model
+
+
+def test_get_key_is_cached(create_fake_client_app, mocker):
+    fake_app = create_fake_client_app(refresh=True)
+    spy_decrypt = mocker.spy(client_app_model.FERNET, "decrypt")
+
+    assert fake_app.get_key() is fake_app.get_key()
+    assert fake_app.get_refresh_key() is fake_app.get_refresh_key()
+    assert spy_decrypt.call_count == 2
+
+
+def test_get_key_misses_after_rotation(create_fake_client_app):
+    fake_app = create_fake_client_app()
+    old_key = fake_app.get_key()
+
+    fake_app.set_key(jwk.JWK.generate(kty="EC", size=2048))
+
+    assert fake_app.get_key() != old_key
+
+
+def test_get_refresh_key_disabled(create_fake_client_app):
+    fake_app = create_fake_client_app()
+
+    assert fake_app.get_refresh_key() is None
+
+
+def test_rotate_key_keeps_previous_key(create_fake_client_app):
+    fake_app = create_fake_client_app()
+    old_key = fake_app.get_key()
+
+    fake_app.rotate_key(
+        jwk.JWK.generate(kty="EC", size=2048),
+        datetime.datetime.now() + datetime.timedelta(minutes=5),
+    )
+
+    assert fake_app.get_key() != old_key
+    assert fake_app.get_key(old_key.key_id) == old_key
+    assert [key.key_id for key in fake_app.get_verification_keys()] == [
+        fake_app.get_key().key_id,
+        old_key.key_id,
+    ]
+
+
+def test_rotate_key_previous_key_retires(create_fake_client_app):
+    fake_app = create_fake_client_app()
+    old_key = fake_app.get_key()
+
+    fake_app.rotate_key(
+        jwk.JWK.generate(kty="EC", size=2048),
+        datetime.datetime.now() - datetime.timedelta(minutes=5),
+    )
+
+    assert fake_app.get_key(old_key.key_id) is None
+    assert fake_app.get_verification_keys() == [fake_app.get_key()]
+
+
+def test_get_key_unknown_kid(create_fake_client_app):
+    fake_app = create_fake_client_app()
+
+    assert fake_app.get_key("unknown") is None
+
+
+def test_generate_key_algorithms():
+    for algorithm in client_app_model.ALGORITHMS:
+        key = client_app_model.generate_key(algorithm)
+
+        assert client_app_model.key_algorithm(key) == algorithm
+
+
+def test_change_refresh_uses_app_algorithm(create_fake_client_app):
+    fake_app = create_fake_client_app()
+    fake_app.algorithm = "EdDSA"
+
+    fake_app.change_refresh(True)
+
+    assert client_app_model.key_algorithm(fake_app.get_refresh_key()) == "EdDSA"
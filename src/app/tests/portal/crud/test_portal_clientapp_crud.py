@@ -0,0 +1,88 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from pymongo import ReturnDocument
+
+from app.models.client_app_model import ClientApp
+from app.portal.crud import clientapp_crud
+from app.services import quota, revocation
+
+
+@pytest.fixture
+def stored_app(fake_app_id, mocker):
+    """
+    An app as it is stored, with just enough of a collection to take quota from
+    it and save settings to it.
+    """
+    _app = ClientApp(
+        name="Old name",
+        app_id=str(fake_app_id),
+        owner="owner@example.com",
+        redirect_url="http://localhost",
+        quota=500,
+    )
+    document = _app.dict(exclude={"id"})
+
+    async def _update_one(query, update):
+        assert query == {"app_id": _app.app_id}
+        document.update(update["$set"])
+
+    async def _find_one_and_update(query, update, projection, return_document):
+        assert return_document == ReturnDocument.AFTER
+        if document["quota"] < query["quota"]["$gte"]:
+            return None
+        document["quota"] += update["$inc"]["quota"]
+        return {"quota": document["quota"]}
+
+    collection = MagicMock()
+    collection.update_one = AsyncMock(side_effect=_update_one)
+    collection.find_one_and_update = AsyncMock(side_effect=_find_one_and_update)
+    mocker.patch("app.models.client_app_model.raw_collection", return_value=collection)
+    mocker.patch("app.services.quota.raw_collection", return_value=collection)
+    return document
+
+
+@pytest.mark.asyncio
+async def test_update_client_app_keeps_concurrent_quota_use(stored_app, mocker):
+    read = ClientApp(**stored_app)
+    mocker.patch(
+        "app.portal.crud.clientapp_crud.get_client_app",
+        new=AsyncMock(return_value=read),
+    )
+    # Someone authenticates between the edit reading the app and saving it.
+    assert await quota._use_mongo_quota(read.app_id) == read.quota - 1
+
+    await clientapp_crud.update_client_app(
+        read.app_id,
+        MagicMock(),
+        "New name",
+        "http://localhost/new",
+        False,
+        None,
+        None,
+        20,
+    )
+
+    assert stored_app["name"] == "New name"
+    assert stored_app["low_quota_threshold"] == 20
+    assert stored_app["quota"] == read.quota - 1
+
+
+@pytest.mark.asyncio
+async def test_turning_off_rotation_revokes_app_tokens(stored_app, mocker):
+    stored_app["rotate_refresh_tokens"] = True
+    stored_app["refresh_token_expire_hours"] = 24
+    read = ClientApp(**stored_app)
+    mocker.patch(
+        "app.portal.crud.clientapp_crud.get_client_app",
+        new=AsyncMock(return_value=read),
+    )
+    revoke = mocker.patch("app.portal.crud.clientapp_crud.revocation.revoke")
+
+    await clientapp_crud.update_client_app(
+        read.app_id, MagicMock(), "Name", "http://localhost", True, 24, None, 10
+    )
+
+    (entry,), _ = revoke.call_args
+    assert entry == revocation.app_entry(read.app_id)
+    assert stored_app["rotate_refresh_tokens"] is False
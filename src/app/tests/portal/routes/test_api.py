@@ -256,6 +256,38 @@ async def test_rotate_keys_rotates_refresh_key(user1_client, user1_app1, fake_co
     assert updated_app.get_refresh_key() != old_key
 
 
+@pytest.mark.asyncio
+async def test_rotate_keys_keeps_old_key(user1_client, user1_app1, fake_cookies):
+    old_key = user1_app1.get_key()
+
+    user1_client.post(
+        f"/api/apps/{user1_app1.app_id}/rotate-keys", cookies=fake_cookies
+    )
+
+    updated_app = await ClientApp.query(ClientApp.app_id == user1_app1.app_id).get()
+
+    assert updated_app.get_key(old_key.key_id) == old_key
+
+
+@pytest.mark.asyncio
+async def test_rotate_keys_revoke_drops_old_key(
+    user1_client, user1_app1, fake_cookies
+):
+    old_key = user1_app1.get_key()
+
+    response = user1_client.post(
+        f"/api/apps/{user1_app1.app_id}/rotate-keys",
+        cookies=fake_cookies,
+        data={"revoke": "true"},
+    )
+
+    assert response.status_code == 200
+
+    updated_app = await ClientApp.query(ClientApp.app_id == user1_app1.app_id).get()
+
+    assert updated_app.get_key(old_key.key_id) is None
+
+
 @pytest.mark.asyncio
 async def test_rotate_keys_fails_unauthorized(user2_client, user1_app1, fake_cookies):
     old_key = user1_app1.get_key()
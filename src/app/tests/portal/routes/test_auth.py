@@ -320,8 +320,9 @@ def test_start_deletion_protection_fails_unauthenticated(test_client, mocker):
     mock_send_email.assert_not_called()
 
 
-def test_disable_deletion_protection_succeeds(user1_client, fake_cookies, user1):
-    code = deletion_protection.generate_dp_code(user1, "account")
+@pytest.mark.asyncio
+async def test_disable_deletion_protection_succeeds(user1_client, fake_cookies, user1):
+    code = await deletion_protection.generate_dp_code(user1, "account")
 
     response = user1_client.post(
         "/auth/me/deletion-protection", data={"code": code}, cookies=fake_cookies
@@ -342,11 +343,12 @@ def test_disable_deletion_protection_fails_unauthorized(test_client):
     assert response.status_code == 401
 
 
-def test_disable_deletion_protection_fails_wrong_code(
+@pytest.mark.asyncio
+async def test_disable_deletion_protection_fails_wrong_code(
     user1_client, fake_cookies, user1
 ):
     # This just ensures that there is a code and it fails because it doesn't match
-    deletion_protection.generate_dp_code(user1, "account")
+    await deletion_protection.generate_dp_code(user1, "account")
 
     response = user1_client.post(
         "/auth/me/deletion-protection", data={"code": "123456"}, cookies=fake_cookies
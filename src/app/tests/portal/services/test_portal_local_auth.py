@@ -0,0 +1,106 @@
+import datetime
+
+import purple_auth_client as pac
+import pytest
+import python_jwt as jwt
+
+from app import config
+from app.portal.services.local_auth import LocalAuthClient
+from app.security import token as security_token
+
+
+@pytest.fixture
+def local_client(fake_refresh_client_app):
+    return LocalAuthClient(fake_refresh_client_app.app_id)
+
+
+@pytest.mark.asyncio
+async def test_verify(local_client, fake_refresh_client_app, fake_email):
+    id_token = security_token.generate(fake_email, fake_refresh_client_app)
+
+    result = await local_client.verify(id_token)
+
+    assert result["claims"]["sub"] == fake_email
+    assert result["headers"]["alg"] == "ES256"
+
+
+@pytest.mark.asyncio
+async def test_verify_expired(local_client, fake_refresh_client_app, fake_email):
+    id_token = jwt.generate_jwt(
+        {"iss": f"{config.ISSUER}/app/{fake_refresh_client_app.app_id}"},
+        fake_refresh_client_app.get_key(),
+        "ES256",
+        datetime.timedelta(minutes=-1),
+    )
+
+    with pytest.raises(pac.AuthenticationFailure) as error_info:
+        await local_client.verify(id_token)
+
+    assert str(error_info.value) == "expired"
+
+
+@pytest.mark.asyncio
+async def test_verify_invalid(local_client):
+    with pytest.raises(pac.AuthenticationFailure):
+        await local_client.verify("not a token")
+
+
+@pytest.mark.asyncio
+async def test_verify_doesnt_make_requests(
+    local_client, fake_refresh_client_app, mocker
+):
+    mock_session = mocker.patch("aiohttp.ClientSession")
+    id_token = security_token.generate("test@example.com", fake_refresh_client_app)
+
+    await local_client.verify(id_token)
+
+    mock_session.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_authenticate_otp(local_client, mocker):
+    mock_request = mocker.patch("app.routes.otp.request_otp")
+
+    await local_client.authenticate("test@example.com", "otp")
+
+    assert mock_request.call_args[0][0].email == "test@example.com"
+
+
+@pytest.mark.asyncio
+async def test_authenticate_invalid_flow(local_client):
+    with pytest.raises(pac.InvalidAuthFlow):
+        await local_client.authenticate("test@example.com", "carrier-pigeon")
+
+
+@pytest.mark.asyncio
+async def test_submit_code(local_client, fake_refresh_client_app, mocker):
+    mocker.patch("app.security.otp.verify", return_value=True)
+    mocker.patch(
+        "app.security.token.generate_refresh_token", return_value="refresh token"
+    )
+
+    tokens = await local_client.submit_code("test@example.com", "123456")
+
+    assert tokens["refresh_token"] == "refresh token"
+    _, claims = security_token.verify(tokens["id_token"], fake_refresh_client_app)
+    assert claims["sub"] == "test@example.com"
+
+
+@pytest.mark.asyncio
+async def test_submit_code_invalid(local_client, mocker):
+    mocker.patch("app.security.otp.verify", return_value=False)
+
+    with pytest.raises(pac.AuthenticationFailure):
+        await local_client.submit_code("test@example.com", "123456")
+
+
+@pytest.mark.asyncio
+async def test_refresh_invalid(local_client):
+    with pytest.raises(pac.AuthenticationFailure):
+        await local_client.refresh("not a token")
+
+
+@pytest.mark.asyncio
+async def test_app_not_found(app_not_found):
+    with pytest.raises(pac.AppNotFound):
+        await LocalAuthClient("12345").verify("token")
@@ -0,0 +1,32 @@
+import time
+
+from app.portal.models.user_model import User
+from app.portal.services import user_cache
+
+
+def test_get_user_returns_copy():
+    user_cache.set_user("token", User(email="test@example.com"))
+
+    cached = user_cache.get_user("token")
+    cached.name = "Changed"
+
+    assert cached.email == "test@example.com"
+    assert user_cache.get_user("token").name != "Changed"
+
+
+def test_set_user_expired_token_isnt_cached():
+    user_cache.set_user("token", User(email="test@example.com"), time.time() - 1)
+
+    assert user_cache.get_user("token") is None
+
+
+def test_invalidate_drops_every_token_for_user():
+    user_cache.set_user("token1", User(email="test@example.com"))
+    user_cache.set_user("token2", User(email="test@example.com"))
+    user_cache.set_user("token3", User(email="other@example.com"))
+
+    user_cache.invalidate("test@example.com")
+
+    assert user_cache.get_user("token1") is None
+    assert user_cache.get_user("token2") is None
+    assert user_cache.get_user("token3").email == "other@example.com"
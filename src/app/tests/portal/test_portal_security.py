@@ -0,0 +1,51 @@
+from unittest.mock import AsyncMock
+
+import pytest
+from starlette.requests import Request
+
+from app.portal import security
+from app.portal.models.user_model import User
+
+
+@pytest.fixture
+def mock_verify(mocker):
+    return mocker.patch.object(
+        security.auth_client,
+        "verify",
+        new=AsyncMock(return_value={"claims": {"sub": "test@example.com"}}),
+    )
+
+
+@pytest.fixture
+def mock_user_lookup(mocker):
+    return mocker.patch(
+        "app.portal.security.user_crud.check_or_create_user_from_email",
+        new=AsyncMock(return_value=User(email="test@example.com")),
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_current_user(mock_verify, mock_user_lookup):
+    request = Request({"type": "http", "headers": []})
+
+    user = await security.get_current_user(request, "token")
+
+    assert user.email == "test@example.com"
+    mock_verify.assert_awaited_once_with("token")
+    mock_user_lookup.assert_awaited_once_with("test@example.com")
+
+
+@pytest.mark.asyncio
+async def test_get_current_user_again_in_request_skips_lookup(
+    mocker, mock_verify, mock_user_lookup
+):
+    request = Request({"type": "http", "headers": []})
+    first = await security.get_current_user(request, "token")
+    get_user = mocker.patch("app.portal.security.user_cache.get_user")
+
+    second = await security.get_current_user(request, "token")
+
+    assert second is first
+    get_user.assert_not_called()
+    mock_verify.assert_awaited_once()
+    mock_user_lookup.assert_awaited_once()
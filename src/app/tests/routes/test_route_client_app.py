@@ -93,3 +93,59 @@ def test_get_client_app_requires_correct_api_key(test_client, fake_client_app):
 
     assert response.status_code == 401
     assert "app_id" not in response.json()
+
+
+def test_legacy_api_key_hash_is_upgraded(
+    test_client, fake_client_app, pwd_context, secret_context, mocker
+):
+    fake_client_app.hashed_api_key = pwd_context.hash("testkey")
+    mock_collection = mocker.patch("app.dependencies.raw_collection").return_value
+    mock_collection.update_one = mocker.AsyncMock()
+
+    response = test_client.get(
+        f"/app/{fake_client_app.app_id}",
+        headers={"Authorization": "Bearer testkey"},
+    )
+
+    assert response.status_code == 200
+    mock_collection.update_one.assert_awaited_once_with(
+        {"app_id": fake_client_app.app_id},
+        {"$set": {"hashed_api_key": secret_context.hash("testkey")}},
+    )
+
+
+def test_get_jwks(test_client, fake_client_app):
+    response = test_client.get(f"/app/{fake_client_app.app_id}/.well-known/jwks.json")
+
+    assert response.status_code == 200
+    assert response.headers["ETag"]
+    assert "max-age" in response.headers["Cache-Control"]
+    (key,) = response.json()["keys"]
+    assert key["kid"] == fake_client_app.get_key().key_id
+    assert "d" not in key
+
+
+def test_get_jwks_not_modified(test_client, fake_client_app):
+    url = f"/app/{fake_client_app.app_id}/.well-known/jwks.json"
+    etag = test_client.get(url).headers["ETag"]
+
+    response = test_client.get(url, headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+
+def test_get_jwks_changed_etag(test_client, fake_client_app):
+    response = test_client.get(
+        f"/app/{fake_client_app.app_id}/.well-known/jwks.json",
+        headers={"If-None-Match": '"stale"'},
+    )
+
+    assert response.status_code == 200
+
+
+def test_get_jwks_not_found(test_client, app_not_found):
+    response = test_client.get(f"/app/{uuid.uuid4()}/.well-known/jwks.json")
+
+    assert response.status_code == 404
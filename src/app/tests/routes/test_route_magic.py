@@ -1,5 +1,6 @@
-import os
+import datetime
 import secrets
+from unittest import mock
 from urllib.parse import quote_plus
 
 import pytest
@@ -42,7 +43,7 @@ def fake_enc_email(fake_email):
 
 def test_request_magic(mocker, test_client, fake_client_app, fake_email):
     fake_link = "http://auth.example.com/test123?secret=12345"
-    mock_send_email = mocker.patch("app.routes.magic.io_email.send")
+    mock_send_email = mocker.patch("app.routes.magic.email_queue.enqueue")
     mock_magic_generate = mocker.patch(
         "app.routes.magic.security_magic.generate",
         return_value=fake_link,
@@ -59,9 +60,11 @@ def test_request_magic(mocker, test_client, fake_client_app, fake_email):
     mock_send_email.assert_called_once_with(
         to=fake_email,
         subject="Your Magic Sign In Link",
-        text=f"Click or copy this link to sign in:\n{fake_link}\nIt will expire "
+        text="Click or copy this link to sign in:\n%recipient.link%\nIt will expire "
         f"in {config.MAGIC_LIFETIME} minutes.\n",
         from_name=fake_client_app.name,
+        variables={"link": fake_link},
+        lifetime=datetime.timedelta(minutes=config.MAGIC_LIFETIME),
     )
     mock_magic_generate.assert_called_once_with(fake_email, fake_client_app.app_id)
 
@@ -71,7 +74,7 @@ def test_request_magic_uses_quota(
 ):
     fca = fake_client_app_use_quota
     fake_link = "http://auth.example.com/test123?secret=12345"
-    _mock_send_email = mocker.patch("app.routes.magic.io_email.send")
+    _mock_send_email = mocker.patch("app.routes.magic.email_queue.enqueue")
     _mock_magic_generate = mocker.patch(
         "app.routes.magic.security_magic.generate",
         return_value=fake_link,
@@ -87,7 +90,8 @@ def test_request_magic_uses_quota(
     assert response.status_code == 200
     assert fca.quota == prev_quota - 1
 
-    fca.save.assert_called()
+    # only the counter is updated, the app document isn't rewritten
+    fca.save.assert_not_called()
 
 
 def test_request_magic_requires_api_key_doesnt_use_quota(
@@ -95,7 +99,7 @@ def test_request_magic_requires_api_key_doesnt_use_quota(
 ):
     fca = fake_client_app_use_quota
     fake_link = "http://auth.example.com/test123?secret=12345"
-    _mock_send_email = mocker.patch("app.routes.magic.io_email.send")
+    _mock_send_email = mocker.patch("app.routes.magic.email_queue.enqueue")
     _mock_magic_generate = mocker.patch(
         "app.routes.magic.security_magic.generate",
         return_value=fake_link,
@@ -118,7 +122,7 @@ def test_request_magic_requires_correct_api_key_doesnt_use_quota(
 ):
     fca = fake_client_app_use_quota
     fake_link = "http://auth.example.com/test123?secret=12345"
-    _mock_send_email = mocker.patch("app.routes.magic.io_email.send")
+    _mock_send_email = mocker.patch("app.routes.magic.email_queue.enqueue")
     _mock_magic_generate = mocker.patch(
         "app.routes.magic.security_magic.generate",
         return_value=fake_link,
@@ -138,14 +142,14 @@ def test_request_magic_requires_correct_api_key_doesnt_use_quota(
 
 
 def test_request_magic_fails_out_of_quota(
-    mocker, test_client, fake_client_app_out_of_quota, fake_email
+    mocker, test_client, fake_email, fake_client_app_out_of_quota
 ):
     fca = fake_client_app_out_of_quota
-    fake_link = "http://auth.example.com/test123?secret=12345"
-    mock_send_email = mocker.patch("app.dependencies.io_email.send")
+    mock_notify = mocker.patch("app.dependencies.notifications.notify_out_of_quota")
+    mock_send_email = mocker.patch("app.routes.magic.email_queue.enqueue")
     _mock_magic_generate = mocker.patch(
         "app.routes.magic.security_magic.generate",
-        return_value=fake_link,
+        return_value="http://auth.example.com/test123?secret=12345",
     )
 
     response = test_client.post(
@@ -155,28 +159,26 @@ def test_request_magic_fails_out_of_quota(
     )
 
     assert response.status_code == 503
-
-    mock_send_email.assert_called_once_with(
-        to=fake_client_app_out_of_quota.owner,
-        subject=f"{fca.name} is out of Authentications",
-        text=f"{fca.name} has reached its quota of "
-        f"authentications. No further authentications will be processed. "
-        f"Please reply to this email to purchase more.\nRick Henry\nRick Henry "
-        f"Development\nhttps://rickhenry.dev",
-        from_name="Purple Authentication",
-        reply_to=os.getenv("WEBMASTER_EMAIL"),
+    assert (
+        response.json()["detail"]
+        == "This app does not have any authentications remaining. Please contact "
+        "your administrator"
     )
 
+    mock_notify.assert_called_once()
+    assert mock_notify.call_args.args[0].app_id == fca.app_id
+    mock_send_email.assert_not_called()
+
 
 def test_request_magic_notifies_low_quota(
-    mocker, test_client, fake_client_app_low_quota, fake_email
+    mocker, test_client, fake_email, fake_client_app_low_quota
 ):
     fca = fake_client_app_low_quota
-    fake_link = "http://auth.example.com/test123?secret=12345"
-    mock_send_email = mocker.patch("app.routes.magic.io_email.send")
+    mock_notify = mocker.patch("app.dependencies.notifications.notify_low_quota")
+    mock_send_email = mocker.patch("app.routes.magic.email_queue.enqueue")
     _mock_magic_generate = mocker.patch(
         "app.routes.magic.security_magic.generate",
-        return_value=fake_link,
+        return_value="http://auth.example.com/test123?secret=12345",
     )
 
     response = test_client.post(
@@ -187,83 +189,21 @@ def test_request_magic_notifies_low_quota(
 
     assert response.status_code == 200
 
-    assert mock_send_email.call_count == 2
-    mock_send_email.assert_any_call(
-        to=fca.owner,
-        subject=f"{fca.name} is almost out of Authentications",
-        text=f"{fca.name} has almost reached its quota of "
-        f"authentications. It will process {fca.quota} more "
-        f"authentications before it stops authenticating users. "
-        f"Please reply to this email to purchase more.\nRick Henry\nRick Henry "
-        f"Development\nhttps://rickhenry.dev",
-        from_name="Purple Authentication",
-        reply_to=os.getenv("WEBMASTER_EMAIL"),
-    )
-
-
-def test_request_magic_notifies_low_quota_once_per_day(
-    mocker, test_client, fake_client_app_low_quota_notified_today, fake_email
-):
-    fca = fake_client_app_low_quota_notified_today
-    fake_link = "http://auth.example.com/test123?secret=12345"
-    mock_send_email = mocker.patch("app.routes.magic.io_email.send")
-    _mock_magic_generate = mocker.patch(
-        "app.routes.magic.security_magic.generate",
-        return_value=fake_link,
-    )
-
-    response = test_client.post(
-        f"/magic/request/{fca.app_id}",
-        json={"email": fake_email},
-        headers={"Authorization": "Bearer testkey"},
-    )
-
-    assert response.status_code == 200
+    # the notification is sent in the background, only the login email is awaited
     assert mock_send_email.call_count == 1
-
-
-def test_request_magic_notifies_low_quota_next_day(
-    mocker, test_client, fake_client_app_low_quota_notified_yesterday, fake_email
-):
-    fca = fake_client_app_low_quota_notified_yesterday
-    fake_link = "http://auth.example.com/test123?secret=12345"
-    mock_send_email = mocker.patch("app.routes.magic.io_email.send")
-    _mock_magic_generate = mocker.patch(
-        "app.routes.magic.security_magic.generate",
-        return_value=fake_link,
-    )
-
-    response = test_client.post(
-        f"/magic/request/{fca.app_id}",
-        json={"email": fake_email},
-        headers={"Authorization": "Bearer testkey"},
-    )
-
-    assert response.status_code == 200
-
-    assert mock_send_email.call_count == 2
-    mock_send_email.assert_any_call(
-        to=fca.owner,
-        subject=f"{fca.name} is almost out of Authentications",
-        text=f"{fca.name} has almost reached its quota of "
-        f"authentications. It will process {fca.quota} more "
-        f"authentications before it stops authenticating users. "
-        f"Please reply to this email to purchase more.\nRick Henry\nRick Henry "
-        f"Development\nhttps://rickhenry.dev",
-        from_name="Purple Authentication",
-        reply_to=os.getenv("WEBMASTER_EMAIL"),
-    )
+    mock_notify.assert_called_once_with(mock.ANY, fca.quota)
+    assert mock_notify.call_args.args[0].app_id == fca.app_id
 
 
 def test_request_magic_notifies_low_quota_custom_threshold(
-    mocker, test_client, fake_client_app_low_quota_custom_threshold, fake_email
+    mocker, test_client, fake_email, fake_client_app_low_quota_custom_threshold
 ):
     fca = fake_client_app_low_quota_custom_threshold
-    fake_link = "http://auth.example.com/test123?secret=12345"
-    mock_send_email = mocker.patch("app.routes.magic.io_email.send")
+    mock_notify = mocker.patch("app.dependencies.notifications.notify_low_quota")
+    mock_send_email = mocker.patch("app.routes.magic.email_queue.enqueue")
     _mock_magic_generate = mocker.patch(
         "app.routes.magic.security_magic.generate",
-        return_value=fake_link,
+        return_value="http://auth.example.com/test123?secret=12345",
     )
 
     response = test_client.post(
@@ -274,29 +214,24 @@ def test_request_magic_notifies_low_quota_custom_threshold(
 
     assert response.status_code == 200
 
-    assert mock_send_email.call_count == 2
-    mock_send_email.assert_any_call(
-        to=fca.owner,
-        subject=f"{fca.name} is almost out of Authentications",
-        text=f"{fca.name} has almost reached its quota of "
-        f"authentications. It will process {fca.quota} more "
-        f"authentications before it stops authenticating users. "
-        f"Please reply to this email to purchase more.\nRick Henry\nRick Henry "
-        f"Development\nhttps://rickhenry.dev",
-        from_name="Purple Authentication",
-        reply_to=os.getenv("WEBMASTER_EMAIL"),
-    )
+    # the notification is sent in the background, only the login email is awaited
+    assert mock_send_email.call_count == 1
+    mock_notify.assert_called_once_with(mock.ANY, fca.quota)
+    assert mock_notify.call_args.args[0].app_id == fca.app_id
 
 
 def test_request_magic_succeeds_unlimited_quota_doesnt_notify(
     mocker, test_client, fake_email, fake_client_app_unlimited
 ):
     fca = fake_client_app_unlimited
-    fake_link = "http://auth.example.com/test123?secret=12345"
-    mock_send_email = mocker.patch("app.dependencies.io_email.send")
+    mock_notify_low = mocker.patch("app.dependencies.notifications.notify_low_quota")
+    mock_notify_out = mocker.patch(
+        "app.dependencies.notifications.notify_out_of_quota"
+    )
+    mock_send_email = mocker.patch("app.routes.magic.email_queue.enqueue")
     _mock_magic_generate = mocker.patch(
         "app.routes.magic.security_magic.generate",
-        return_value=fake_link,
+        return_value="http://auth.example.com/test123?secret=12345",
     )
 
     assert fca.quota == 0
@@ -309,11 +244,13 @@ def test_request_magic_succeeds_unlimited_quota_doesnt_notify(
 
     assert response.status_code == 200
     assert mock_send_email.call_count == 1
+    mock_notify_low.assert_not_called()
+    mock_notify_out.assert_not_called()
     assert fca.quota == 0
 
 
 def test_request_magic_no_app(app_not_found, mocker, test_client, fake_email):
-    mock_send_email = mocker.patch("app.routes.otp.io_email.send")
+    mock_send_email = mocker.patch("app.routes.magic.email_queue.enqueue")
     mock_otp_generate = mocker.patch("app.routes.otp.security_otp.generate")
 
     response = test_client.post(f"/magic/request/12345", json={"email": fake_email})
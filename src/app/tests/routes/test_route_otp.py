@@ -1,8 +1,10 @@
-import os
+import datetime
+from unittest import mock
 from unittest.mock import AsyncMock
 
 import pytest
 
+from app import config
 from app.io import email as io_email
 
 # TODO: test certain routes are not accessible without api key
@@ -37,7 +39,7 @@ def fake_code():
 
 
 def test_request_otp(monkeypatch, mocker, test_client, fake_client_app, fake_email):
-    mock_send_email = mocker.patch("app.routes.otp.io_email.send")
+    mock_send_email = mocker.patch("app.routes.otp.email_queue.enqueue")
     mock_otp_generate = mocker.patch(
         "app.routes.otp.security_otp.generate", return_value="11111111"
     )
@@ -52,14 +54,16 @@ def test_request_otp(monkeypatch, mocker, test_client, fake_client_app, fake_ema
     mock_send_email.assert_called_once_with(
         to=fake_email,
         subject="Your One Time Login Code",
-        text=f"Your code is 11111111\nIt will expire in 5 minutes.\n",
+        text="Your code is %recipient.code%\nIt will expire in 5 minutes.\n",
         from_name=fake_client_app.name,
+        variables={"code": "11111111"},
+        lifetime=datetime.timedelta(minutes=config.OTP_LIFETIME),
     )
     mock_otp_generate.assert_called_once_with(fake_email, fake_client_app.app_id)
 
 
 def test_request_otp_no_app(app_not_found, mocker, test_client, fake_email):
-    mock_send_email = mocker.patch("app.routes.otp.io_email.send")
+    mock_send_email = mocker.patch("app.routes.otp.email_queue.enqueue")
     mock_otp_generate = mocker.patch("app.routes.otp.security_otp.generate")
 
     response = test_client.post(f"/otp/request/12345", json={"email": fake_email})
@@ -72,10 +76,15 @@ def test_request_otp_no_app(app_not_found, mocker, test_client, fake_email):
 def test_request_otp_fails_out_of_quota(
     mocker, test_client, fake_email, fake_client_app_out_of_quota
 ):
-    mock_send_email = mocker.patch("app.dependencies.io_email.send")
+    fca = fake_client_app_out_of_quota
+    mock_notify = mocker.patch("app.dependencies.notifications.notify_out_of_quota")
+    mock_send_email = mocker.patch("app.routes.otp.email_queue.enqueue")
+    _mock_otp_generate = mocker.patch(
+        "app.routes.otp.security_otp.generate", return_value="11111111"
+    )
 
     response = test_client.post(
-        f"/otp/request/{fake_client_app_out_of_quota.app_id}",
+        f"/otp/request/{fca.app_id}",
         json={"email": fake_email},
         headers={"Authorization": "Bearer testkey"},
     )
@@ -87,22 +96,15 @@ def test_request_otp_fails_out_of_quota(
         "your administrator"
     )
 
-    mock_send_email.assert_called_once_with(
-        to=fake_client_app_out_of_quota.owner,
-        subject=f"{fake_client_app_out_of_quota.name} is out of Authentications",
-        text=f"{fake_client_app_out_of_quota.name} has reached its quota of "
-        f"authentications. No further authentications will be processed. "
-        f"Please reply to this email to purchase more.\nRick Henry\nRick Henry "
-        f"Development\nhttps://rickhenry.dev",
-        from_name="Purple Authentication",
-        reply_to=os.getenv("WEBMASTER_EMAIL"),
-    )
+    mock_notify.assert_called_once()
+    assert mock_notify.call_args.args[0].app_id == fca.app_id
+    mock_send_email.assert_not_called()
 
 
 def test_request_otp_uses_quota(
     mocker, test_client, fake_email, fake_client_app_use_quota
 ):
-    _mock_send_email = mocker.patch("app.routes.otp.io_email.send")
+    _mock_send_email = mocker.patch("app.routes.otp.email_queue.enqueue")
     _mock_otp_generate = mocker.patch(
         "app.routes.otp.security_otp.generate", return_value="11111111"
     )
@@ -118,13 +120,14 @@ def test_request_otp_uses_quota(
     assert response.status_code == 200
     assert fake_client_app_use_quota.quota == prev_quota - 1
 
-    fake_client_app_use_quota.save.assert_called()
+    # only the counter is updated, the app document isn't rewritten
+    fake_client_app_use_quota.save.assert_not_called()
 
 
 def test_request_otp_requires_api_key_doesnt_use_quota(
     mocker, test_client, fake_email, fake_client_app_use_quota
 ):
-    _mock_send_email = mocker.patch("app.routes.otp.io_email.send")
+    _mock_send_email = mocker.patch("app.routes.otp.email_queue.enqueue")
     _mock_otp_generate = mocker.patch(
         "app.routes.otp.security_otp.generate", return_value="11111111"
     )
@@ -145,7 +148,7 @@ def test_request_otp_requires_api_key_doesnt_use_quota(
 def test_request_otp_requires_correct_api_key_doesnt_use_quota(
     mocker, test_client, fake_email, fake_client_app_use_quota
 ):
-    _mock_send_email = mocker.patch("app.routes.otp.io_email.send")
+    _mock_send_email = mocker.patch("app.routes.otp.email_queue.enqueue")
     _mock_otp_generate = mocker.patch(
         "app.routes.otp.security_otp.generate", return_value="11111111"
     )
@@ -167,38 +170,9 @@ def test_request_otp_requires_correct_api_key_doesnt_use_quota(
 def test_request_otp_notifies_low_quota(
     mocker, test_client, fake_email, fake_client_app_low_quota
 ):
-    mock_send_email = mocker.patch("app.dependencies.io_email.send")
-    _mock_otp_generate = mocker.patch(
-        "app.routes.otp.security_otp.generate", return_value="11111111"
-    )
-
-    response = test_client.post(
-        f"/otp/request/{fake_client_app_low_quota.app_id}",
-        json={"email": fake_email},
-        headers={"Authorization": "Bearer testkey"},
-    )
-
-    assert response.status_code == 200
-
-    assert mock_send_email.call_count == 2
-    mock_send_email.assert_any_call(
-        to=fake_client_app_low_quota.owner,
-        subject=f"{fake_client_app_low_quota.name} is almost out of Authentications",
-        text=f"{fake_client_app_low_quota.name} has almost reached its quota of "
-        f"authentications. It will process {fake_client_app_low_quota.quota} more "
-        f"authentications before it stops authenticating users. "
-        f"Please reply to this email to purchase more.\nRick Henry\nRick Henry "
-        f"Development\nhttps://rickhenry.dev",
-        from_name="Purple Authentication",
-        reply_to=os.getenv("WEBMASTER_EMAIL"),
-    )
-
-
-def test_request_otp_notifies_low_quota_only_once_per_day(
-    mocker, test_client, fake_email, fake_client_app_low_quota_notified_today
-):
-    fca = fake_client_app_low_quota_notified_today
-    mock_send_email = mocker.patch("app.dependencies.io_email.send")
+    fca = fake_client_app_low_quota
+    mock_notify = mocker.patch("app.dependencies.notifications.notify_low_quota")
+    mock_send_email = mocker.patch("app.routes.otp.email_queue.enqueue")
     _mock_otp_generate = mocker.patch(
         "app.routes.otp.security_otp.generate", return_value="11111111"
     )
@@ -211,45 +185,18 @@ def test_request_otp_notifies_low_quota_only_once_per_day(
 
     assert response.status_code == 200
 
+    # the notification is sent in the background, only the login email is awaited
     assert mock_send_email.call_count == 1
-
-
-def test_request_otp_notifies_low_quota_next_day(
-    mocker, test_client, fake_email, fake_client_app_low_quota_notified_yesterday
-):
-    fca = fake_client_app_low_quota_notified_yesterday
-    mock_send_email = mocker.patch("app.dependencies.io_email.send")
-    _mock_otp_generate = mocker.patch(
-        "app.routes.otp.security_otp.generate", return_value="11111111"
-    )
-
-    response = test_client.post(
-        f"/otp/request/{fca.app_id}",
-        json={"email": fake_email},
-        headers={"Authorization": "Bearer testkey"},
-    )
-
-    assert response.status_code == 200
-
-    assert mock_send_email.call_count == 2
-    mock_send_email.assert_any_call(
-        to=fca.owner,
-        subject=f"{fca.name} is almost out of Authentications",
-        text=f"{fca.name} has almost reached its quota of "
-        f"authentications. It will process {fca.quota} more "
-        f"authentications before it stops authenticating users. "
-        f"Please reply to this email to purchase more.\nRick Henry\nRick Henry "
-        f"Development\nhttps://rickhenry.dev",
-        from_name="Purple Authentication",
-        reply_to=os.getenv("WEBMASTER_EMAIL"),
-    )
+    mock_notify.assert_called_once_with(mock.ANY, fca.quota)
+    assert mock_notify.call_args.args[0].app_id == fca.app_id
 
 
 def test_request_otp_notifies_low_quota_custom_threshold(
     mocker, test_client, fake_email, fake_client_app_low_quota_custom_threshold
 ):
     fca = fake_client_app_low_quota_custom_threshold
-    mock_send_email = mocker.patch("app.dependencies.io_email.send")
+    mock_notify = mocker.patch("app.dependencies.notifications.notify_low_quota")
+    mock_send_email = mocker.patch("app.routes.otp.email_queue.enqueue")
     _mock_otp_generate = mocker.patch(
         "app.routes.otp.security_otp.generate", return_value="11111111"
     )
@@ -262,29 +209,25 @@ def test_request_otp_notifies_low_quota_custom_threshold(
 
     assert response.status_code == 200
 
-    assert mock_send_email.call_count == 2
-    mock_send_email.assert_any_call(
-        to=fca.owner,
-        subject=f"{fca.name} is almost out of Authentications",
-        text=f"{fca.name} has almost reached its quota of "
-        f"authentications. It will process {fca.quota} more "
-        f"authentications before it stops authenticating users. "
-        f"Please reply to this email to purchase more.\nRick Henry\nRick Henry "
-        f"Development\nhttps://rickhenry.dev",
-        from_name="Purple Authentication",
-        reply_to=os.getenv("WEBMASTER_EMAIL"),
-    )
+    # the notification is sent in the background, only the login email is awaited
+    assert mock_send_email.call_count == 1
+    mock_notify.assert_called_once_with(mock.ANY, fca.quota)
+    assert mock_notify.call_args.args[0].app_id == fca.app_id
 
 
 def test_request_otp_succeeds_unlimited_quota_doesnt_notify(
     mocker, test_client, fake_email, fake_client_app_unlimited
 ):
     fca = fake_client_app_unlimited
-    mock_send_email = mocker.patch("app.dependencies.io_email.send")
+    mock_notify_low = mocker.patch("app.dependencies.notifications.notify_low_quota")
+    mock_notify_out = mocker.patch(
+        "app.dependencies.notifications.notify_out_of_quota"
+    )
+    mock_send_email = mocker.patch("app.routes.otp.email_queue.enqueue")
     _mock_otp_generate = mocker.patch(
-        "app.routes.otp.security_otp.generate",
-        return_value="111111",
+        "app.routes.otp.security_otp.generate", return_value="11111111"
     )
+
     assert fca.quota == 0
 
     response = test_client.post(
@@ -295,6 +238,8 @@ def test_request_otp_succeeds_unlimited_quota_doesnt_notify(
 
     assert response.status_code == 200
     assert mock_send_email.call_count == 1
+    mock_notify_low.assert_not_called()
+    mock_notify_out.assert_not_called()
     assert fca.quota == 0
 
 
@@ -1,7 +1,9 @@
+import base64
 from unittest.mock import AsyncMock
 
 import pytest
 
+from app.security import token as security_token
 from app.security.token import TokenVerificationError
 
 
@@ -56,7 +58,7 @@ def test_verify_token_not_found(app_not_found, test_client, mocker):
 def test_refresh_success(fake_refresh_client_app, test_client, mocker):
     verify_mock = mocker.patch(
         "app.routes.token.security_token.verify_refresh_token",
-        return_value="fake_id_token",
+        return_value=("fake_id_token", "test12345"),
         new_callable=AsyncMock,
     )
 
@@ -72,6 +74,22 @@ def test_refresh_success(fake_refresh_client_app, test_client, mocker):
     verify_mock.assert_called_once_with("test12345", fake_refresh_client_app)
 
 
+def test_refresh_rotated(fake_refresh_client_app, test_client, mocker):
+    mocker.patch(
+        "app.routes.token.security_token.verify_refresh_token",
+        return_value=("fake_id_token", "next12345"),
+        new_callable=AsyncMock,
+    )
+
+    response = test_client.post(
+        f"/token/refresh/{fake_refresh_client_app.app_id}",
+        json={"refreshToken": "test12345"},
+    )
+
+    assert response.status_code == 200
+    assert response.json().get("refreshToken") == "next12345"
+
+
 def test_refresh_not_found(app_not_found, mocker, test_client):
     verify_mock = mocker.patch(
         "app.routes.token.security_token.verify_refresh_token",
@@ -334,3 +352,51 @@ def test_delete_all_refresh_tokens_not_found(
     assert response.status_code == 404
 
     delete_all_mock.assert_not_called()
+
+
+def test_verify_tokens(test_client, fake_client_app, fake_email):
+    valid_token = security_token.generate(fake_email, fake_client_app)
+
+    response = test_client.post(
+        f"/token/verify/{fake_client_app.app_id}/batch",
+        json={"idTokens": [valid_token, "not-a-token", valid_token]},
+    )
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["valid"] for result in results] == [True, False, True]
+    assert results[0]["claims"]["sub"] == fake_email
+    assert results[1]["claims"] is None
+    assert results[1]["error"]
+
+
+def test_verify_tokens_header_not_object(test_client, fake_client_app, fake_email):
+    valid_token = security_token.generate(fake_email, fake_client_app)
+    _header, claims, signature = valid_token.split(".")
+    header = base64.urlsafe_b64encode(b"[]").decode("ascii").rstrip("=")
+
+    response = test_client.post(
+        f"/token/verify/{fake_client_app.app_id}/batch",
+        json={"idTokens": [f"{header}.{claims}.{signature}", valid_token]},
+    )
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["valid"] for result in results] == [False, True]
+    assert results[0]["error"]
+
+
+def test_verify_tokens_empty(test_client, fake_client_app):
+    response = test_client.post(
+        f"/token/verify/{fake_client_app.app_id}/batch", json={"idTokens": []}
+    )
+
+    assert response.status_code == 422
+
+
+def test_verify_tokens_not_found(app_not_found, test_client):
+    response = test_client.post(
+        "/token/verify/12345/batch", json={"idTokens": ["fake_token"]}
+    )
+
+    assert response.status_code == 404
@@ -1,4 +1,5 @@
 import datetime
+import json
 
 import pytest
 from jwcrypto import jwk
@@ -58,3 +59,22 @@ def test_exported_key_cannot_sign_keys(fake_client_app, fake_email):
             datetime.timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES),
         )
     assert token is None
+
+
+def test_token_kid_is_in_jwks(fake_client_app, fake_email):
+    token = security_token.generate(fake_email, fake_client_app)
+    body, _etag = security_client_app.export_jwks(fake_client_app)
+    keys = {key["kid"]: jwk.JWK(**key) for key in json.loads(body)["keys"]}
+
+    headers, _ = jwt.process_jwt(token)
+
+    jwt.verify_jwt(token, keys[headers["kid"]], allowed_algs=["ES256"])
+
+
+def test_export_jwks_etag_changes_with_key(fake_client_app):
+    _, etag = security_client_app.export_jwks(fake_client_app)
+    fake_client_app.set_key(jwk.JWK.generate(kty="EC", size=2048))
+
+    _, new_etag = security_client_app.export_jwks(fake_client_app)
+
+    assert new_etag != etag
@@ -0,0 +1,57 @@
+from passlib.context import CryptContext
+
+from app.security.context import SecretContext
+
+LEGACY = CryptContext(schemes=["argon2"], deprecated="auto", argon2__rounds=1)
+
+
+def test_hash_and_verify():
+    context = SecretContext(b"pepper", legacy=LEGACY)
+    secret_hash = context.hash("a secret")
+
+    assert secret_hash.startswith(SecretContext.prefix)
+    assert context.verify("a secret", secret_hash)
+    assert context.verify("a secret", secret_hash.encode("utf-8"))
+    assert not context.verify("another secret", secret_hash)
+    assert not context.needs_update(secret_hash)
+
+
+def test_hash_depends_on_pepper():
+    context1 = SecretContext(b"pepper", legacy=LEGACY)
+    context2 = SecretContext(b"different pepper", legacy=LEGACY)
+
+    assert not context2.verify("a secret", context1.hash("a secret"))
+
+
+def test_verify_missing_hash():
+    context = SecretContext(b"pepper", legacy=LEGACY)
+
+    assert not context.verify("a secret", None)
+    assert context.verify_and_update("a secret", None) == (False, None)
+
+
+def test_legacy_hash_is_upgraded():
+    context = SecretContext(b"pepper", legacy=LEGACY)
+    legacy_hash = LEGACY.hash("a secret")
+
+    assert context.needs_update(legacy_hash)
+    assert context.verify_and_update("a secret", legacy_hash) == (
+        True,
+        context.hash("a secret"),
+    )
+
+
+def test_legacy_hash_wrong_secret():
+    context = SecretContext(b"pepper", legacy=LEGACY)
+    legacy_hash = LEGACY.hash("a secret")
+
+    assert context.verify_and_update("another secret", legacy_hash) == (False, None)
+
+
+def test_current_hash_isnt_upgraded():
+    context = SecretContext(b"pepper", legacy=LEGACY)
+
+    assert context.verify_and_update("a secret", context.hash("a secret")) == (
+        True,
+        None,
+    )
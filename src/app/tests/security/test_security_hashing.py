@@ -0,0 +1,56 @@
+import asyncio
+import logging
+
+import pytest
+
+from app.security import hashing
+
+
+@pytest.fixture
+def fresh_metrics(monkeypatch):
+    metrics = hashing.HashingMetrics(max_workers=2)
+    monkeypatch.setattr(hashing, "METRICS", metrics)
+    return metrics
+
+
+@pytest.mark.asyncio
+async def test_hash_and_verify(fresh_metrics, pwd_context):
+    code_hash = await hashing.hash_secret("123456")
+
+    assert pwd_context.identify(code_hash) == "argon2"
+    assert await hashing.verify_secret("123456", code_hash)
+    assert not await hashing.verify_secret("654321", code_hash)
+    assert fresh_metrics.completed == 3
+    assert fresh_metrics.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_verify_missing_hash_skips_pool(fresh_metrics):
+    assert not await hashing.verify_secret("123456", None)
+    assert fresh_metrics.completed == 0
+
+
+def test_metrics():
+    metrics = hashing.HashingMetrics(max_workers=2)
+    metrics.in_flight = 5
+    metrics.record(0.5)
+    metrics.record(1.5)
+
+    assert metrics.queue_depth == 3
+    assert metrics.mean_wait == 1.0
+    assert metrics.max_wait == 1.5
+    assert metrics.as_dict()["completed"] == 2
+
+
+@pytest.mark.asyncio
+async def test_reporter_logs_metrics(fresh_metrics, monkeypatch, caplog):
+    monkeypatch.setattr("app.config.HASH_METRICS_SECONDS", 0.01)
+    fresh_metrics.record(0.25)
+    caplog.set_level(logging.INFO)
+
+    hashing.start_reporter()
+    await asyncio.sleep(0.05)
+    await hashing.stop_reporter()
+
+    reports = [r.message for r in caplog.records if r.message.startswith("Hashing")]
+    assert reports == ["Hashing pool: " + fresh_metrics.summary()]
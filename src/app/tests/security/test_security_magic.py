@@ -1,6 +1,7 @@
 import datetime
 import secrets
 from unittest import mock
+from unittest.mock import AsyncMock
 from urllib.parse import unquote
 
 import pytest
@@ -11,7 +12,7 @@ from app.security import magic as security_magic
 
 @pytest.fixture
 def mocked_magic_store(mocker):
-    return mocker.patch("app.security.magic.MAGIC_STORE")
+    return mocker.patch("app.security.magic.MAGIC_STORE", new_callable=AsyncMock)
 
 
 @pytest.fixture
@@ -24,7 +25,8 @@ def encrypted_email(fake_email):
     return config.FERNET.encrypt(fake_email.encode("utf-8"))
 
 
-def test_generate(
+@pytest.mark.asyncio
+async def test_generate(
     monkeypatch,
     mocked_magic_store: mock.MagicMock,
     fake_email: str,
@@ -33,7 +35,7 @@ def test_generate(
     mocker,
 ):
     monkeypatch.setattr(secrets, "token_urlsafe", lambda: fake_secret)
-    returned_link = security_magic.generate(fake_email, fake_app_id)
+    returned_link = await security_magic.generate(fake_email, fake_app_id)
 
     print(returned_link)
 
@@ -53,64 +55,50 @@ def test_generate(
     ) == fake_email.encode("utf-8")
 
     mocked_magic_store.set.assert_called_once_with(
-        f"{fake_app_id}:magic:{fake_email}", mock.ANY
-    )
-    mocked_magic_store.expire.assert_called_once_with(
-        f"{fake_app_id}:magic:{fake_email}",
-        datetime.timedelta(minutes=config.MAGIC_LIFETIME),
+        f"{fake_app_id}:{fake_email}",
+        mock.ANY,
+        ex=datetime.timedelta(minutes=config.MAGIC_LIFETIME),
     )
+    mocked_magic_store.expire.assert_not_called()
 
 
 # noinspection DuplicatedCode
-def test_verify(
+@pytest.mark.asyncio
+async def test_verify(
     mocked_magic_store,
-    pwd_context,
+    secret_context,
     encrypted_email,
     fake_email,
     fake_secret,
     fake_app_id,
 ):
-    mocked_magic_store.get.return_value = pwd_context.hash(fake_secret)
+    mocked_magic_store.delete_if_equal.return_value = True
 
-    result = security_magic.verify(encrypted_email, fake_secret, fake_app_id)
+    result = await security_magic.verify(encrypted_email, fake_secret, fake_app_id)
 
     assert result == fake_email
 
-    mocked_magic_store.get.assert_called_once_with(f"{fake_app_id}:magic:{fake_email}")
-    mocked_magic_store.expire.assert_called_once_with(
-        f"{fake_app_id}:magic:{fake_email}", datetime.timedelta(seconds=1)
+    mocked_magic_store.delete_if_equal.assert_called_once_with(
+        f"{fake_app_id}:{fake_email}", secret_context.hash(fake_secret)
     )
+    mocked_magic_store.get.assert_not_called()
 
 
-def test_secret_expired_or_missing(
-    mocked_magic_store, encrypted_email, fake_email, fake_secret, fake_app_id
-):
-    mocked_magic_store.get.return_value = None
-
-    result = security_magic.verify(encrypted_email, fake_secret, fake_app_id)
-
-    assert result is None
-
-    mocked_magic_store.get.assert_called_once_with(f"{fake_app_id}:magic:{fake_email}")
-    mocked_magic_store.expire.asset_not_called()
-
-
-def test_verify_fails(
+@pytest.mark.asyncio
+async def test_verify_fails(
     mocked_magic_store,
     encrypted_email,
     fake_email,
     fake_secret,
     fake_app_id,
-    pwd_context,
 ):
-    mocked_magic_store.get.return_value = pwd_context.hash("not the real secret")
+    # missing, expired, already used or a different secret all look the same
+    mocked_magic_store.delete_if_equal.return_value = False
 
-    result = security_magic.verify(encrypted_email, fake_secret, fake_app_id)
+    result = await security_magic.verify(encrypted_email, fake_secret, fake_app_id)
 
     assert result is None
 
-    mocked_magic_store.get.assert_called_once_with(f"{fake_app_id}:magic:{fake_email}")
-    mocked_magic_store.expire.assert_not_called()
-
-
-# TEST that links can only be used once
+    mocked_magic_store.delete_if_equal.assert_called_once_with(
+        f"{fake_app_id}:{fake_email}", mock.ANY
+    )
@@ -2,19 +2,25 @@ import datetime
 import time
 import uuid
 from unittest import mock
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, MagicMock
 
-import mongox
 import pytest
 
 from app import config
+from app.models import client_app_model
 from app.models.client_app_model import ClientApp
 from app.models.token_models import RefreshToken
 from app.security import token as security_token
+from app.services import revocation
 from jwcrypto import jwk
 import python_jwt as jwt
 
 
+@pytest.fixture(autouse=True)
+def mock_revoke(mocker):
+    return mocker.patch("app.services.revocation.revoke")
+
+
 @pytest.fixture
 def fake_uid():
     return str(uuid.uuid4())
@@ -36,15 +42,24 @@ def fake_refresh_token(fake_refresh_client_app, fake_email, pwd_context, fake_ui
     return refresh_token
 
 
+@pytest.fixture
+def refresh_collection(mocker):
+    collection = mocker.MagicMock()
+    collection.find_one = mocker.AsyncMock(return_value=None)
+    collection.update_one = mocker.AsyncMock()
+    collection.delete_one = mocker.AsyncMock()
+    mocker.patch("app.services.refresh_store.raw_collection", return_value=collection)
+    return collection
+
+
 @pytest.fixture
 def saved_refresh_token(
     fake_refresh_token,
     fake_refresh_client_app,
     fake_email,
     pwd_context,
-    monkeypatch,
     fake_uid,
-    create_fake_queryset,
+    refresh_collection,
 ):
     expires = datetime.datetime.now() + datetime.timedelta(hours=24)
     _saved = RefreshToken(
@@ -54,49 +69,10 @@ def saved_refresh_token(
         expires=expires,
         uid=fake_uid,
     )
-
-    def _fake_query(*_args):
-        return create_fake_queryset(get_return=_saved)
-
-    monkeypatch.setattr("app.security.token.RefreshToken.query", _fake_query)
+    refresh_collection.find_one.return_value = _saved.dict(by_alias=True)
     return _saved
 
 
-@pytest.fixture
-def generate_saved_refresh_token(
-    fake_refresh_client_app, fake_email, pwd_context, monkeypatch, mocker
-):
-    def _generate():
-        uid = str(uuid.uuid4())
-        payload = {
-            "iss": f"{config.ISSUER}/{fake_refresh_client_app.app_id}",
-            "sub": fake_email,
-            "uid": uid,
-        }
-        refresh_token = jwt.generate_jwt(
-            payload,
-            fake_refresh_client_app.get_refresh_key(),
-            "ES256",
-            datetime.timedelta(
-                hours=fake_refresh_client_app.refresh_token_expire_hours
-            ),
-        )
-
-        mocker.patch("mongox.Model.delete")
-        expires = datetime.datetime.now() + datetime.timedelta(hours=24)
-        _saved = RefreshToken(
-            app_id=fake_refresh_client_app.app_id,
-            email=fake_email,
-            hash=pwd_context.hash(refresh_token),
-            expires=expires,
-            uid=uid,
-        )
-
-        return _saved
-
-    return _generate
-
-
 def test_generate(fake_email, fake_client_app):
     token = security_token.generate(fake_email, fake_client_app)
     assert token is not None
@@ -198,12 +174,35 @@ def test_verify_wrong_issuer_app_id_fails(fake_email, fake_client_app):
         security_token.verify(token, fake_client_app)
 
 
+def test_verify_after_rotation(fake_email, fake_client_app):
+    token = security_token.generate(fake_email, fake_client_app)
+    fake_client_app.rotate_key(
+        jwk.JWK.generate(kty="EC", size=2048),
+        datetime.datetime.now() + datetime.timedelta(minutes=5),
+    )
+
+    _, claims = security_token.verify(token, fake_client_app)
+
+    assert claims["sub"] == fake_email
+
+
+def test_verify_retired_key_fails(fake_email, fake_client_app):
+    token = security_token.generate(fake_email, fake_client_app)
+    fake_client_app.rotate_key(
+        jwk.JWK.generate(kty="EC", size=2048),
+        datetime.datetime.now() - datetime.timedelta(minutes=5),
+    )
+
+    with pytest.raises(security_token.TokenVerificationError):
+        security_token.verify(token, fake_client_app)
+
+
 @pytest.mark.asyncio
 async def test_generate_refresh_token(
     fake_email,
     fake_refresh_client_app: ClientApp,
     monkeypatch,
-    pwd_context,
+    secret_context,
 ):
     fake_uuid = uuid.uuid4()
     monkeypatch.setattr(uuid, "uuid4", lambda: fake_uuid)
@@ -244,7 +243,7 @@ async def test_generate_refresh_token(
 
     assert generated_rt.expires >= should_expire_lower_bound
     assert generated_rt.expires <= should_expire_upper_bound
-    assert pwd_context.verify(refresh_token, generated_rt.hash)
+    assert secret_context.verify(refresh_token, generated_rt.hash)
 
 
 @pytest.mark.asyncio
@@ -267,38 +266,191 @@ async def test_generate_refresh_token_invalid_app(
 async def test_verify_refresh_token(
     fake_refresh_client_app: ClientApp, fake_refresh_token, saved_refresh_token
 ):
-    result = await security_token.verify_refresh_token(
+    id_token, refresh_token = await security_token.verify_refresh_token(
         fake_refresh_token, fake_refresh_client_app
     )
 
-    assert result is not None
+    assert id_token is not None
+    assert refresh_token == fake_refresh_token
 
 
 @pytest.mark.asyncio
-async def test_verify_refresh_token_not_found(
+async def test_verify_refresh_token_rotates(
     fake_refresh_client_app: ClientApp,
-    monkeypatch,
     fake_refresh_token,
-    create_fake_queryset,
+    saved_refresh_token,
+    refresh_collection,
+    secret_context,
+    fake_uid,
+    mocker,
 ):
-    def _fake_query(*_args):
-        return create_fake_queryset(get_raises=mongox.NoMatchFound)
+    fake_refresh_client_app.rotate_refresh_tokens = True
+    refresh_collection.update_one.return_value = mocker.MagicMock(modified_count=1)
 
-    monkeypatch.setattr("app.security.token.RefreshToken.query", _fake_query)
+    _, next_token = await security_token.verify_refresh_token(
+        fake_refresh_token, fake_refresh_client_app
+    )
+
+    assert next_token != fake_refresh_token
+    _, claims = jwt.verify_jwt(
+        next_token, fake_refresh_client_app.get_refresh_key(), allowed_algs=["ES256"]
+    )
+    assert claims["uid"] == fake_uid
+    assert claims["gen"] == 1
+    assert claims["exp"] <= saved_refresh_token.expires.timestamp() + 1
+    query, update = refresh_collection.update_one.call_args[0]
+    assert query["uid"] == fake_uid
+    assert update["$inc"] == {"generation": 1}
+    assert secret_context.verify(next_token, update["$set"]["hash"])
+
+
+@pytest.mark.asyncio
+async def test_verify_refresh_token_reuse_revokes_family(
+    fake_refresh_client_app: ClientApp,
+    fake_refresh_token,
+    saved_refresh_token,
+    refresh_collection,
+):
+    fake_refresh_client_app.rotate_refresh_tokens = True
+    refresh_collection.find_one.return_value["generation"] = 1
 
     with pytest.raises(security_token.TokenVerificationError):
         await security_token.verify_refresh_token(
             fake_refresh_token, fake_refresh_client_app
         )
 
+    refresh_collection.delete_one.assert_awaited_once()
+    refresh_collection.update_one.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_verify_refresh_token_reuse_records_revocation(
+    fake_refresh_client_app: ClientApp,
+    fake_refresh_token,
+    saved_refresh_token,
+    refresh_collection,
+    mock_revoke,
+    fake_uid,
+):
+    fake_refresh_client_app.rotate_refresh_tokens = True
+    refresh_collection.find_one.return_value["generation"] = 1
+
+    with pytest.raises(security_token.TokenVerificationError):
+        await security_token.verify_refresh_token(
+            fake_refresh_token, fake_refresh_client_app
+        )
+
+    mock_revoke.assert_awaited_once_with(
+        f"token:{fake_refresh_client_app.app_id}:{fake_uid}",
+        until=saved_refresh_token.expires,
+    )
+
+
+@pytest.mark.asyncio
+async def test_verify_refresh_token_concurrent_rotation_revokes_family(
+    fake_refresh_client_app: ClientApp,
+    fake_refresh_token,
+    saved_refresh_token,
+    refresh_collection,
+    mocker,
+):
+    fake_refresh_client_app.rotate_refresh_tokens = True
+    refresh_collection.update_one.return_value = mocker.MagicMock(modified_count=0)
+
+    with pytest.raises(security_token.TokenVerificationError):
+        await security_token.verify_refresh_token(
+            fake_refresh_token, fake_refresh_client_app
+        )
+
+    refresh_collection.delete_one.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_verify_refresh_token_old_generation_without_rotation(
+    fake_refresh_client_app: ClientApp,
+    fake_refresh_token,
+    saved_refresh_token,
+    refresh_collection,
+):
+    refresh_collection.find_one.return_value["generation"] = 1
+
+    with pytest.raises(security_token.TokenVerificationError):
+        await security_token.verify_refresh_token(
+            fake_refresh_token, fake_refresh_client_app
+        )
+
+    refresh_collection.delete_one.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_verify_refresh_token_upgrades_legacy_hash(
+    fake_refresh_client_app: ClientApp,
+    fake_refresh_token,
+    saved_refresh_token,
+    secret_context,
+    refresh_collection,
+):
+    assert secret_context.needs_update(saved_refresh_token.hash)
+
+    await security_token.verify_refresh_token(
+        fake_refresh_token, fake_refresh_client_app
+    )
+
+    _, update = refresh_collection.update_one.call_args[0]
+    assert secret_context.verify(fake_refresh_token, update["$set"]["hash"])
+    assert not secret_context.needs_update(update["$set"]["hash"])
+
+
+@pytest.mark.asyncio
+async def test_verify_refresh_token_looks_up_by_app_and_uid(
+    fake_refresh_client_app: ClientApp,
+    fake_refresh_token,
+    saved_refresh_token,
+    refresh_collection,
+    fake_uid,
+):
+    await security_token.verify_refresh_token(
+        fake_refresh_token, fake_refresh_client_app
+    )
+
+    refresh_collection.find_one.assert_awaited_once_with(
+        {"app_id": fake_refresh_client_app.app_id, "uid": fake_uid}
+    )
+
+
+@pytest.mark.asyncio
+async def test_verify_refresh_token_wrong_email(
+    fake_refresh_client_app: ClientApp,
+    fake_refresh_token,
+    saved_refresh_token,
+    refresh_collection,
+):
+    refresh_collection.find_one.return_value["email"] = "someone-else@example.com"
+
+    with pytest.raises(security_token.TokenVerificationError):
+        await security_token.verify_refresh_token(
+            fake_refresh_token, fake_refresh_client_app
+        )
+
+
+@pytest.mark.asyncio
+async def test_verify_refresh_token_not_found(
+    fake_refresh_client_app: ClientApp,
+    fake_refresh_token,
+    refresh_collection,
+):
+    with pytest.raises(security_token.TokenVerificationError):
+        await security_token.verify_refresh_token(
+            fake_refresh_token, fake_refresh_client_app
+        )
+
 
 @pytest.mark.asyncio
 async def test_verify_refresh_token_expired_token(
     fake_email,
     fake_refresh_client_app: ClientApp,
-    monkeypatch,
     pwd_context,
-    create_fake_queryset,
+    refresh_collection,
 ):
     uid = "fake_uuid"
     expires = datetime.datetime.now() + datetime.timedelta(hours=24)
@@ -320,11 +472,7 @@ async def test_verify_refresh_token_expired_token(
         expires=expires,
         uid=uid,
     )
-
-    def _fake_query(*_args):
-        return create_fake_queryset(get_return=saved_refresh_token)
-
-    monkeypatch.setattr("app.security.token.RefreshToken.query", _fake_query)
+    refresh_collection.find_one.return_value = saved_refresh_token.dict(by_alias=True)
 
     with pytest.raises(security_token.TokenVerificationError):
         await security_token.verify_refresh_token(
@@ -336,14 +484,11 @@ async def test_verify_refresh_token_expired_token(
 async def test_verify_refresh_token_expired_in_database(
     fake_email,
     fake_refresh_client_app: ClientApp,
-    monkeypatch,
     pwd_context,
     fake_refresh_token,
-    create_fake_queryset,
-    mocker,
+    refresh_collection,
 ):
     expires = datetime.datetime.now() - datetime.timedelta(hours=24)
-    mocker.patch("mongox.Model.delete")
     saved_refresh_token = RefreshToken(
         app_id=fake_refresh_client_app.app_id,
         email=fake_email,
@@ -351,27 +496,24 @@ async def test_verify_refresh_token_expired_in_database(
         expires=expires,
         uid="fake_uuid",
     )
-
-    def _fake_query(*_args):
-        return create_fake_queryset(get_return=saved_refresh_token)
-
-    monkeypatch.setattr("app.security.token.RefreshToken.query", _fake_query)
+    refresh_collection.find_one.return_value = saved_refresh_token.dict(by_alias=True)
 
     with pytest.raises(security_token.TokenVerificationError):
         await security_token.verify_refresh_token(
             fake_refresh_token, fake_refresh_client_app
         )
-    saved_refresh_token.delete.assert_called()
+    refresh_collection.delete_one.assert_awaited_once_with(
+        {"app_id": fake_refresh_client_app.app_id, "uid": "fake_uuid"}
+    )
 
 
 @pytest.mark.asyncio
 async def test_verify_refresh_token_pwd_verification_failed(
     fake_email,
     fake_refresh_client_app: ClientApp,
-    monkeypatch,
     pwd_context,
     fake_refresh_token,
-    create_fake_queryset,
+    refresh_collection,
 ):
     saved_refresh_token = RefreshToken(
         app_id=fake_refresh_client_app.app_id,
@@ -382,11 +524,7 @@ async def test_verify_refresh_token_pwd_verification_failed(
         expires=datetime.datetime.now() + datetime.timedelta(hours=24),
         uid="fake_uuid",
     )
-
-    def _fake_query(*_args):
-        return create_fake_queryset(get_return=saved_refresh_token)
-
-    monkeypatch.setattr("app.security.token.RefreshToken.query", _fake_query)
+    refresh_collection.find_one.return_value = saved_refresh_token.dict(by_alias=True)
 
     with pytest.raises(security_token.TokenVerificationError):
         await security_token.verify_refresh_token(
@@ -397,55 +535,193 @@ async def test_verify_refresh_token_pwd_verification_failed(
 @pytest.mark.asyncio
 async def test_delete_refresh_token(
     fake_refresh_client_app: ClientApp,
-    mocker,
     fake_refresh_token,
     saved_refresh_token,
+    refresh_collection,
+    mock_revoke,
 ):
-    fake_delete = mocker.patch("mongox.Model.delete")
-
     await security_token.delete_refresh_token(
         fake_refresh_token, fake_refresh_client_app
     )
 
-    fake_delete.assert_called()
+    refresh_collection.delete_one.assert_awaited_once_with(
+        {"app_id": fake_refresh_client_app.app_id, "uid": saved_refresh_token.uid}
+    )
+    (entry,), _ = mock_revoke.call_args
+    assert entry == revocation.token_entry(
+        fake_refresh_client_app.app_id, saved_refresh_token.uid
+    )
 
 
 @pytest.mark.asyncio
 async def test_delete_refresh_token_not_found(
     fake_refresh_client_app: ClientApp,
+    fake_refresh_token,
+    refresh_collection,
+):
+    with pytest.raises(security_token.TokenVerificationError):
+        await security_token.verify_refresh_token(
+            fake_refresh_token, fake_refresh_client_app
+        )
+
+
+@pytest.mark.asyncio
+async def test_delete_all_refresh_tokens(
+    fake_refresh_client_app, refresh_collection, fake_email, mocker, mock_revoke
+):
+    refresh_collection.delete_many = mocker.AsyncMock(
+        return_value=mocker.MagicMock(deleted_count=10)
+    )
+
+    deleted = await security_token.delete_all_refresh_tokens(
+        fake_email, fake_refresh_client_app
+    )
+
+    assert deleted == 10
+    refresh_collection.delete_many.assert_awaited_once_with(
+        {"app_id": fake_refresh_client_app.app_id, "email": fake_email}
+    )
+    (entry,), _ = mock_revoke.call_args
+    assert entry == revocation.user_entry(fake_refresh_client_app.app_id, fake_email)
+
+
+@pytest.mark.asyncio
+async def test_verify_refresh_token_stateless(
+    fake_refresh_client_app: ClientApp,
+    fake_refresh_token,
+    refresh_collection,
     monkeypatch,
+    mocker,
+):
+    monkeypatch.setattr("app.config.REFRESH_STATELESS", True)
+    mocker.patch("app.services.revocation.might_be_revoked", return_value=False)
+
+    id_token, refresh_token = await security_token.verify_refresh_token(
+        fake_refresh_token, fake_refresh_client_app
+    )
+
+    assert id_token is not None
+    assert refresh_token == fake_refresh_token
+    refresh_collection.find_one.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_verify_refresh_token_stateless_checks_store_if_revoked(
+    fake_refresh_client_app: ClientApp,
     fake_refresh_token,
-    create_fake_queryset,
+    refresh_collection,
+    monkeypatch,
+    mocker,
+    fake_email,
+    fake_uid,
 ):
-    def _fake_query(*_args):
-        return create_fake_queryset(get_raises=mongox.NoMatchFound)
+    monkeypatch.setattr("app.config.REFRESH_STATELESS", True)
+    might_be_revoked = mocker.patch(
+        "app.services.revocation.might_be_revoked", return_value=True
+    )
+
+    with pytest.raises(security_token.TokenVerificationError):
+        await security_token.verify_refresh_token(
+            fake_refresh_token, fake_refresh_client_app
+        )
+
+    might_be_revoked.assert_called_once_with(
+        fake_refresh_client_app.app_id, fake_email, fake_uid
+    )
+    refresh_collection.find_one.assert_awaited_once()
 
-    monkeypatch.setattr("app.security.token.RefreshToken.query", _fake_query)
+
+@pytest.mark.asyncio
+async def test_verify_refresh_token_stateless_not_for_rotating_apps(
+    fake_refresh_client_app: ClientApp,
+    fake_refresh_token,
+    refresh_collection,
+    monkeypatch,
+    mocker,
+):
+    monkeypatch.setattr("app.config.REFRESH_STATELESS", True)
+    fake_refresh_client_app.rotate_refresh_tokens = True
+    mocker.patch("app.services.revocation.might_be_revoked", return_value=False)
 
     with pytest.raises(security_token.TokenVerificationError):
         await security_token.verify_refresh_token(
             fake_refresh_token, fake_refresh_client_app
         )
 
+    refresh_collection.find_one.assert_awaited_once()
+
 
 @pytest.mark.asyncio
-async def test_delete_all_refresh_tokens(
-    fake_refresh_client_app,
+async def test_verify_refresh_token_stateless_after_lifetime_lowered(
+    fake_refresh_client_app: ClientApp,
+    fake_refresh_token,
+    refresh_collection,
     monkeypatch,
     mocker,
-    generate_saved_refresh_token,
     fake_email,
-    create_fake_queryset,
 ):
-    tokens = [generate_saved_refresh_token() for _ in range(10)]
+    monkeypatch.setattr("app.config.REFRESH_STATELESS", True)
+    revoke = mocker.patch("app.services.revocation.revoke", new=AsyncMock())
+    refresh_collection.delete_many = AsyncMock(return_value=MagicMock(deleted_count=1))
+    fake_refresh_client_app.refresh_token_expire_hours = 1
+    await security_token.delete_all_refresh_tokens(fake_email, fake_refresh_client_app)
+    # The revocation only lasts as long as the new lifetime, so once it has gone
+    # the token, issued to last longer, must still be looked up.
+    mocker.patch("app.services.revocation.might_be_revoked", return_value=False)
+
+    with pytest.raises(security_token.TokenVerificationError):
+        await security_token.verify_refresh_token(
+            fake_refresh_token, fake_refresh_client_app
+        )
 
-    def _fake_query(*args, **kwargs):
-        return create_fake_queryset(all_return=tokens)
+    _, claims = jwt.process_jwt(fake_refresh_token)
+    assert revoke.await_args.kwargs["until"].timestamp() < claims["exp"]
+    refresh_collection.find_one.assert_awaited_once()
 
-    monkeypatch.setattr("app.security.token.RefreshToken.query", _fake_query)
 
-    await security_token.delete_all_refresh_tokens(fake_email, fake_refresh_client_app)
+def test_verify_eddsa(fake_email, fake_client_app):
+    fake_client_app.algorithm = "EdDSA"
+    fake_client_app.set_key(client_app_model.generate_key("EdDSA"))
+    token = security_token.generate(fake_email, fake_client_app)
 
-    for token in tokens:
-        # noinspection PyUnresolvedReferences
-        token.delete.assert_called()
+    headers, claims = security_token.verify(token, fake_client_app)
+
+    assert headers["alg"] == "EdDSA"
+    assert claims["sub"] == fake_email
+
+
+def test_verify_after_changing_algorithm(fake_email, fake_client_app):
+    token = security_token.generate(fake_email, fake_client_app)
+    fake_client_app.algorithm = "EdDSA"
+    fake_client_app.rotate_key(
+        client_app_model.generate_key("EdDSA"),
+        datetime.datetime.now() + datetime.timedelta(minutes=5),
+    )
+    new_token = security_token.generate(fake_email, fake_client_app)
+
+    old_headers, _ = security_token.verify(token, fake_client_app)
+    new_headers, _ = security_token.verify(new_token, fake_client_app)
+
+    assert old_headers["alg"] == "ES256"
+    assert new_headers["alg"] == "EdDSA"
+
+
+def test_verify_caches_result(fake_email, fake_client_app, mocker):
+    token = security_token.generate(fake_email, fake_client_app)
+    spy_verify = mocker.spy(security_token.jwt, "verify_jwt")
+
+    first = security_token.verify(token, fake_client_app)
+    second = security_token.verify(token, fake_client_app)
+
+    assert first == second
+    assert spy_verify.call_count == 1
+
+
+def test_verify_cache_misses_after_revoking_keys(fake_email, fake_client_app):
+    token = security_token.generate(fake_email, fake_client_app)
+    security_token.verify(token, fake_client_app)
+
+    fake_client_app.set_key(client_app_model.generate_key())
+
+    with pytest.raises(security_token.TokenVerificationError):
+        security_token.verify(token, fake_client_app)
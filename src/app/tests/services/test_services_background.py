@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from app.services.background import BackgroundTask
+
+
+@pytest.mark.asyncio
+async def test_start_only_runs_once():
+    started = []
+
+    async def run(name):
+        started.append(name)
+        await asyncio.Event().wait()
+
+    task = BackgroundTask()
+    task.start(run, "first")
+    task.start(run, "second")
+    await asyncio.sleep(0)
+
+    assert task.running
+    assert started == ["first"]
+    await task.stop()
+    assert not task.running
+
+
+@pytest.mark.asyncio
+async def test_start_again_after_finishing():
+    runs = []
+
+    async def run():
+        runs.append(1)
+
+    task = BackgroundTask()
+    task.start(run)
+    await asyncio.sleep(0)
+    task.start(run)
+    await asyncio.sleep(0)
+
+    assert len(runs) == 2
+    await task.stop()
+
+
+@pytest.mark.asyncio
+async def test_stop_without_start():
+    await BackgroundTask().stop()
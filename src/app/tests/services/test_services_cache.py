@@ -0,0 +1,105 @@
+import pytest
+
+from app.services.cache import BloomFilter, TTLCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def fake_timer():
+    return FakeTimer()
+
+
+def test_get_and_set(fake_timer):
+    cache = TTLCache(maxsize=2, ttl=10, timer=fake_timer)
+    cache.set("a", 1)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("b", "default") == "default"
+    assert "a" in cache
+    assert "b" not in cache
+
+
+def test_entries_expire(fake_timer):
+    cache = TTLCache(maxsize=2, ttl=10, timer=fake_timer)
+    cache.set("a", 1)
+
+    fake_timer.now += 9
+    assert cache.get("a") == 1
+
+    fake_timer.now += 1
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_per_entry_ttl(fake_timer):
+    cache = TTLCache(maxsize=2, ttl=10, timer=fake_timer)
+    cache.set("a", 1, ttl=100)
+
+    fake_timer.now += 50
+    assert cache.get("a") == 1
+
+
+def test_no_ttl_never_expires(fake_timer):
+    cache = TTLCache(maxsize=2, timer=fake_timer)
+    cache.set("a", 1)
+
+    fake_timer.now += 10**9
+    assert cache.get("a") == 1
+
+
+def test_evicts_least_recently_used(fake_timer):
+    cache = TTLCache(maxsize=2, ttl=10, timer=fake_timer)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_zero_size_stores_nothing(fake_timer):
+    cache = TTLCache(maxsize=0, ttl=10, timer=fake_timer)
+    cache.set("a", 1)
+
+    assert cache.get("a") is None
+
+
+def test_pop_and_clear(fake_timer):
+    cache = TTLCache(maxsize=2, ttl=10, timer=fake_timer)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    assert cache.pop("a") == 1
+    assert cache.pop("a") is None
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(capacity=1000)
+    bloom.update(f"item{i}" for i in range(1000))
+
+    assert all(f"item{i}" in bloom for i in range(1000))
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    bloom.update(f"item{i}" for i in range(1000))
+
+    false_positives = sum(f"other{i}" in bloom for i in range(10000))
+
+    assert false_positives < 300
+
+
+def test_empty_bloom_filter():
+    assert "anything" not in BloomFilter(capacity=10)
@@ -0,0 +1,47 @@
+import mongox
+import pytest
+
+from app.services import client_app_cache
+from app.services.client_app_cache import CLIENT_APP_CACHE, INVALIDATION_CHANNEL
+
+
+@pytest.mark.asyncio
+async def test_get_client_app_caches(fake_client_app, mocker):
+    spy_query = mocker.spy(client_app_cache.ClientApp, "query")
+
+    first = await client_app_cache.get_client_app(fake_client_app.app_id)
+    second = await client_app_cache.get_client_app(fake_client_app.app_id)
+
+    assert first.app_id == fake_client_app.app_id
+    assert second.app_id == fake_client_app.app_id
+    assert spy_query.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_get_client_app_returns_copy(fake_client_app):
+    cached = await client_app_cache.get_client_app(fake_client_app.app_id)
+    cached.name = "Changed"
+
+    again = await client_app_cache.get_client_app(fake_client_app.app_id)
+
+    assert again.name == fake_client_app.name
+
+
+@pytest.mark.asyncio
+async def test_get_client_app_not_found_isnt_cached(app_not_found):
+    with pytest.raises(mongox.NoMatchFound):
+        await client_app_cache.get_client_app("12345")
+
+    assert "12345" not in CLIENT_APP_CACHE
+
+
+@pytest.mark.asyncio
+async def test_invalidate_evicts_and_publishes(fake_client_app):
+    await client_app_cache.get_client_app(fake_client_app.app_id)
+
+    await client_app_cache.invalidate(fake_client_app.app_id)
+
+    assert fake_client_app.app_id not in CLIENT_APP_CACHE
+    client_app_cache.REDIS.publish.assert_awaited_once_with(
+        INVALIDATION_CHANNEL, fake_client_app.app_id
+    )
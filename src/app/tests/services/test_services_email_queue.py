@@ -0,0 +1,282 @@
+import datetime
+import json
+import time
+from unittest import mock
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from app import config
+from app.io import email as io_email
+from app.services import email_queue
+
+
+class FakePipeline:
+    def __init__(self):
+        self.commands = []
+        self.executed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_args):
+        pass
+
+    def __getattr__(self, name):
+        def _command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return _command
+
+    async def execute(self):
+        self.executed = True
+
+
+@pytest.fixture
+def pipeline():
+    return FakePipeline()
+
+
+@pytest.fixture
+def promote(mocker):
+    return mocker.patch(
+        "app.services.email_queue._promote", new=AsyncMock(return_value=0)
+    )
+
+
+@pytest.fixture
+def mocked_redis(mocker, pipeline, promote):
+    redis = mocker.patch("app.services.email_queue.REDIS", new=MagicMock())
+    redis.xadd = AsyncMock(return_value=b"1-0")
+    redis.xreadgroup = AsyncMock(return_value=[])
+    redis.xpending_range = AsyncMock(return_value=[])
+    redis.xclaim = AsyncMock(return_value=[])
+    redis.pipeline.return_value = pipeline
+    return redis
+
+
+@pytest.fixture
+def mock_send_email(mocker):
+    batcher = mocker.patch("app.services.email_queue.io_email.Batcher")
+    batcher.return_value.send = AsyncMock()
+    return batcher.return_value.send
+
+
+def make_entry(attempts=0, entry_id=b"1-0", expires=None):
+    message = {
+        "id": "abc",
+        "provider": "mailgun",
+        "attempts": attempts,
+        "expires": expires,
+        "email": {
+            "to": "test@example.com",
+            "subject": "Test Subject",
+            "text": "Test text",
+            "from_name": "Test Sender",
+            "reply_to": None,
+            "variables": {"code": "123456"},
+        },
+    }
+    return entry_id, {b"message": json.dumps(message).encode("utf-8")}
+
+
+@pytest.mark.asyncio
+async def test_enqueue(mocked_redis):
+    await email_queue.enqueue(
+        to="test@example.com",
+        subject="Test Subject",
+        text="Test text",
+        from_name="Test Sender",
+    )
+
+    stream, fields = mocked_redis.xadd.call_args.args
+    assert stream == email_queue.QUEUE
+    message = json.loads(fields["message"])
+    assert message["provider"] == config.EMAIL_TRANSPORT
+    assert message["attempts"] == 0
+    assert message["expires"] is None
+    assert message["email"] == {
+        "to": "test@example.com",
+        "subject": "Test Subject",
+        "text": "Test text",
+        "from_name": "Test Sender",
+        "reply_to": None,
+        "variables": None,
+    }
+
+
+@pytest.mark.asyncio
+async def test_run_once_sends_batch(mocked_redis, pipeline, mock_send_email):
+    mocked_redis.xreadgroup.return_value = [
+        [email_queue.QUEUE.encode("utf-8"), [make_entry(), make_entry(entry_id=b"2-0")]]
+    ]
+    worker = email_queue.EmailWorker(consumer="test", batch_size=10)
+
+    assert await worker.run_once() == 2
+
+    mocked_redis.xreadgroup.assert_awaited_once_with(
+        email_queue.GROUP, "test", {email_queue.QUEUE: ">"}, count=10, block=None
+    )
+    assert mock_send_email.call_count == 2
+    mock_send_email.assert_called_with(
+        to="test@example.com",
+        subject="Test Subject",
+        text="Test text",
+        from_name="Test Sender",
+        reply_to=None,
+        variables={"code": "123456"},
+    )
+    assert ("xack", (email_queue.QUEUE, email_queue.GROUP, b"2-0"), {}) in (
+        pipeline.commands
+    )
+
+
+@pytest.mark.asyncio
+async def test_rejected_batch_only_retries_rejected_address(
+    mocked_redis, pipeline, mocker
+):
+    mocker.patch.object(
+        io_email.MailgunTransport,
+        "send_batch",
+        side_effect=io_email.EmailRejected("400 bad address"),
+    )
+
+    async def _send(to, *_args):
+        if to == "bad@example.com":
+            raise io_email.EmailRejected("400 bad address")
+
+    mocker.patch.object(io_email.MailgunTransport, "send", side_effect=_send)
+    good = make_entry(entry_id=b"1-0")
+    bad = make_entry(entry_id=b"2-0")
+    message = json.loads(bad[1][b"message"])
+    message["email"]["to"] = "bad@example.com"
+    bad[1][b"message"] = json.dumps(message).encode("utf-8")
+    mocked_redis.xreadgroup.return_value = [
+        [email_queue.QUEUE.encode("utf-8"), [good, bad]]
+    ]
+    worker = email_queue.EmailWorker(consumer="test")
+
+    await worker.run_once()
+
+    retried = [
+        json.loads(next(iter(args[1])))
+        for name, args, _kwargs in pipeline.commands
+        if name == "zadd"
+    ]
+    assert [message["email"]["to"] for message in retried] == ["bad@example.com"]
+    acked = [args[2] for name, args, _kwargs in pipeline.commands if name == "xack"]
+    assert sorted(acked) == [b"1-0", b"2-0"]
+
+
+@pytest.mark.asyncio
+async def test_failed_send_is_retried_later(mocked_redis, pipeline, mock_send_email):
+    mock_send_email.side_effect = ConnectionError("down")
+    worker = email_queue.EmailWorker(consumer="test")
+
+    await worker.process(*make_entry())
+
+    names = [name for name, _args, _kwargs in pipeline.commands]
+    assert names == ["zadd", "xack", "xdel"]
+    retry_key, scheduled = pipeline.commands[0][1]
+    assert retry_key == email_queue.RETRY
+    ((message, _due),) = scheduled.items()
+    assert json.loads(message)["attempts"] == 1
+    assert json.loads(message)["error"] == "down"
+    assert pipeline.executed
+
+
+@pytest.mark.asyncio
+async def test_failed_send_is_dead_lettered(mocked_redis, pipeline, mock_send_email):
+    mock_send_email.side_effect = ConnectionError("down")
+    worker = email_queue.EmailWorker(consumer="test")
+
+    await worker.process(*make_entry(attempts=config.EMAIL_QUEUE_MAX_ATTEMPTS - 1))
+
+    names = [name for name, _args, _kwargs in pipeline.commands]
+    assert names == ["xadd", "xack", "xdel"]
+    stream, fields = pipeline.commands[0][1]
+    assert stream == email_queue.DEAD
+    dead = json.loads(fields["message"])
+    assert dead["error"] == "down"
+    assert dead["email"] == {
+        "to": "test@example.com",
+        "subject": "Test Subject",
+        "from_name": "Test Sender",
+        "reply_to": None,
+    }
+
+
+@pytest.mark.asyncio
+async def test_enqueue_with_lifetime(mocked_redis):
+    await email_queue.enqueue(
+        to="test@example.com",
+        subject="Test Subject",
+        text="Test text",
+        from_name="Test Sender",
+        lifetime=datetime.timedelta(minutes=5),
+    )
+
+    _stream, fields = mocked_redis.xadd.call_args.args
+    expires = json.loads(fields["message"])["expires"]
+    assert time.time() + 290 < expires <= time.time() + 300
+
+
+@pytest.mark.asyncio
+async def test_expired_message_is_dropped(mocked_redis, pipeline, mock_send_email):
+    worker = email_queue.EmailWorker(consumer="test")
+
+    await worker.process(*make_entry(expires=time.time() - 1))
+
+    mock_send_email.assert_not_called()
+    names = [name for name, _args, _kwargs in pipeline.commands]
+    assert names == ["xack", "xdel"]
+
+
+@pytest.mark.asyncio
+async def test_failed_send_expiring_before_retry_is_dropped(
+    mocked_redis, pipeline, mock_send_email
+):
+    mock_send_email.side_effect = ConnectionError("down")
+    worker = email_queue.EmailWorker(consumer="test")
+    expires = time.time() + config.EMAIL_QUEUE_RETRY_BACKOFF / 2
+
+    await worker.process(*make_entry(expires=expires))
+
+    mock_send_email.assert_called_once()
+    names = [name for name, _args, _kwargs in pipeline.commands]
+    assert names == ["xack", "xdel"]
+
+
+@pytest.mark.asyncio
+async def test_stale_messages_are_claimed(mocked_redis, mock_send_email):
+    idle = config.EMAIL_QUEUE_CLAIM_IDLE * 1000
+    mocked_redis.xpending_range.return_value = [
+        {"message_id": b"1-0", "time_since_delivered": idle + 1},
+        {"message_id": b"2-0", "time_since_delivered": 5},
+    ]
+    mocked_redis.xclaim.return_value = [make_entry()]
+    worker = email_queue.EmailWorker(consumer="test")
+
+    assert await worker.run_once() == 1
+
+    mocked_redis.xclaim.assert_awaited_once_with(
+        email_queue.QUEUE,
+        email_queue.GROUP,
+        "test",
+        min_idle_time=idle,
+        message_ids=[b"1-0"],
+    )
+    mocked_redis.xreadgroup.assert_not_called()
+    mock_send_email.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_due_retries_are_promoted(mocked_redis, promote):
+    worker = email_queue.EmailWorker(consumer="test", batch_size=10)
+
+    await worker.promote_retries()
+
+    promote.assert_awaited_once_with(
+        keys=[email_queue.RETRY, email_queue.QUEUE], args=[mock.ANY, 10]
+    )
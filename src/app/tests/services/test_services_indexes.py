@@ -0,0 +1,87 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from app.models.token_models import RefreshToken
+from app.services import indexes
+
+
+@pytest.fixture
+def mocked_collection(mocker):
+    collection = MagicMock()
+    collection.name = "refresh_tokens"
+    collection.index_information = AsyncMock(
+        return_value={"_id_": {}, "app_id": {}, "email": {}, "expires": {}}
+    )
+    collection.create_indexes = AsyncMock()
+    collection.drop_index = AsyncMock()
+    mocker.patch("app.services.indexes.raw_collection", return_value=collection)
+    return collection
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes_creates_missing(mocked_collection):
+    created = await indexes.ensure_indexes(RefreshToken)
+
+    assert created == ["app_id_uid", "app_id_email"]
+    built = [
+        call[0][0][0].name for call in mocked_collection.create_indexes.call_args_list
+    ]
+    assert built == ["app_id_uid", "app_id_email"]
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes_drops_stale_after_building(mocked_collection):
+    calls = []
+    mocked_collection.create_indexes.side_effect = lambda _: calls.append("create")
+    mocked_collection.drop_index.side_effect = lambda name: calls.append(name)
+
+    await indexes.ensure_indexes(RefreshToken)
+
+    assert calls == ["create", "create", "app_id", "email"]
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes_keeps_other_indexes(mocked_collection):
+    mocked_collection.index_information.return_value = {
+        "_id_": {},
+        "app_id": {},
+        "added_by_hand": {},
+        "expires": {},
+    }
+
+    await indexes.ensure_indexes(RefreshToken)
+
+    mocked_collection.drop_index.assert_awaited_once_with("app_id")
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes_nothing_to_do(mocked_collection):
+    mocked_collection.index_information.return_value = {
+        "_id_": {},
+        "app_id_uid": {},
+        "app_id_email": {},
+        "expires": {},
+    }
+
+    assert await indexes.ensure_indexes(RefreshToken) == []
+    mocked_collection.create_indexes.assert_not_called()
+    mocked_collection.drop_index.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes_reports_slow_builds(
+    mocked_collection, mocker, monkeypatch
+):
+    monkeypatch.setattr("app.config.INDEX_PROGRESS_SECONDS", 0.01)
+    report = mocker.patch("app.services.indexes._report_progress")
+
+    async def _slow_build(_):
+        await asyncio.sleep(0.05)
+
+    mocked_collection.create_indexes.side_effect = _slow_build
+
+    await indexes.ensure_indexes(RefreshToken)
+
+    report.assert_called()
@@ -0,0 +1,144 @@
+import asyncio
+import datetime
+import os
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app.services import notifications
+
+
+@pytest.fixture
+def mocked_notification_store(mocker):
+    return mocker.patch(
+        "app.services.notifications.NOTIFICATION_STORE", new_callable=AsyncMock
+    )
+
+
+@pytest.fixture
+def mock_send_email(mocker):
+    return mocker.patch("app.services.notifications.email_queue.enqueue")
+
+
+@pytest.fixture
+def mock_mark_notified(mocker):
+    return mocker.patch("app.services.notifications.quota.mark_low_quota_notified")
+
+
+@pytest.fixture
+def owned_client_app(create_fake_client_app):
+    return create_fake_client_app(owner="owner@example.com", quota=5)
+
+
+@pytest.mark.asyncio
+async def test_send_out_of_quota(
+    mocked_notification_store, mock_send_email, owned_client_app
+):
+    fca = owned_client_app
+    mocked_notification_store.set.return_value = True
+
+    await notifications.send_out_of_quota(fca)
+
+    today = datetime.date.today().isoformat()
+    mocked_notification_store.set.assert_awaited_once_with(
+        f"out_of_quota:{fca.app_id}:{today}",
+        "1",
+        nx=True,
+        ex=datetime.timedelta(days=1),
+    )
+    mock_send_email.assert_called_once_with(
+        to=fca.owner,
+        subject="%recipient.app_name% is out of Authentications",
+        text="%recipient.app_name% has reached its quota of "
+        "authentications. No further authentications will be processed. "
+        "Please reply to this email to purchase more.\nRick Henry\nRick Henry "
+        "Development\nhttps://rickhenry.dev",
+        from_name="Purple Authentication",
+        reply_to=os.getenv("WEBMASTER_EMAIL"),
+        variables={"app_name": fca.name},
+    )
+
+
+@pytest.mark.asyncio
+async def test_send_low_quota(
+    mocked_notification_store, mock_send_email, mock_mark_notified, owned_client_app
+):
+    fca = owned_client_app
+    mocked_notification_store.set.return_value = True
+
+    await notifications.send_low_quota(fca, 4)
+
+    today = datetime.date.today().isoformat()
+    mocked_notification_store.set.assert_awaited_once_with(
+        f"low_quota:{fca.app_id}:{today}",
+        "1",
+        nx=True,
+        ex=datetime.timedelta(days=1),
+    )
+    mock_send_email.assert_called_once_with(
+        to=fca.owner,
+        subject="%recipient.app_name% is almost out of Authentications",
+        text="%recipient.app_name% has almost reached its quota of "
+        "authentications. It will process %recipient.remaining% more "
+        "authentications before it stops authenticating users. "
+        "Please reply to this email to purchase more.\nRick Henry\nRick Henry "
+        "Development\nhttps://rickhenry.dev",
+        from_name="Purple Authentication",
+        reply_to=os.getenv("WEBMASTER_EMAIL"),
+        variables={"app_name": fca.name, "remaining": 4},
+    )
+    mock_mark_notified.assert_awaited_once_with(fca.app_id)
+
+
+@pytest.mark.asyncio
+async def test_send_low_quota_only_once_per_day(
+    mocked_notification_store, mock_send_email, mock_mark_notified, owned_client_app
+):
+    # another worker already holds today's lock
+    mocked_notification_store.set.return_value = None
+
+    await notifications.send_low_quota(owned_client_app, 4)
+
+    mock_send_email.assert_not_called()
+    mock_mark_notified.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_failed_send_releases_lock(
+    mocked_notification_store, mock_send_email, owned_client_app
+):
+    mocked_notification_store.set.return_value = True
+    mock_send_email.side_effect = ConnectionError
+
+    with pytest.raises(ConnectionError):
+        await notifications.send_out_of_quota(owned_client_app)
+
+    today = datetime.date.today().isoformat()
+    mocked_notification_store.delete.assert_awaited_once_with(
+        f"out_of_quota:{owned_client_app.app_id}:{today}"
+    )
+
+
+@pytest.mark.asyncio
+async def test_notify_runs_in_background(mocker, owned_client_app):
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def _slow_send(*_args):
+        started.set()
+        await release.wait()
+
+    mock_send = mocker.patch(
+        "app.services.notifications.send_low_quota", side_effect=_slow_send
+    )
+
+    notifications.notify_low_quota(owned_client_app, 4)
+    await started.wait()
+
+    assert len(notifications._pending) == 1
+
+    release.set()
+    await notifications.drain()
+
+    assert len(notifications._pending) == 0
+    mock_send.assert_called_once_with(owned_client_app, 4)
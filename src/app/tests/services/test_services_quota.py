@@ -0,0 +1,70 @@
+import datetime
+from unittest import mock
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from pymongo import ReturnDocument
+
+from app.services import quota
+
+
+@pytest.fixture
+def mocked_collection(mocker):
+    collection = MagicMock()
+    collection.find_one_and_update = AsyncMock()
+    collection.update_one = AsyncMock()
+    mocker.patch("app.services.quota.raw_collection", return_value=collection)
+    return collection
+
+
+@pytest.mark.asyncio
+async def test_use_quota_decrements_atomically(mocked_collection, fake_app_id):
+    mocked_collection.find_one_and_update.return_value = {"quota": 41}
+
+    assert await quota.use_quota(fake_app_id) == 41
+
+    mocked_collection.find_one_and_update.assert_awaited_once_with(
+        {"app_id": fake_app_id, "quota": {"$gte": 1}},
+        {"$inc": {"quota": -1}},
+        projection={"_id": False, "quota": True},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+@pytest.mark.asyncio
+async def test_use_quota_out_of_quota(mocked_collection, fake_app_id):
+    mocked_collection.find_one_and_update.return_value = None
+
+    assert await quota.use_quota(fake_app_id) is None
+
+
+@pytest.mark.asyncio
+async def test_mark_low_quota_notified(mocked_collection, fake_app_id):
+    await quota.mark_low_quota_notified(fake_app_id)
+
+    mocked_collection.update_one.assert_awaited_once_with(
+        {"app_id": fake_app_id}, {"$set": {"low_quota_last_notified": mock.ANY}}
+    )
+    update = mocked_collection.update_one.call_args.args[1]
+    assert isinstance(update["$set"]["low_quota_last_notified"], datetime.datetime)
+
+
+@pytest.mark.asyncio
+async def test_set_quota_resets_counter(mocked_collection, mocker, fake_app_id):
+    mocked_collection.update_one.return_value = MagicMock(matched_count=1)
+    forget = mocker.patch("app.services.quota.forget_counter")
+
+    assert await quota.set_quota(fake_app_id, 1000)
+
+    mocked_collection.update_one.assert_awaited_once_with(
+        {"app_id": fake_app_id}, {"$set": {"quota": 1000}}
+    )
+    forget.assert_awaited_once_with(fake_app_id)
+
+
+@pytest.mark.asyncio
+async def test_set_quota_no_app(mocked_collection, mocker, fake_app_id):
+    mocked_collection.update_one.return_value = MagicMock(matched_count=0)
+    mocker.patch("app.services.quota.forget_counter")
+
+    assert not await quota.set_quota(fake_app_id, 1000)
@@ -0,0 +1,191 @@
+from unittest import mock
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from pymongo import UpdateOne
+from redis.exceptions import ConnectionError
+
+from app import config
+from app.services import quota, redis_quota
+
+
+@pytest.fixture
+def scripts(mocker):
+    return {
+        source: mocker.patch(f"app.services.redis_quota.{name}", new=script)
+        for source, name, script in [
+            (redis_quota._TAKE, "_take", AsyncMock()),
+            (redis_quota._SEED, "_seed_counter", AsyncMock(return_value=1)),
+            (redis_quota._START_FLUSH, "_start_flush", AsyncMock()),
+            (redis_quota._FINISH_FLUSH, "_finish_flush", AsyncMock(return_value=0)),
+        ]
+    }
+
+
+@pytest.fixture
+def mocked_redis(mocker, scripts):
+    redis = mocker.patch("app.services.redis_quota.REDIS", new=MagicMock())
+    redis.delete = AsyncMock()
+    redis.get = AsyncMock(return_value=b"3")
+    redis.hgetall = AsyncMock(return_value={})
+    return redis
+
+
+@pytest.fixture
+def mocked_collection(mocker):
+    collection = MagicMock()
+    collection.find_one = AsyncMock()
+    collection.bulk_write = AsyncMock()
+    mocker.patch("app.services.redis_quota.raw_collection", return_value=collection)
+    return collection
+
+
+@pytest.mark.asyncio
+async def test_use_quota_takes_from_counter(mocked_redis, scripts, fake_app_id):
+    scripts[redis_quota._TAKE].return_value = 41
+
+    assert await redis_quota.use_quota(fake_app_id) == 41
+
+    scripts[redis_quota._TAKE].assert_awaited_once_with(
+        keys=[redis_quota.remaining_key(fake_app_id), redis_quota.PENDING],
+        args=[fake_app_id],
+    )
+    scripts[redis_quota._SEED].assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_use_quota_out_of_quota(mocked_redis, scripts, fake_app_id):
+    scripts[redis_quota._TAKE].return_value = -1
+
+    assert await redis_quota.use_quota(fake_app_id) is None
+
+
+@pytest.mark.asyncio
+async def test_use_quota_seeds_from_mongo(
+    mocked_redis, mocked_collection, scripts, fake_app_id
+):
+    scripts[redis_quota._TAKE].side_effect = [-2, 99]
+    mocked_collection.find_one.return_value = {"quota": 100, "quota_flush_id": "abc"}
+
+    assert await redis_quota.use_quota(fake_app_id) == 99
+
+    scripts[redis_quota._SEED].assert_awaited_once_with(
+        keys=[
+            redis_quota.remaining_key(fake_app_id),
+            redis_quota.PENDING,
+            redis_quota.FLUSHING,
+            redis_quota.FLUSHING_ID,
+            redis_quota.GENERATION,
+        ],
+        args=[fake_app_id, 100, "abc", b"3", config.QUOTA_REDIS_TTL],
+    )
+
+
+@pytest.mark.asyncio
+async def test_use_quota_gives_up_seeding(
+    mocked_redis, mocked_collection, scripts, fake_app_id
+):
+    scripts[redis_quota._TAKE].return_value = -2
+    mocked_collection.find_one.return_value = None
+
+    with pytest.raises(redis_quota.CounterUnavailable):
+        await redis_quota.use_quota(fake_app_id)
+
+    assert scripts[redis_quota._TAKE].await_count == redis_quota.SEED_ATTEMPTS + 1
+
+
+@pytest.mark.asyncio
+async def test_flush_writes_pending_counts(mocked_redis, mocked_collection, scripts):
+    scripts[redis_quota._START_FLUSH].return_value = b"flush1"
+    mocked_redis.hgetall.return_value = {b"app1": b"3", b"app2": b"1"}
+
+    assert await redis_quota.flush() == 2
+
+    mocked_redis.hgetall.assert_awaited_once_with(redis_quota.FLUSHING)
+    mocked_collection.bulk_write.assert_awaited_once_with(
+        [
+            UpdateOne(
+                {"app_id": "app1", "quota_flush_id": {"$ne": "flush1"}},
+                {"$inc": {"quota": -3}, "$set": {"quota_flush_id": "flush1"}},
+            ),
+            UpdateOne(
+                {"app_id": "app2", "quota_flush_id": {"$ne": "flush1"}},
+                {"$inc": {"quota": -1}, "$set": {"quota_flush_id": "flush1"}},
+            ),
+        ],
+        ordered=False,
+    )
+    scripts[redis_quota._FINISH_FLUSH].assert_awaited_once_with(
+        keys=[redis_quota.FLUSHING, redis_quota.FLUSHING_ID, redis_quota.GENERATION],
+        args=["flush1"],
+    )
+
+
+@pytest.mark.asyncio
+async def test_flush_nothing_pending(mocked_redis, mocked_collection, scripts):
+    scripts[redis_quota._START_FLUSH].return_value = None
+
+    assert await redis_quota.flush() == 0
+
+    mocked_collection.bulk_write.assert_not_called()
+    scripts[redis_quota._FINISH_FLUSH].assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_quota_uses_redis_engine(mocker, fake_app_id):
+    mocker.patch("app.services.quota.config.QUOTA_ENGINE", "redis")
+    mock_redis_use = mocker.patch(
+        "app.services.quota.redis_quota.use_quota", return_value=7
+    )
+    mock_mongo_use = mocker.patch("app.services.quota._use_mongo_quota")
+
+    assert await quota.use_quota(fake_app_id) == 7
+
+    mock_redis_use.assert_awaited_once_with(fake_app_id)
+    mock_mongo_use.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_quota_falls_back_to_mongo(mocker, fake_app_id):
+    mocker.patch("app.services.quota.config.QUOTA_ENGINE", "redis")
+    mocker.patch(
+        "app.services.quota.redis_quota.use_quota",
+        side_effect=redis_quota.CounterUnavailable(fake_app_id),
+    )
+    mock_mongo_use = mocker.patch(
+        "app.services.quota._use_mongo_quota", return_value=mock.sentinel.remaining
+    )
+
+    assert await quota.use_quota(fake_app_id) is mock.sentinel.remaining
+    mock_mongo_use.assert_awaited_once_with(fake_app_id)
+
+
+@pytest.mark.asyncio
+async def test_quota_falls_back_to_mongo_when_redis_is_down(mocker, fake_app_id):
+    mocker.patch("app.services.quota.config.QUOTA_ENGINE", "redis")
+    mocker.patch(
+        "app.services.quota.redis_quota.use_quota",
+        side_effect=ConnectionError("Connection refused"),
+    )
+    mock_mongo_use = mocker.patch("app.services.quota._use_mongo_quota", return_value=3)
+
+    assert await quota.use_quota(fake_app_id) == 3
+    mock_mongo_use.assert_awaited_once_with(fake_app_id)
+
+
+@pytest.mark.asyncio
+async def test_forget_counter(mocker, mocked_redis, fake_app_id):
+    mocker.patch("app.services.quota.config.QUOTA_ENGINE", "redis")
+
+    await quota.forget_counter(fake_app_id)
+
+    mocked_redis.delete.assert_awaited_once_with(redis_quota.remaining_key(fake_app_id))
+
+
+@pytest.mark.asyncio
+async def test_forget_counter_mongo_engine(mocker, mocked_redis, fake_app_id):
+    mocker.patch("app.services.quota.config.QUOTA_ENGINE", "mongo")
+
+    await quota.forget_counter(fake_app_id)
+
+    mocked_redis.delete.assert_not_called()
@@ -0,0 +1,279 @@
+import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from pymongo import ReplaceOne
+
+from app.models.token_models import RefreshToken
+from app.services import refresh_store
+
+
+@pytest.fixture
+def app_id(fake_app_id):
+    return str(fake_app_id)
+
+
+@pytest.fixture
+def record(app_id, fake_email):
+    return RefreshToken(
+        app_id=app_id,
+        email=fake_email,
+        hash="hash",
+        expires=datetime.datetime.now() + datetime.timedelta(hours=1),
+        uid="fake_uid",
+    )
+
+
+@pytest.fixture
+def scripts(mocker):
+    return {
+        source: mocker.patch(
+            f"app.services.refresh_store.{name}", new=AsyncMock(return_value=result)
+        )
+        for source, name, result in [
+            (refresh_store._SAVE, "_save_record", 1),
+            (refresh_store._UPDATE_HASH, "_set_hash", 1),
+            (refresh_store._ROTATE, "_rotate_record", 1),
+            (refresh_store._DELETE, "_delete_record", 1),
+            (refresh_store._DELETE_ALL, "_delete_user", 3),
+        ]
+    }
+
+
+@pytest.fixture
+def mocked_redis(mocker, scripts):
+    redis = mocker.patch("app.services.refresh_store.REDIS", new=MagicMock())
+    redis.hgetall = AsyncMock(return_value={})
+    return redis
+
+
+@pytest.fixture
+def mocked_collection(mocker):
+    collection = MagicMock()
+    collection.find_one = AsyncMock(return_value=None)
+    collection.bulk_write = AsyncMock()
+    collection.update_one = AsyncMock(return_value=MagicMock(modified_count=1))
+    mocker.patch("app.services.refresh_store.raw_collection", return_value=collection)
+    return collection
+
+
+def test_get_store_default(monkeypatch):
+    monkeypatch.setattr("app.config.REFRESH_TOKEN_STORE", "redis")
+
+    assert isinstance(refresh_store.get_store(), refresh_store.RedisRefreshStore)
+    assert refresh_store.get_store() is refresh_store.get_store("redis")
+
+
+def test_store_must_implement_interface():
+    class Incomplete(refresh_store.RefreshTokenStore):
+        async def save(self, record):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_get_store_unknown():
+    with pytest.raises(ValueError):
+        refresh_store.get_store("carrier-pigeon")
+
+
+@pytest.mark.asyncio
+async def test_mongo_find(mocked_collection, record, app_id):
+    mocked_collection.find_one.return_value = record.dict(by_alias=True)
+
+    found = await refresh_store.MongoRefreshStore().find(app_id, "fake_uid")
+
+    assert found.hash == "hash"
+    mocked_collection.find_one.assert_awaited_once_with(
+        {"app_id": app_id, "uid": "fake_uid"}
+    )
+
+
+@pytest.mark.asyncio
+async def test_mongo_find_missing(mocked_collection, app_id):
+    assert await refresh_store.MongoRefreshStore().find(app_id, "nope") is None
+
+
+@pytest.mark.asyncio
+async def test_mongo_save_many_upserts(mocked_collection, record, app_id):
+    saved = await refresh_store.MongoRefreshStore().save_many([record])
+
+    assert saved == 1
+    operations = mocked_collection.bulk_write.call_args[0][0]
+    assert operations == [
+        ReplaceOne(
+            {"app_id": app_id, "uid": "fake_uid"},
+            record.dict(exclude={"id"}),
+            upsert=True,
+        )
+    ]
+
+
+@pytest.mark.asyncio
+async def test_mongo_rotate(mocked_collection, record, app_id):
+    record.generation = 2
+
+    assert await refresh_store.MongoRefreshStore().rotate(record, "new")
+
+    mocked_collection.update_one.assert_awaited_once_with(
+        {"app_id": app_id, "uid": "fake_uid", "generation": 2},
+        {"$set": {"hash": "new"}, "$inc": {"generation": 1}},
+    )
+
+
+@pytest.mark.asyncio
+async def test_mongo_rotate_matches_records_without_generation(
+    mocked_collection, record
+):
+    await refresh_store.MongoRefreshStore().rotate(record, "new")
+
+    query, _ = mocked_collection.update_one.call_args[0]
+    assert query["generation"] == {"$in": [0, None]}
+
+
+@pytest.mark.asyncio
+async def test_mongo_rotate_lost_race(mocked_collection, record):
+    mocked_collection.update_one.return_value = MagicMock(modified_count=0)
+
+    assert not await refresh_store.MongoRefreshStore().rotate(record, "new")
+
+
+@pytest.mark.asyncio
+async def test_redis_rotate(mocked_redis, scripts, record, app_id):
+    assert await refresh_store.RedisRefreshStore().rotate(record, "new")
+
+    scripts[refresh_store._ROTATE].assert_awaited_once_with(
+        keys=[refresh_store.TOKENS.key(f"{{{app_id}}}:fake_uid")], args=[0, "new"]
+    )
+
+
+@pytest.mark.asyncio
+async def test_redis_save(mocked_redis, scripts, record, app_id, fake_email):
+    await refresh_store.RedisRefreshStore().save(record)
+
+    call = scripts[refresh_store._SAVE].call_args
+    assert call.kwargs["keys"] == [
+        refresh_store.TOKENS.key(f"{{{app_id}}}:fake_uid"),
+        refresh_store.USERS.key(f"{{{app_id}}}:{fake_email}"),
+        refresh_store.APPS.key(f"{{{app_id}}}"),
+    ]
+    email, token_hash, expires, seconds_left, uid = call.kwargs["args"][:5]
+    assert (email, token_hash, uid) == (fake_email, "hash", "fake_uid")
+    assert expires == record.expires.timestamp()
+    assert 3590 <= seconds_left <= 3600
+
+
+@pytest.mark.asyncio
+async def test_redis_save_skips_expired(mocked_redis, scripts, record):
+    record.expires = datetime.datetime.now() - datetime.timedelta(seconds=1)
+
+    await refresh_store.RedisRefreshStore().save(record)
+
+    scripts[refresh_store._SAVE].assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_redis_find(mocked_redis, record, app_id, fake_email):
+    mocked_redis.hgetall.return_value = {
+        b"email": fake_email.encode("utf-8"),
+        b"hash": b"hash",
+        b"expires": str(record.expires.timestamp()).encode("utf-8"),
+    }
+
+    found = await refresh_store.RedisRefreshStore().find(app_id, "fake_uid")
+
+    assert found.email == fake_email
+    assert found.uid == "fake_uid"
+    assert found.expires == record.expires
+    mocked_redis.hgetall.assert_awaited_once_with(
+        refresh_store.TOKENS.key(f"{{{app_id}}}:fake_uid")
+    )
+
+
+@pytest.mark.asyncio
+async def test_redis_find_missing(mocked_redis, app_id):
+    assert await refresh_store.RedisRefreshStore().find(app_id, "nope") is None
+
+
+@pytest.mark.asyncio
+async def test_redis_delete(mocked_redis, scripts, record, app_id, fake_email):
+    assert await refresh_store.RedisRefreshStore().delete(record) == 1
+
+    scripts[refresh_store._DELETE].assert_awaited_once_with(
+        keys=[
+            refresh_store.TOKENS.key(f"{{{app_id}}}:fake_uid"),
+            refresh_store.USERS.key(f"{{{app_id}}}:{fake_email}"),
+            refresh_store.APPS.key(f"{{{app_id}}}"),
+        ],
+        args=["fake_uid"],
+    )
+
+
+@pytest.mark.asyncio
+async def test_redis_delete_all(mocked_redis, scripts, app_id, fake_email):
+    mocked_redis.zrange = AsyncMock(return_value=[b"uid1", b"uid2"])
+
+    deleted = await refresh_store.RedisRefreshStore().delete_all(
+        app_id, fake_email
+    )
+
+    assert deleted == 3
+    scripts[refresh_store._DELETE_ALL].assert_awaited_once_with(
+        keys=[
+            refresh_store.USERS.key(f"{{{app_id}}}:{fake_email}"),
+            refresh_store.APPS.key(f"{{{app_id}}}"),
+            refresh_store.TOKENS.key(f"{{{app_id}}}:uid1"),
+            refresh_store.TOKENS.key(f"{{{app_id}}}:uid2"),
+        ],
+        args=["uid1", "uid2"],
+    )
+
+
+@pytest.mark.asyncio
+async def test_redis_delete_all_rereads_changed_tokens(
+    mocked_redis, scripts, app_id, fake_email
+):
+    mocked_redis.zrange = AsyncMock(side_effect=[[b"uid1"], [b"uid1", b"uid2"]])
+    scripts[refresh_store._DELETE_ALL].side_effect = [-1, 2]
+
+    deleted = await refresh_store.RedisRefreshStore().delete_all(
+        app_id, fake_email
+    )
+
+    assert deleted == 2
+    assert scripts[refresh_store._DELETE_ALL].await_args.kwargs["args"] == [
+        "uid1",
+        "uid2",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_redis_delete_apps(mocked_redis, app_id, fake_email):
+    token_key = refresh_store.TOKENS.key(f"{{{app_id}}}:fake_uid").encode("utf-8")
+    user_key = refresh_store.USERS.key(f"{{{app_id}}}:{fake_email}").encode("utf-8")
+    mocked_redis.zrange = AsyncMock(side_effect=[[token_key, user_key], []])
+    pipeline = MagicMock()
+    pipeline.__aenter__ = AsyncMock(return_value=pipeline)
+    pipeline.__aexit__ = AsyncMock(return_value=None)
+    pipeline.execute = AsyncMock(return_value=[1, 1, 2])
+    mocked_redis.pipeline.return_value = pipeline
+
+    deleted = await refresh_store.RedisRefreshStore().delete_apps(app_id)
+
+    assert deleted == 1
+    mocked_redis.zrange.assert_awaited_with(
+        refresh_store.APPS.key(f"{{{app_id}}}"), 0, refresh_store.BATCH_SIZE - 1
+    )
+    assert [call.args for call in pipeline.unlink.call_args_list] == [
+        (token_key,),
+        (user_key,),
+    ]
+    pipeline.zrem.assert_called_once_with(
+        refresh_store.APPS.key(f"{{{app_id}}}"), token_key, user_key
+    )
+    mocked_redis.scan_iter.assert_not_called()
+
+
+def test_glob_escape():
+    assert refresh_store._glob_escape("a*b?[c]") == "a\\*b\\?\\[c\\]"
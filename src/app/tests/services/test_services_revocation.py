@@ -0,0 +1,76 @@
+import datetime
+import time
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from app.services import revocation
+
+
+@pytest.fixture
+def mocked_redis(mocker):
+    redis = mocker.patch("app.services.revocation.REDIS", new=MagicMock())
+    redis.zadd = AsyncMock()
+    redis.publish = AsyncMock()
+    redis.zremrangebyscore = AsyncMock()
+    redis.zrangebyscore = AsyncMock(return_value=[])
+    return redis
+
+
+@pytest.fixture
+def ready_filter(mocker):
+    mocker.patch("app.services.revocation._filter", new=revocation.BloomFilter(100))
+    mocker.patch("app.services.revocation._ready", new=True)
+
+
+@pytest.mark.asyncio
+async def test_revoke_records_and_publishes(mocked_redis, ready_filter):
+    until = datetime.datetime.now() + datetime.timedelta(hours=1)
+    entry = revocation.token_entry("app", "uid")
+
+    await revocation.revoke(entry, until=until)
+
+    mocked_redis.zadd.assert_awaited_once_with(
+        revocation.REVOKED, {entry: until.timestamp()}
+    )
+    mocked_redis.publish.assert_awaited_once_with(revocation.REVOCATION_CHANNEL, entry)
+    assert revocation.might_be_revoked("app", "test@example.com", "uid")
+
+
+@pytest.mark.asyncio
+async def test_revoke_user_covers_all_their_tokens(mocked_redis, ready_filter):
+    await revocation.revoke(
+        revocation.user_entry("app", "test@example.com"),
+        until=datetime.datetime.now(),
+    )
+
+    assert revocation.might_be_revoked("app", "test@example.com", "any uid")
+    assert not revocation.might_be_revoked("app", "other@example.com", "any uid")
+
+
+@pytest.mark.asyncio
+async def test_revoke_app_covers_all_its_tokens(mocked_redis, ready_filter):
+    await revocation.revoke(revocation.app_entry("app"), until=datetime.datetime.now())
+
+    assert revocation.might_be_revoked("app", "test@example.com", "uid")
+    assert not revocation.might_be_revoked("other app", "test@example.com", "uid")
+
+
+def test_might_be_revoked_until_ready(mocker):
+    mocker.patch("app.services.revocation._ready", new=False)
+
+    assert revocation.might_be_revoked("app", "test@example.com", "uid")
+
+
+@pytest.mark.asyncio
+async def test_rebuild_filter(mocked_redis, ready_filter):
+    await revocation.revoke(revocation.app_entry("gone"), until=datetime.datetime.now())
+    mocked_redis.zrangebyscore.return_value = [b"token:app:uid"]
+
+    assert await revocation.rebuild_filter() == 1
+
+    assert revocation.might_be_revoked("app", "test@example.com", "uid")
+    assert not revocation.might_be_revoked("gone", "test@example.com", "uid")
+    _, start, _ = mocked_redis.zremrangebyscore.call_args[0]
+    assert start == "-inf"
+    assert mocked_redis.zrangebyscore.call_args[0][1] <= time.time()
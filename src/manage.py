@@ -1,14 +1,26 @@
 import asyncio
+import logging
 import secrets
+import time
 import uuid
 from typing import Optional
-import jwcrypto.jwk as jwk
 
 import click
 
 from app import config
-from app.models.client_app_model import ClientApp
+from app.io import mailgun_standin, redis_interface, smtp_standin
+from app.models.client_app_model import ALGORITHMS, ClientApp, generate_key
+from app.models.token_models import RefreshToken
 from app.portal.crud import clientapp_crud
+from app.portal.models.user_model import User
+from app.security import token as security_token
+from app.services import (
+    client_app_cache,
+    email_queue,
+    indexes,
+    quota,
+    refresh_store,
+)
 
 
 @click.group()
@@ -23,6 +35,8 @@ def cli():
 @click.option("--refresh-token-expire-hours", type=int)
 @click.option("--app-id")
 @click.option("--api-key")
+@click.option("--algorithm", type=click.Choice(list(ALGORITHMS)), default="ES256")
+@click.option("--rotate-refresh-tokens", is_flag=True)
 def createapp(
     app_name: str,
     url: str,
@@ -30,8 +44,10 @@ def createapp(
     refresh_token_expire_hours: Optional[int],
     app_id: Optional[str],
     api_key: Optional[str],
+    algorithm: str,
+    rotate_refresh_tokens: bool,
 ):
-    key = jwk.JWK.generate(kty="EC", size=2048)
+    key = generate_key(algorithm)
     app_id = app_id or str(uuid.uuid4())
     app = ClientApp(
         name=app_name,
@@ -41,15 +57,23 @@ def createapp(
         refresh_token_expire_hours=None,
         redirect_url=url,
         owner=config.WEBMASTER_EMAIL,
+        algorithm=algorithm,
+        rotate_refresh_tokens=rotate_refresh_tokens,
     )
     if refresh:
-        app.set_refresh_key(jwk.JWK.generate(kty="EC", size=4096))
+        app.set_refresh_key(generate_key(algorithm))
         app.refresh_token_expire_hours = refresh_token_expire_hours or 24
     app.set_key(key)
     if not api_key:
         api_key = secrets.token_urlsafe()
     app.set_api_key(api_key)
-    asyncio.run(app.insert())
+
+    async def _insert():
+        await app.insert()
+        await quota.forget_counter(app_id)
+        await redis_interface.close()
+
+    asyncio.run(_insert())
     print(f"New App ID: {app_id}")
     print(f"API Key: {api_key}")
 
@@ -57,12 +81,147 @@ def createapp(
 @cli.command()
 @click.argument("app_id")
 def reset_api_key(app_id: str):
-    app = asyncio.run(ClientApp.query(ClientApp.app_id == app_id).get())
     api_key = secrets.token_urlsafe()
-    app.set_api_key(api_key)
-    asyncio.run(app.save())
+
+    async def _reset():
+        app = await ClientApp.query(ClientApp.app_id == app_id).get()
+        app.set_api_key(api_key)
+        await app.save_settings()
+        await client_app_cache.invalidate(app_id)
+        await redis_interface.close()
+
+    asyncio.run(_reset())
     print(f"New API Key: {api_key}")
 
 
+@cli.command()
+@click.argument("app_id")
+@click.argument("remaining", type=int)
+def set_quota(app_id: str, remaining: int):
+    """Set how many authentications an app has left."""
+
+    async def _set() -> bool:
+        found = await quota.set_quota(app_id, remaining)
+        if found:
+            await client_app_cache.invalidate(app_id)
+        await redis_interface.close()
+        return found
+
+    if not asyncio.run(_set()):
+        raise click.BadParameter(f"no app with id {app_id}")
+    print(f"{app_id} has {remaining} authentications left")
+
+
+@cli.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", type=int, default=8025)
+@click.option("--latency", type=float, default=0, help="Seconds to delay responses")
+@click.option("--failure-rate", type=float, default=0, help="Fraction to fail")
+def mailgun_standin_server(host: str, port: int, latency: float, failure_rate: float):
+    """Run a local stand-in for the mailgun API, for testing and benchmarking."""
+    mailgun_standin.run(host, port, latency, failure_rate)
+
+
+@cli.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", type=int, default=8026)
+@click.option("--username", help="Require this login, anyone can send if not set")
+@click.option("--password")
+@click.option("--latency", type=float, default=0, help="Seconds to delay each message")
+def smtp_standin_server(
+    host: str,
+    port: int,
+    username: Optional[str],
+    password: Optional[str],
+    latency: float,
+):
+    """Run a local stand-in for an SMTP server, for testing and benchmarking."""
+    smtp_standin.run(host, port, username, password, latency)
+
+
+@cli.command()
+@click.option("--consumer", help="Unique name for this worker")
+@click.option("--batch-size", type=int, default=config.EMAIL_QUEUE_BATCH_SIZE)
+@click.option("--concurrency", type=int, default=config.EMAIL_PROVIDER_CONCURRENCY)
+def email_worker(consumer: Optional[str], batch_size: int, concurrency: int):
+    """Send queued emails until stopped."""
+    asyncio.run(email_queue.work(consumer, batch_size, concurrency))
+
+
+@cli.command()
+@click.option("-n", "--number", type=int, default=2000, help="Tokens per algorithm")
+def benchmark_tokens(number: int):
+    """Measure how fast tokens are issued and verified with each algorithm."""
+    for algorithm in ALGORITHMS:
+        app = ClientApp(
+            name="Benchmark",
+            app_id=str(uuid.uuid4()),
+            redirect_url="http://localhost",
+            owner=None,
+            algorithm=algorithm,
+        )
+        app.set_key(generate_key(algorithm))
+        start = time.perf_counter()
+        tokens = [
+            security_token.generate("test@example.com", app) for _ in range(number)
+        ]
+        issued = time.perf_counter() - start
+        start = time.perf_counter()
+        for token in tokens:
+            security_token.verify(token, app)
+        verified = time.perf_counter() - start
+        print(
+            f"{algorithm}: issued {number / issued:.0f}/s, "
+            f"verified {number / verified:.0f}/s"
+        )
+
+
+@cli.command()
+def create_indexes():
+    """Build any missing indexes and drop the ones they replace, reporting progress."""
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+
+    async def _create():
+        for model in (ClientApp, RefreshToken, User):
+            created = await indexes.ensure_indexes(model)
+            print(f"{model.__name__}: created {', '.join(created) or 'nothing'}")
+
+    asyncio.run(_create())
+
+
+@cli.command()
+@click.option(
+    "--source", type=click.Choice(list(refresh_store.STORES)), default="mongo"
+)
+@click.option(
+    "--target", type=click.Choice(list(refresh_store.STORES)), default="redis"
+)
+@click.option("--batch-size", type=int, default=500)
+def migrate_refresh_tokens(source: str, target: str, batch_size: int):
+    """
+    Copy unexpired refresh tokens from one store to another, a batch at a time.
+    Tokens already copied are overwritten, so it is safe to run again.
+    """
+    if source == target:
+        raise click.BadParameter("source and target must be different stores")
+
+    async def _migrate():
+        from_store = refresh_store.get_store(source)
+        to_store = refresh_store.get_store(target)
+        copied = 0
+        batch = []
+        async for record in from_store.scan():
+            batch.append(record)
+            if len(batch) == batch_size:
+                copied += await to_store.save_many(batch)
+                batch = []
+                print(f"Copied {copied} refresh tokens")
+        copied += await to_store.save_many(batch)
+        print(f"Copied {copied} refresh tokens from {source} to {target}")
+        await redis_interface.close()
+
+    asyncio.run(_migrate())
+
+
 if __name__ == "__main__":
     cli()